@@ -18,7 +18,7 @@ import signal
 import socket
 import subprocess
 import sys
-from twisted.internet import reactor, task
+from twisted.internet import defer, reactor, task, threads
 
 # esky is only needed for updating the application if its frozen
 if hasattr(sys, 'frozen'):
@@ -29,8 +29,14 @@ from . import __version__
 from . import daemon
 from . import monitors
 from . import network
+from . import scheduler
+from . import telemetry
+import hiveary.info.dmesg
 import hiveary.info.system
+import hiveary.logwatch
 import hiveary.paths
+import hiveary.startup
+import hiveary.statsd
 
 
 class RealityAuditor(daemon.Daemon):
@@ -38,8 +44,11 @@ class RealityAuditor(daemon.Daemon):
   network connections are active, and gravity is working."""
 
   INITIAL_DELAY = 5  # Small delay to make sure the network has been initialized
+  MAX_WORKERS = 5  # Maximum number of monitors collecting data at the same time
+  STARTUP_TIMEOUT = 30  # Longest wait for the first samples before the startup message is sent, in seconds
+  SOURCES_UPDATE_INTERVAL = 60 * 5  # Shortest time between startup messages resent for new sources, in seconds
+  TELEMETRY_TIMER = 60 * 5  # How often to report the agent's own telemetry, in seconds
   UPDATE_TIMER = 60 * 60 * 8  # How often to check for agent updates, in seconds
-  PID_FILE = '/var/run/hiveary-agent.pid'  # Default location of the PID file
   REMOTE_HOST = 'hiveary.com'  # Default server to connect to
   MONITORS_DIR = '/usr/lib/hiveary/'  # Default location to find monitor modules
   EXTERNAL_DIR = '/etc/hiveary/external/' # Default location to find monitor config files
@@ -57,13 +66,9 @@ class RealityAuditor(daemon.Daemon):
 
     self.startup_path = os.path.abspath(os.path.curdir)
 
-    # Check that the directory for the pid file exists, and if not then use
-    # the same directory as the config file
-    pid_file = stored_config.get('pid_file', self.PID_FILE)
-    if not os.path.isdir(os.path.dirname(pid_file)):
-      directory = os.path.dirname(stored_config['filename'])
-      filename = os.path.basename(pid_file)
-      pid_file = os.path.join(directory, filename)
+    pid_file = hiveary.paths.get_pid_file(stored_config['filename'],
+                                          stored_config.get('pid_file'))
+    self.telemetry_file = hiveary.paths.get_telemetry_file(pid_file)
 
     # Check if the monitors directory exists, otherwise, place it under the
     # location of the config file
@@ -75,6 +80,18 @@ class RealityAuditor(daemon.Daemon):
         os.makedirs(self.monitors_dir)
 
     self.monitors = []
+    self.scheduler = None
+    self.live_sampler = None
+    self.collect_locks = {}  # Monitor UID mapped to a lock, so collections don't overlap
+
+    # The startup message is resent when monitors add sources after it was sent
+    self.inventory = None
+    self.startup_sent = None  # Reactor time the startup message was last sent
+    self.startup_resend = None
+
+    # Monitors collect their data in a bounded pool of worker threads, leaving
+    # the reactor free for publishing and the network.
+    self.threadpool = scheduler.MonitorThreadPool(0, self.MAX_WORKERS, 'hiveary-monitors')
 
     # Check if the external monitor config directory exists, otherwise place it
     # under the location of the config file
@@ -85,10 +102,23 @@ class RealityAuditor(daemon.Daemon):
       if not os.path.isdir(self.external_dir):
         os.makedirs(self.external_dir)
 
+    # Keep track of the kernel log records that have already been read next to
+    # the config file, so restarts don't have to parse the full kernel log again
+    hiveary.info.dmesg.cursor_file = os.path.join(
+        os.path.dirname(stored_config['filename']), 'kmsg.cursor')
+    hiveary.logwatch.checkpoint_file = os.path.join(
+        os.path.dirname(stored_config['filename']), 'logs.offsets')
+
+    # The StatsD listener is only started when it's configured, so it doesn't
+    # take the port or socket of another StatsD server on the host
+    hiveary.statsd.port = stored_config.get('statsd_port')
+    hiveary.statsd.unix_socket = stored_config.get('statsd_socket')
+
     # Get and possibly save optional configuration parameters. If the defaults
     # are used, they won't be saved.
     self.extra_options = {}
-    for option in ('monitor_backoff', 'pid_file', 'ca_bundle', 'monitors_dir'):
+    for option in ('monitor_backoff', 'pid_file', 'ca_bundle', 'monitors_dir',
+                   'statsd_port', 'statsd_socket'):
       value = stored_config.get(option)
       if value:
         self.extra_options[option] = value
@@ -112,7 +142,8 @@ class RealityAuditor(daemon.Daemon):
     in the foreground. All monitors are started from here and communication
     with the server is started."""
 
-    self.network_controller.ensure_internet_connection()
+    with hiveary.startup.phase('checking the connection'):
+      self.network_controller.ensure_internet_connection()
 
     if hasattr(sys, 'frozen'):
       # Setup the auto-updater
@@ -122,18 +153,86 @@ class RealityAuditor(daemon.Daemon):
                         self.auto_agent_update)
 
     # Load all monitors
-    self.load_monitors()
+    with hiveary.startup.phase('loading monitors'):
+      self.load_monitors()
 
     # Connect to the server
-    self.network_controller.initialize_amqp()
+    with hiveary.startup.phase('connecting to the server'):
+      self.network_controller.initialize_amqp()
+
+    # Monitors are spread out using the host ID, which is known once connected
+    self.scheduler = scheduler.MonitorScheduler(
+        reactor, host_id=self.network_controller.obj_id)
+    self.live_sampler = scheduler.LiveSampler(reactor, self.scheduler, self.sample_live,
+                                              telemetry.recorder)
+    self.network_controller.live_sampler = self.live_sampler
+    self.threadpool.start()
+    reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+
+    # The system inventory is slow to gather, so it's gathered in the
+    # background while the monitors start collecting data
+    inventory = threads.deferToThread(self.gather_inventory)
+
+    # Start all of our monitors, each collecting its first sample straight away
+    first_samples = []
+    with hiveary.startup.phase('starting monitors'):
+      for monitor in self.monitors:
+        first_sample = self.start_monitor(monitor)
+        if first_sample is not None:
+          first_samples.append(first_sample)
+
+    # The startup message is sent once the inventory is ready. It also waits
+    # for the first samples, which complete the sources of monitors that find
+    # them as they sample, but not for longer than STARTUP_TIMEOUT.
+    samples = scheduler.with_timeout(reactor, defer.DeferredList(first_samples),
+                                     self.STARTUP_TIMEOUT)
+    samples.addErrback(lambda failure: self.logger.warn(
+        'Not all monitors collected their first sample within %ss', self.STARTUP_TIMEOUT))
+    ready = defer.gatherResults([inventory, samples])
+    ready.addCallback(lambda results: self.send_startup(results[0]))
+    ready.addErrback(lambda failure: self.logger.error(
+        'Failed to send the startup message: %s', failure.getTraceback()))
+
+    # Report how long each monitor is taking
+    reactor.callLater(self.INITIAL_DELAY, self.start_loop, self.TELEMETRY_TIMER,
+                      self.report_telemetry)
 
-    # Start all of our monitors
-    for monitor in self.monitors:
-      self.start_monitor(monitor)
+    # Send a ping to the server to act as a keep-alive.
+    reactor.callLater(self.INITIAL_DELAY, self.start_loop,
+                      self.network_controller.PING_TIMER,
+                      self.network_controller.ping_pong)
+
+    reactor.run()
+
+  def gather_inventory(self):
+    """Gathers the system inventory for the startup message. This is safe to
+    call outside of the reactor thread.
+
+    Returns:
+      A dictionary of system information, which is empty if it couldn't be
+      gathered.
+    """
+
+    try:
+      with hiveary.startup.phase('gathering the system inventory'):
+        return hiveary.info.system.pull_all()
+    except Exception:
+      self.logger.error('Failed to gather the system inventory', exc_info=True)
+      return {}
+
+  def send_startup(self, info):
+    """Sends the startup message, describing this host and its monitors, to
+    the server. This must be called from the reactor thread.
+
+    Args:
+      info: A dictionary of system information.
+    """
+
+    resend = self.startup_sent is not None
+    self.inventory = info
 
-    # Send the first data dump
     data = {}
-    data['info'] = hiveary.info.system.pull_all()
+    data['info'] = info
     data['version'] = __version__
     data['host_id'] = self.network_controller.obj_id
     data['stack'] = self.STACK
@@ -155,17 +254,39 @@ class RealityAuditor(daemon.Daemon):
         monitor_data['default_type'] = monitor.DEFAULT_TYPE
 
       data['monitors'].append(monitor_data)
-    reactor.callLater(self.INITIAL_DELAY,
-                      self.network_controller.publish_info_message,
-                      'startup',
-                      json.dumps(data))
+    self.network_controller.publish_info_message('startup', json.dumps(data))
+    self.startup_sent = reactor.seconds()
+    if resend:
+      self.logger.info('Startup message resent with the new monitor sources')
+    else:
+      self.logger.info('Startup message sent %.3fs after startup',
+                       hiveary.startup.elapsed())
 
-    # Send a ping to the server to act as a keep-alive.
-    reactor.callLater(self.INITIAL_DELAY, self.start_loop,
-                      self.network_controller.PING_TIMER,
-                      self.network_controller.ping_pong)
+  def report_sources(self, monitor):
+    """Resends the startup message after a monitor has added sources, so the
+    server learns about them. Sources added before the startup message is
+    first sent are already part of it, and resends are batched to at most one
+    every SOURCES_UPDATE_INTERVAL. This is safe to call outside of the
+    reactor thread.
 
-    reactor.run()
+    Args:
+      monitor: Instance of a monitor class
+    """
+
+    self.logger.debug('%s (%s) monitor added sources', monitor.NAME, monitor.UID)
+    reactor.callFromThread(self.schedule_startup_resend)
+
+  def schedule_startup_resend(self):
+    """Schedules the startup message to be resent, unless it hasn't been sent
+    yet or a resend is already scheduled."""
+
+    if self.startup_sent is None:
+      return
+    if self.startup_resend is not None and self.startup_resend.active():
+      return
+
+    delay = max(0, self.startup_sent + self.SOURCES_UPDATE_INTERVAL - reactor.seconds())
+    self.startup_resend = reactor.callLater(delay, self.send_startup, self.inventory)
 
   def load_monitors(self):
     """Loads all monitors from the config file. If it cannot find a configured module,
@@ -206,6 +327,9 @@ class RealityAuditor(daemon.Daemon):
         self.logger.info('Loading %s from %s', class_name, module_name)
         try:
           monitor = monitor_class()
+        except monitors.MonitorDisabled as e:
+          self.logger.info('Not loading %s: %s', class_name, e)
+          continue
         except Exception:
           self.logger.error('Failed to load class %s from module %s',
                             class_name, module_name)
@@ -228,13 +352,24 @@ class RealityAuditor(daemon.Daemon):
         self.logger.warn('Failed to load external monitor config %s', filename, exc_info=True)
       else:
 
-        if (not config.get('type') or not config.get('name') or not config.get('uid')
-            or not config.get('get_data')):
+        monitor_type = config.get('type', '').lower()
+        # Log monitors follow files instead of running a get_data command
+        data_field = 'files' if monitor_type == 'log' else 'get_data'
+        if (not monitor_type or not config.get('name') or not config.get('uid')
+            or not config.get(data_field)):
           self.logger.warn('Not all required fields present for %s external monitor', filename)
           continue
 
-        monitor_type = config.get('type', '').lower()
-        if monitor_type == 'usage':
+        if monitor_type == 'log':
+          MonitorClass = type(classname, (monitors.PollingMixin, monitors.LogMonitor), {})
+          try:
+            monitor = MonitorClass(**config)
+          except Exception as e:
+            self.logger.error('Failed to instantiate External Monitor %s, due to %s', filename, e, exc_info=True)
+          else:
+            self.monitors.append(monitor)
+          continue
+        elif monitor_type == 'usage':
           base_class = monitors.UsageMonitor
           if not config.get('sources') and not config.get('default_type'):
             self.logger.warn('No sources or default type provided for External Usage Monitor %s', filename)
@@ -249,7 +384,8 @@ class RealityAuditor(daemon.Daemon):
           continue
 
         methods = {}
-        MonitorClass = type(classname, (monitors.PollingMixin, base_class, monitors.ExternalMonitor), methods)
+        # ExternalMonitor comes first so its collect overrides PollingMixin's
+        MonitorClass = type(classname, (monitors.ExternalMonitor, monitors.PollingMixin, base_class), methods)
         try:
           monitor = MonitorClass(**config)
         except Exception as e:
@@ -257,23 +393,143 @@ class RealityAuditor(daemon.Daemon):
         else:
           self.monitors.append(monitor)
 
+    # Log monitors also report how fast their files are written to, and any
+    # structured fields of their lines, as usage data that can be alerted on
+    for monitor in list(self.monitors):
+      if isinstance(monitor, monitors.LogMonitor):
+        try:
+          self.monitors.append(monitors.LogRateMonitor(monitor))
+          if monitor.extractor is not None:
+            self.monitors.append(monitors.LogFieldMonitor(monitor))
+        except Exception:
+          self.logger.error('Failed to load the log rates of %s', monitor.NAME, exc_info=True)
+
   def start_monitor(self, monitor):
     """Starts a given monitor.
 
     Args:
       monitor: Instance of a monitor class
+    Returns:
+      A Deferred that fires once the monitor's first sample has been
+      collected, or None if it isn't collected straight away.
     """
 
     self.logger.debug('Starting %s (%s) monitor data checks', monitor.NAME,
                       monitor.UID)
     self.network_controller.monitors[monitor.UID] = monitor
     monitor.send_alert = self.network_controller.publish_alert_message
-
-    # Check if the monitor should run in a loop
-    if monitor.DATA_INTERVAL is not None:
-      self.start_loop(monitor.DATA_INTERVAL, monitor.run, self.network_controller)
+    monitor.report_sources = self.report_sources
+    self.collect_locks[monitor.UID] = defer.DeferredLock()
+
+    # Check if the monitor should run in a loop. Monitors that sample faster
+    # than they send data have their samples aggregated until the next send.
+    if monitor.DATA_INTERVAL is not None and monitor.subsampling():
+      self.scheduler.add(monitor.UID + '.sample', monitor.sample_interval(),
+                         self.run_monitor, monitor, flush=False)
+      self.scheduler.add(monitor.UID, monitor.DATA_INTERVAL, monitor.flush,
+                         self.network_controller)
+    elif monitor.DATA_INTERVAL is not None:
+      self.scheduler.add(monitor.UID, monitor.DATA_INTERVAL, self.run_monitor,
+                         monitor)
     else:
       reactor.callInThread(monitor.run, self.network_controller)
+      return None
+
+    # The scheduled runs are spread out over the interval, so the first sample
+    # is sent now rather than up to a full interval after startup. Monitors
+    # whose get_data drains what they've gathered are left to their schedule.
+    if not monitor.LIVE_SAMPLING:
+      return None
+    return self.run_monitor(monitor)
+
+  def run_monitor(self, monitor, flush=True, adapt=True):
+    """Collects a sample from a monitor off the reactor thread, then publishes
+    it back on the reactor thread.
+
+    Args:
+      monitor: Instance of a monitor class
+      flush: Whether to send the data to the server straight away, otherwise
+          the sample is stored until the monitor is next flushed.
+      adapt: Whether the sample can change an adaptive monitor's interval.
+    Returns:
+      A Deferred that fires once the collection has finished, even if it has
+      already timed out, so the scheduler won't start overlapping runs.
+    """
+
+    start_time = reactor.seconds()
+    # A livestream sample and a regular one can come due together, and
+    # get_data isn't expected to be called from two threads at once
+    collected = self.collect_locks[monitor.UID].run(monitor.collect, reactor,
+                                                     self.threadpool)
+
+    def publish(data):
+      if flush:
+        monitor.publish(self.network_controller, data)
+      else:
+        monitor.add_sample(data)
+      telemetry.recorder.record(monitor.UID, 'run', reactor.seconds() - start_time)
+
+      # Adaptive monitors sample faster while their data is volatile
+      interval = monitor.adapt_interval(data) if adapt else None
+      if interval is not None:
+        key = monitor.UID if flush else monitor.UID + '.sample'
+        self.logger.debug('%s (%s) monitor now sampling every %ss', monitor.NAME,
+                          monitor.UID, interval)
+        self.scheduler.reschedule(key, interval)
+
+    timeout = monitor.RUN_TIMEOUT or monitor.DATA_INTERVAL
+    result = scheduler.with_timeout(reactor, collected, timeout)
+    result.addCallback(publish)
+    result.addErrback(self.monitor_errback, monitor)
+
+    return collected
+
+  def sample_live(self, monitor):
+    """Collects an extra sample for a monitor's livestreams, which is stored
+    along with its regular samples. Nothing is collected if a collection is
+    already in progress.
+
+    Args:
+      monitor: Instance of a monitor class
+    Returns:
+      A Deferred that fires once the collection has finished, or None.
+    """
+
+    if self.collect_locks[monitor.UID].locked:
+      return None
+    return self.run_monitor(monitor, flush=False, adapt=False)
+
+  def monitor_errback(self, failure, monitor):
+    """Logs a failed monitor run.
+
+    Args:
+      failure: The twisted Failure of the run.
+      monitor: Instance of a monitor class
+    """
+
+    if failure.check(defer.TimeoutError):
+      telemetry.recorder.increment(monitor.UID, 'timeouts')
+      self.logger.warn('%s (%s) monitor timed out, its data will be dropped',
+                       monitor.NAME, monitor.UID)
+    else:
+      self.logger.error('%s (%s) monitor failed: %s', monitor.NAME, monitor.UID,
+                        failure.getTraceback())
+
+  def report_telemetry(self):
+    """Publishes the execution statistics of every monitor, and stores them
+    locally for the telemetry command."""
+
+    snapshot = telemetry.recorder.snapshot(
+        self.scheduler.stats() if self.scheduler else None)
+
+    try:
+      with open(self.telemetry_file, 'w') as file_desc:
+        json.dump(snapshot, file_desc)
+    except IOError:
+      self.logger.warn('Unable to write telemetry to %s', self.telemetry_file)
+
+    self.network_controller.publish_info_message('telemetry', snapshot,
+                                                 retry=False)
 
   def signal_handler(self, signum, stackframe):
     """Handles a SIGTERM or SIGINT sent to the process.
@@ -292,6 +548,12 @@ class RealityAuditor(daemon.Daemon):
     # Clean up the daemon after the reactor is done
     reactor.addSystemEventTrigger('after', 'shutdown', self.delpid)
 
+    if self.live_sampler:
+      self.live_sampler.stop_all()
+    if self.scheduler:
+      self.scheduler.stop()
+    for monitor in self.monitors:
+      monitor.stop()
     self.network_controller.stop_amqp()
     reactor.stop()
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Encoding of samples into messages, once per sample.
+"""
+
+import json
+
+
+def splice(fields, encoded):
+  """Adds fields to an object that's already encoded as JSON, without decoding
+  it again.
+
+  Args:
+    fields: A dictionary of the fields to add, none of which may already be in
+        the encoded object.
+    encoded: A JSON object as a string.
+  Returns:
+    The JSON string of the combined object.
+  """
+
+  if not fields:
+    return encoded
+  head = json.dumps(fields)
+  if encoded == '{}':
+    return head
+  return head[:-1] + ', ' + encoded[1:]
+
+
+class EncodedSample(object):
+  """A sample encoded as JSON a single time. The messages built from it, such
+  as the regular data send and the livestream frames, splice the encoded
+  sample into their own fields instead of encoding the sample again, and the
+  livestream frame is built once and shared by every viewer."""
+
+  def __init__(self, data, exclude=('extra',)):
+    """Initialize and encode the sample.
+
+    Args:
+      data: A dictionary of sampled data.
+      exclude: Keys of the data to leave out, such as alert details that
+          livestreams don't need.
+    """
+
+    if any(key in data for key in exclude):
+      data = dict((key, value) for key, value in data.iteritems() if key not in exclude)
+    self.keys = frozenset(data)
+    self.json = json.dumps(data)
+
+  def extend(self, fields):
+    """Returns the JSON of the sample with more top level fields.
+
+    Args:
+      fields: A dictionary of the fields to add, fields already in the sample
+          are ignored.
+    """
+
+    return splice(dict((key, value) for key, value in fields.iteritems()
+                       if key not in self.keys), self.json)
+
+  def wrap(self, key, fields):
+    """Returns the JSON of an object holding the sample under a key.
+
+    Args:
+      key: The key to put the sample under.
+      fields: A dictionary of the other fields of the object.
+    """
+
+    return splice(fields, '{%s: %s}' % (json.dumps(key), self.json))
+
+
+if __name__ == '__main__':
+  # Cost of sending a sample to its livestream viewers, encoding it for each
+  # viewer compared with encoding it once:
+  #   python -m hiveary.encoding [viewers] [sources]
+  import sys
+  import time
+
+  viewers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+  num_sources = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  repeats = 200
+
+  sample = dict(('source_%d' % i, i * 1.5) for i in xrange(num_sources))
+  sample.update({'timestamp': time.time(), 'interval': 15, 'extra': {'procs': ['x'] * 50}})
+
+  def per_viewer():
+    live_data = dict(sample)
+    live_data.pop('extra', None)
+    container = {'monitor_id': 'monitor', 'data': live_data}
+    sent = 0
+    for viewer in xrange(viewers):
+      # What publish_info_message did with each dictionary
+      message = dict(container)
+      message['host_id'] = 'host'
+      message['timestamp'] = time.time()
+      sent += len(json.dumps(message))
+    regular = dict(sample, host_id='host', id='monitor')
+    return sent + len(json.dumps(regular))
+
+  def once():
+    encoded = EncodedSample(sample)
+    frame = encoded.wrap('data', {'monitor_id': 'monitor', 'host_id': 'host',
+                                  'timestamp': time.time()})
+    sent = len(frame) * viewers
+    regular = encoded.extend({'extra': sample['extra'], 'host_id': 'host', 'id': 'monitor'})
+    return sent + len(regular)
+
+  for name, publish in (('Encoded per viewer', per_viewer), ('Encoded once', once)):
+    start = time.time()
+    for repeat in xrange(repeats):
+      sent = publish()
+    elapsed = (time.time() - start) / repeats
+    print '%-20s %d viewers, %d sources: %.2fms per sample, %d bytes' % (
+        name, viewers, num_sources, elapsed * 1000, sent)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Running of the commands behind external monitors.
+"""
+
+import itertools
+import json
+import logging
+import os
+import Queue
+import signal
+import subprocess
+import threading
+import time
+from twisted.internet import defer, error, protocol
+from twisted.python import failure
+
+# The reactor's POSIX process support, to start commands in their own session
+if os.name == 'posix':
+  from twisted.internet import process
+
+import hiveary.telemetry
+
+MAX_OUTPUT = 1024 * 1024  # Most output kept from a command, in bytes
+
+# Shared executor, created by get_executor
+executor = None
+
+
+class CommandError(Exception):
+  """Raised when an external command fails to return a result."""
+  pass
+
+
+def run_command(command, timeout=None):
+  """Runs a command synchronously, killing it if it takes too long. This is
+  for use outside of the reactor thread, when the output is needed straight
+  away.
+
+  Args:
+    command: The command to run, as a list of arguments.
+    timeout: The most time to let the command run, in seconds.
+  Returns:
+    The output of the command, with stderr merged into stdout.
+  Raises:
+    CommandError: The command failed to start or timed out.
+  """
+
+  # On POSIX the command gets its own process group, so any children it starts
+  # can be killed along with it
+  new_group = not subprocess.mswindows and hasattr(os, 'setsid')
+  try:
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            preexec_fn=os.setsid if new_group else None)
+  except OSError as e:
+    raise CommandError('Failed to start %s: %s' % (command[0], e))
+
+  killed = threading.Event()
+
+  def kill():
+    killed.set()
+    try:
+      if new_group:
+        os.killpg(proc.pid, signal.SIGKILL)
+      else:
+        proc.kill()
+    except OSError:
+      pass
+
+  timer = None
+  if timeout:
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+  try:
+    output = proc.communicate()[0]
+  finally:
+    if timer is not None:
+      timer.cancel()
+
+  if killed.is_set():
+    raise CommandError('%s timed out after %ss' % (command[0], timeout))
+  return output
+
+
+class CommandProtocol(protocol.ProcessProtocol):
+  """Collects the output of a command spawned by the reactor."""
+
+  def __init__(self, deferred):
+    self.deferred = deferred
+    self.output = []
+    self.size = 0
+    self.timed_out = False
+
+  def outReceived(self, data):
+    if self.size < MAX_OUTPUT:
+      self.output.append(data[:MAX_OUTPUT - self.size])
+      self.size += len(data)
+
+  # Stderr is merged into the output, as it is for synchronous commands
+  errReceived = outReceived
+
+  def processEnded(self, reason):
+    output = ''.join(self.output)
+    if self.timed_out:
+      self.deferred.errback(CommandError('Killed after timing out'))
+    elif reason.check(error.ProcessTerminated) and reason.value.exitCode is None:
+      self.deferred.errback(CommandError('Killed by signal %s' % reason.value.signal))
+    else:
+      self.deferred.callback(output)
+
+
+if os.name == 'posix':
+  class SessionProcess(process.Process):
+    """A process started in its own session, and so its own process group, so
+    that any children it starts can be killed along with it."""
+
+    def _execChild(self, *args):
+      os.setsid()
+      process.Process._execChild(self, *args)
+
+
+class CommandExecutor(object):
+  """Runs external commands through the reactor, so they don't tie up a
+  thread while they run. Commands from every monitor share a limit on how
+  many run at once, and are killed once their timeout passes. The latest
+  output of each command is cached, and runtimes are recorded against the
+  monitor in the telemetry.
+
+  All methods must be called from the reactor thread, apart from
+  cached_output and store_output."""
+
+  MAX_CONCURRENCY = 4  # Commands that can run at once across all monitors
+
+  def __init__(self, reactor, max_concurrency=MAX_CONCURRENCY, logger=None):
+    """Initialize the executor.
+
+    Args:
+      reactor: A reference to the twisted reactor.
+      max_concurrency: The most commands that can run at once.
+      logger: A logging object to use.
+    """
+
+    self.logger = logger or logging.getLogger('hiveary_agent.external')
+    self.reactor = reactor
+    self.semaphore = defer.DeferredSemaphore(max_concurrency)
+    self.results = {}  # Cache key mapped to a (time, output) tuple
+
+  def run(self, uid, key, command, timeout=None):
+    """Runs a command once a slot is free.
+
+    Args:
+      uid: The UID of the monitor running the command, for telemetry.
+      key: A key to cache the output under, such as uid + '.get_data'.
+      command: The command to run, as a list of arguments.
+      timeout: The most time to let the command run once started, in seconds.
+    Returns:
+      A Deferred that fires with the output of the command, with stderr merged
+      into stdout, or errbacks with a CommandError.
+    """
+
+    return self.semaphore.run(self._spawn, uid, key, command, timeout)
+
+  def _spawn(self, uid, key, command, timeout):
+    deferred = defer.Deferred()
+    command_protocol = CommandProtocol(deferred)
+    started = time.time()
+
+    try:
+      if os.name == 'posix':
+        transport = SessionProcess(self.reactor, command[0], command, os.environ,
+                                   None, command_protocol)
+      else:
+        transport = self.reactor.spawnProcess(command_protocol, command[0], command,
+                                              env=os.environ)
+    except (OSError, error.ProcessExitedAlready) as e:
+      hiveary.telemetry.recorder.increment(uid, 'command_failures')
+      return defer.fail(CommandError('Failed to start %s: %s' % (command[0], e)))
+    # The command's pid is also its process group, which outlives the command
+    # while any of its children are still running
+    group = transport.pid if os.name == 'posix' else None
+
+    def kill():
+      command_protocol.timed_out = True
+      try:
+        if group is not None:
+          os.killpg(group, signal.SIGKILL)
+        else:
+          command_protocol.transport.signalProcess('KILL')
+      except (OSError, error.ProcessExitedAlready):
+        pass
+      # Children of the command can keep its pipes open after it's killed
+      command_protocol.transport.loseConnection()
+    timer = self.reactor.callLater(timeout, kill) if timeout else None
+
+    def finished(outcome):
+      if timer is not None and timer.active():
+        timer.cancel()
+      hiveary.telemetry.recorder.record(uid, 'command', time.time() - started)
+      if command_protocol.timed_out:
+        hiveary.telemetry.recorder.increment(uid, 'command_timeouts')
+        self.logger.warn('%s timed out after %ss and was killed', command[0], timeout)
+        return failure.Failure(CommandError('%s timed out after %ss' % (command[0], timeout)))
+      if isinstance(outcome, failure.Failure):
+        hiveary.telemetry.recorder.increment(uid, 'command_failures')
+        return outcome
+      self.store_output(key, outcome)
+      return outcome
+
+    deferred.addBoth(finished)
+    return deferred
+
+  def cached_output(self, key, max_age=None):
+    """Finds the latest output stored for a key.
+
+    Args:
+      key: The key the output was stored under.
+      max_age: The oldest output to return, in seconds.
+    Returns:
+      The output, or None if there is none recent enough.
+    """
+
+    result = self.results.get(key)
+    if result is None or (max_age is not None and time.time() - result[0] > max_age):
+      return None
+    return result[1]
+
+  def store_output(self, key, output):
+    """Caches the output of a command.
+
+    Args:
+      key: The key to store the output under.
+      output: The output of the command.
+    """
+
+    self.results[key] = (time.time(), output)
+
+
+def get_executor(reactor=None):
+  """Returns the shared CommandExecutor, creating it the first time.
+
+  Args:
+    reactor: A reference to the twisted reactor, defaults to the global one.
+  """
+
+  global executor
+  if executor is None:
+    if reactor is None:
+      from twisted.internet import reactor
+    executor = CommandExecutor(reactor)
+  return executor
+
+
+class PersistentProcess(object):
+  """A long running command that answers requests over its stdin and stdout,
+  so the interpreter of a check script only has to start once.
+
+  Each request is written to stdin as a single line of JSON, such as
+  {"id": 1, "command": "get_data"}, and the command must write a single line
+  of JSON back with the same id, either {"id": 1, "result": {...}} or
+  {"id": 1, "error": "message"}. Requests are made one at a time.
+
+  The command is started on the first request and restarted on the next
+  request after it exits, waiting longer after each consecutive failure.
+  It's also restarted after repeated timeouts, since it's likely hung."""
+
+  MIN_RESTART_DELAY = 1  # Seconds to wait before the first restart
+  MAX_RESTART_DELAY = 300  # Longest wait between restarts, in seconds
+  MAX_TIMEOUTS = 3  # Consecutive timed out requests before restarting
+  STOP_TIMEOUT = 5  # Seconds to wait for the command to exit before killing it
+  _EOF = object()  # Queued by the reader once the command's stdout closes
+
+  def __init__(self, command, name, timeout=10, logger=None):
+    """Initialize the process. The command isn't started until it's needed.
+
+    Args:
+      command: The command to run, as a list of arguments.
+      name: The name of the monitor the command belongs to, used in logs.
+      timeout: The default time to wait for each response, in seconds.
+      logger: A logging object to use.
+    """
+
+    self.logger = logger or logging.getLogger('hiveary_agent.external')
+    self.command = command
+    self.name = name
+    self.timeout = timeout
+
+    self.lock = threading.Lock()
+    self.ids = itertools.count(1)
+    self.process = None
+    self.responses = None
+    self.failures = 0
+    self.timeouts = 0
+    self.next_start = 0
+
+  def running(self):
+    """Returns a boolean of whether the command is currently running."""
+
+    return self.process is not None and self.process.poll() is None
+
+  def _start(self):
+    """Starts the command, unless it's waiting to be restarted.
+
+    Raises:
+      CommandError: The command is waiting to restart or failed to start.
+    """
+
+    if self.process is not None:
+      # The command exited since the last request
+      self._crashed()
+
+    now = time.time()
+    if now < self.next_start:
+      raise CommandError('%s is restarting in %.1fs' % (self.name, self.next_start - now))
+
+    self.logger.info('Starting persistent command for %s monitor', self.name)
+    try:
+      self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      bufsize=1, close_fds=not subprocess.mswindows)
+    except OSError as e:
+      self.process = None
+      self._crashed()
+      raise CommandError('Failed to start %s: %s' % (self.name, e))
+
+    self.responses = Queue.Queue()
+    self.timeouts = 0
+    for target, stream in ((self._read_responses, self.process.stdout),
+                           (self._read_errors, self.process.stderr)):
+      reader = threading.Thread(target=target, args=(stream, self.responses),
+                                name='hiveary-%s-reader' % self.name)
+      reader.daemon = True
+      reader.start()
+
+  def _read_responses(self, stream, responses):
+    """Thread target that parses each line from the command's stdout.
+
+    Args:
+      stream: The stdout of the command.
+      responses: The Queue to put parsed responses on.
+    """
+
+    for line in iter(stream.readline, ''):
+      try:
+        response = json.loads(line)
+      except ValueError:
+        self.logger.warn('Ignoring invalid output from %s: %r', self.name, line[:200])
+        continue
+      if type(response) is dict:
+        responses.put(response)
+    responses.put(self._EOF)
+
+  def _read_errors(self, stream, responses):
+    """Thread target that logs the command's stderr.
+
+    Args:
+      stream: The stderr of the command.
+      responses: Unused, present to match _read_responses.
+    """
+
+    for line in iter(stream.readline, ''):
+      self.logger.debug('%s: %s', self.name, line.rstrip())
+
+  def request(self, command, timeout=None, **params):
+    """Sends a request to the command and waits for its response.
+
+    Args:
+      command: The name of the request, such as get_data.
+      timeout: The time to wait for the response in seconds, defaults to the
+          timeout given at initialization.
+      **params: Any extra values to include in the request.
+    Returns:
+      The result sent by the command.
+    Raises:
+      CommandError: The command couldn't be started, exited, timed out, or
+          returned an error.
+    """
+
+    timeout = self.timeout if timeout is None else timeout
+
+    with self.lock:
+      if not self.running():
+        self._start()
+
+      request_id = self.ids.next()
+      params.update({'id': request_id, 'command': command})
+      try:
+        self.process.stdin.write(json.dumps(params) + '\n')
+        self.process.stdin.flush()
+      except (IOError, OSError) as e:
+        raise CommandError('Failed to send request to %s: %s' % (self.name, e))
+
+      deadline = time.time() + timeout
+      while True:
+        remaining = deadline - time.time()
+        try:
+          if remaining <= 0:
+            raise Queue.Empty
+          response = self.responses.get(timeout=remaining)
+        except Queue.Empty:
+          self.timeouts += 1
+          if self.timeouts >= self.MAX_TIMEOUTS:
+            self.logger.warn('%s timed out %d times in a row, restarting it',
+                             self.name, self.timeouts)
+            self._stop()
+          raise CommandError('%s timed out after %ss' % (self.name, timeout))
+
+        if response is self._EOF:
+          code = self.process.wait()
+          self._crashed()
+          raise CommandError('%s exited with code %s' % (self.name, code))
+        if response.get('id') != request_id:
+          # A late response to a request that already timed out
+          continue
+
+        self.failures = 0
+        self.timeouts = 0
+        if 'error' in response:
+          raise CommandError('%s returned an error: %s' % (self.name, response['error']))
+        return response.get('result')
+
+  def _crashed(self):
+    """Stops a command that failed, and delays its restart by a backoff that
+    grows with each consecutive failure, counted from now. The lock must be
+    held."""
+
+    self.failures += 1
+    self._stop()
+    delay = min(self.MIN_RESTART_DELAY * 2 ** self.failures, self.MAX_RESTART_DELAY)
+    self.next_start = time.time() + delay
+
+  def _stop(self):
+    """Stops the command if it's running, killing it if it hasn't exited
+    within STOP_TIMEOUT. The lock must be held."""
+
+    if self.process is None:
+      return
+    if self.process.poll() is None:
+      try:
+        self.process.stdin.close()
+        self.process.terminate()
+      except (IOError, OSError):
+        pass
+
+      deadline = time.time() + self.STOP_TIMEOUT
+      while self.process.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+      if self.process.poll() is None:
+        self.logger.warn('%s did not exit after %ss, killing it', self.name, self.STOP_TIMEOUT)
+        try:
+          self.process.kill()
+        except OSError:
+          pass
+    self.process.wait()
+    self.process = None
+
+  def stop(self):
+    """Stops the command. Any request in progress fails once the command's
+    stdout closes, so this doesn't wait on the lock."""
+
+    process = self.process
+    if process is not None and process.poll() is None:
+      try:
+        process.terminate()
+      except OSError:
+        pass
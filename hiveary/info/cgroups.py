@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Functions for collecting container resource information from the cgroup
+hierarchy. Both the legacy (v1) per-controller hierarchies and the unified (v2)
+hierarchy are supported.
+"""
+
+import errno
+import logging
+import os
+import re
+import time
+
+MOUNTINFO_FILE = '/proc/self/mountinfo'
+
+# Container runtimes (docker, containerd, cri-o) name the container cgroup with
+# the full 64 character container ID, optionally wrapped in a systemd scope
+# name such as docker-<id>.scope.
+_container_id_regex = re.compile('([0-9a-f]{64})')
+
+logger = logging.getLogger('hiveary_agent.info.cgroups')
+
+
+def find_hierarchies(mountinfo_file=MOUNTINFO_FILE):
+  """Finds the mount points of the cgroup hierarchies used for resource stats.
+
+  Args:
+    mountinfo_file: The mountinfo file to parse.
+  Returns:
+    A dictionary mapping the controller name (cpuacct, memory, blkio) to its
+    mount point for v1 hierarchies, with the additional key 'unified' for the
+    v2 hierarchy if it is mounted with the needed controllers enabled.
+  """
+
+  hierarchies = {}
+
+  try:
+    with open(mountinfo_file, 'r') as mountinfo:
+      mounts = mountinfo.readlines()
+  except IOError:
+    logger.warn('Unable to read %s, cgroups are not available', mountinfo_file)
+    return hierarchies
+
+  for mount in mounts:
+    # Format: id parent major:minor root mountpoint options - fstype source superoptions
+    fields = mount.split(' - ')
+    if len(fields) != 2:
+      continue
+    mount_point = fields[0].split()[4]
+    fs_fields = fields[1].split()
+    fs_type = fs_fields[0]
+
+    if fs_type == 'cgroup2':
+      # The unified hierarchy is only useful if the controllers are delegated to it
+      try:
+        with open(os.path.join(mount_point, 'cgroup.controllers'), 'r') as controllers:
+          enabled = controllers.read().split()
+      except IOError:
+        enabled = []
+      if 'cpu' in enabled or 'memory' in enabled:
+        hierarchies['unified'] = mount_point
+    elif fs_type == 'cgroup':
+      options = fs_fields[2].split(',') if len(fs_fields) > 2 else []
+      for controller in ('cpuacct', 'memory', 'blkio'):
+        if controller in options:
+          hierarchies[controller] = mount_point
+
+  return hierarchies
+
+
+def container_id(cgroup_path):
+  """Extracts the container ID from a cgroup path.
+
+  Args:
+    cgroup_path: A cgroup path, either relative to the hierarchy or absolute.
+  Returns:
+    The full container ID, or None if the path does not belong to a container.
+  """
+
+  matches = _container_id_regex.findall(cgroup_path)
+  if matches:
+    # Nested runtimes (such as docker-in-docker) use the innermost ID
+    return matches[-1]
+
+
+def container_for_pid(pid):
+  """Finds which container a process belongs to using /proc/[pid]/cgroup.
+
+  Args:
+    pid: The process ID to look up.
+  Returns:
+    The full container ID, or None if the process is not in a container or no
+    longer exists.
+  """
+
+  try:
+    with open('/proc/{0}/cgroup'.format(pid), 'r') as cgroup_file:
+      lines = cgroup_file.readlines()
+  except IOError:
+    return None
+
+  for line in lines:
+    # Format: hierarchy-ID:controller-list:cgroup-path
+    path = line.rstrip('\n').split(':', 2)[-1]
+    found_id = container_id(path)
+    if found_id:
+      return found_id
+
+
+def find_containers(root):
+  """Walks a cgroup hierarchy to find all container cgroups.
+
+  Args:
+    root: The mount point of the hierarchy to walk.
+  Returns:
+    A dictionary mapping each container ID to the path of its cgroup relative
+    to the hierarchy root.
+  """
+
+  containers = {}
+
+  for dirpath, dirnames, _ in os.walk(root):
+    matched = []
+    for dirname in dirnames:
+      found_id = container_id(dirname)
+      if found_id:
+        containers[found_id] = os.path.relpath(os.path.join(dirpath, dirname), root)
+        matched.append(dirname)
+
+    # Container cgroups never need to be descended into, which keeps the walk
+    # proportional to the number of containers rather than their processes.
+    for dirname in matched:
+      dirnames.remove(dirname)
+
+  return containers
+
+
+def parse_flat_keyed(content):
+  """Parses the "key value" per line format used by cpu.stat and memory.stat.
+
+  Args:
+    content: The contents of the stat file.
+  Returns:
+    A dictionary of the stat names mapped to their integer values.
+  """
+
+  stats = {}
+  for line in content.splitlines():
+    fields = line.split()
+    if len(fields) == 2:
+      try:
+        stats[fields[0]] = int(fields[1])
+      except ValueError:
+        continue
+  return stats
+
+
+def parse_io_stat(content):
+  """Parses the cgroup v2 io.stat format into read and written byte totals.
+
+  Args:
+    content: The contents of io.stat, one device per line such as
+        "8:0 rbytes=1459200 wbytes=314773504 rios=192 wios=353 ...".
+  Returns:
+    A tuple of the total (read bytes, written bytes) across all devices.
+  """
+
+  read_bytes = 0
+  write_bytes = 0
+  for line in content.splitlines():
+    for field in line.split()[1:]:
+      key, _, value = field.partition('=')
+      if key == 'rbytes':
+        read_bytes += int(value)
+      elif key == 'wbytes':
+        write_bytes += int(value)
+  return (read_bytes, write_bytes)
+
+
+def parse_blkio_service_bytes(content):
+  """Parses the cgroup v1 blkio.throttle.io_service_bytes format into read and
+  written byte totals.
+
+  Args:
+    content: The contents of the file, such as "8:0 Read 1459200".
+  Returns:
+    A tuple of the total (read bytes, written bytes) across all devices.
+  """
+
+  read_bytes = 0
+  write_bytes = 0
+  for line in content.splitlines():
+    fields = line.split()
+    if len(fields) != 3:
+      # Skips the trailing "Total" line, which has no device
+      continue
+    if fields[1] == 'Read':
+      read_bytes += int(fields[2])
+    elif fields[1] == 'Write':
+      write_bytes += int(fields[2])
+  return (read_bytes, write_bytes)
+
+
+def default_max_open_files():
+  """Finds how many stat files to keep open, a quarter of the process's file
+  descriptor limit, leaving the rest for sockets, logs and monitors.
+
+  Returns:
+    The number of files.
+  """
+
+  try:
+    import resource
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+  except (ImportError, ValueError, OSError):
+    return CgroupStatReader.MIN_OPEN_FILES * 16
+  if limit == resource.RLIM_INFINITY:
+    return CgroupStatReader.MAX_OPEN_FILES
+  return min(max(limit // 4, CgroupStatReader.MIN_OPEN_FILES), CgroupStatReader.MAX_OPEN_FILES)
+
+
+class CgroupStatReader(object):
+  """Reads cgroup stat files while keeping the file descriptors open between
+  reads, so that repeated polling of hundreds of cgroups doesn't have to pay
+  for the path lookup and open on every interval.
+
+  Every file is read once per interval in the same order, so once the cache
+  is full, new files are opened for each read rather than evicting cached
+  ones, which would leave every read a miss. Files of removed containers are
+  closed with forget_cgroup, making room for new ones."""
+
+  MIN_OPEN_FILES = 16  # Fewest files kept open, even after running out of descriptors
+  MAX_OPEN_FILES = 16384  # Most files kept open, however high the descriptor limit
+  RECOVERY_TIME = 300  # Seconds after running out of descriptors before caching more files again
+
+  def __init__(self, hierarchies, max_open_files=None):
+    """Initialize the reader.
+
+    Args:
+      hierarchies: A dictionary of hierarchy mount points, as returned by
+          find_hierarchies.
+      max_open_files: The most file descriptors to keep open, defaults to
+          default_max_open_files().
+    """
+
+    self.hierarchies = hierarchies
+    self.unified = 'unified' in hierarchies
+    self.open_files_limit = max_open_files or default_max_open_files()
+    self.max_open_files = self.open_files_limit
+    self.reduced_at = None
+    self._files = {}
+
+  def read(self, path):
+    """Reads the full contents of a stat file, reusing a cached descriptor.
+
+    Args:
+      path: The absolute path of the stat file.
+    Returns:
+      The contents of the file, or None if it could not be read.
+    """
+
+    if self.reduced_at is not None and time.time() - self.reduced_at > self.RECOVERY_TIME:
+      self.max_open_files = self.open_files_limit
+      self.reduced_at = None
+
+    stat_file = self._files.get(path)
+    cached = stat_file is not None
+    try:
+      if not cached:
+        stat_file = self._open(path)
+      stat_file.seek(0)
+      content = stat_file.read()
+    except (IOError, OSError) as e:
+      if cached:
+        self.forget(path)
+      elif stat_file is not None:
+        stat_file.close()
+      if e.errno in (errno.EMFILE, errno.ENFILE):
+        logger.warn('Out of file descriptors, unable to read %s', path)
+      elif e.errno not in (errno.ENOENT, errno.ENODEV):
+        logger.debug('Unable to read %s: %s', path, e)
+      # Otherwise the cgroup was removed along with its container
+      return None
+
+    if not cached:
+      if len(self._files) < self.max_open_files:
+        self._files[path] = stat_file
+      else:
+        stat_file.close()
+    return content
+
+  def _open(self, path):
+    """Opens a stat file. If the process is out of file descriptors, half of
+    the cached files are closed to give some back and the open is retried.
+    Fewer files are cached until RECOVERY_TIME has passed.
+
+    Args:
+      path: The absolute path of the stat file.
+    Returns:
+      The open file.
+    """
+
+    try:
+      return open(path, 'r')
+    except (IOError, OSError) as e:
+      if e.errno not in (errno.EMFILE, errno.ENFILE) or not self._files:
+        raise
+      self.max_open_files = max(len(self._files) // 2, self.MIN_OPEN_FILES)
+      self.reduced_at = time.time()
+      logger.warn('Out of file descriptors, keeping at most %d cgroup stat files open',
+                  self.max_open_files)
+      for cached_path in self._files.keys()[self.max_open_files:]:
+        self.forget(cached_path)
+      return open(path, 'r')
+
+  def forget(self, path):
+    """Closes and removes a cached file descriptor.
+
+    Args:
+      path: The absolute path of the stat file.
+    """
+
+    stat_file = self._files.pop(path, None)
+    if stat_file is not None:
+      try:
+        stat_file.close()
+      except (IOError, OSError):
+        pass
+
+  def forget_cgroup(self, cgroup_path):
+    """Closes all cached file descriptors that belong to a cgroup.
+
+    Args:
+      cgroup_path: The cgroup path relative to the hierarchy roots.
+    """
+
+    for root in self.hierarchies.itervalues():
+      prefix = os.path.join(root, cgroup_path) + os.sep
+      for path in [p for p in self._files if p.startswith(prefix)]:
+        self.forget(path)
+
+  def close(self):
+    """Closes all cached file descriptors."""
+
+    for path in self._files.keys():
+      self.forget(path)
+
+  def _read_int(self, path):
+    content = self.read(path)
+    if content:
+      try:
+        return int(content.strip())
+      except ValueError:
+        return None
+
+  def container_stats(self, cgroup_path):
+    """Reads the cumulative resource counters for a single cgroup.
+
+    Args:
+      cgroup_path: The cgroup path relative to the hierarchy roots.
+    Returns:
+      A dictionary with the keys cpu_usage (seconds), memory (bytes),
+      io_read and io_write (cumulative bytes). Counters that could not be
+      read are left out.
+    """
+
+    stats = {}
+
+    if self.unified:
+      base = os.path.join(self.hierarchies['unified'], cgroup_path)
+
+      cpu_stat = self.read(os.path.join(base, 'cpu.stat'))
+      if cpu_stat:
+        usage = parse_flat_keyed(cpu_stat).get('usage_usec')
+        if usage is not None:
+          stats['cpu_usage'] = usage / 1e6
+
+      memory = self._read_int(os.path.join(base, 'memory.current'))
+      if memory is not None:
+        # Report the working set like `docker stats`, since the page cache
+        # can be reclaimed under pressure.
+        memory_stat = parse_flat_keyed(self.read(os.path.join(base, 'memory.stat')) or '')
+        stats['memory'] = max(0, memory - memory_stat.get('inactive_file', 0))
+
+      io_stat = self.read(os.path.join(base, 'io.stat'))
+      if io_stat is not None:
+        stats['io_read'], stats['io_write'] = parse_io_stat(io_stat)
+    else:
+      if 'cpuacct' in self.hierarchies:
+        usage = self._read_int(os.path.join(self.hierarchies['cpuacct'], cgroup_path,
+                                            'cpuacct.usage'))
+        if usage is not None:
+          stats['cpu_usage'] = usage / 1e9
+
+      if 'memory' in self.hierarchies:
+        base = os.path.join(self.hierarchies['memory'], cgroup_path)
+        memory = self._read_int(os.path.join(base, 'memory.usage_in_bytes'))
+        if memory is not None:
+          memory_stat = parse_flat_keyed(self.read(os.path.join(base, 'memory.stat')) or '')
+          stats['memory'] = max(0, memory - memory_stat.get('total_inactive_file', 0))
+
+      if 'blkio' in self.hierarchies:
+        io_bytes = self.read(os.path.join(self.hierarchies['blkio'], cgroup_path,
+                                          'blkio.throttle.io_service_bytes'))
+        if io_bytes is not None:
+          stats['io_read'], stats['io_write'] = parse_blkio_service_bytes(io_bytes)
+
+    return stats
+
+  def find_containers(self):
+    """Finds all container cgroups in the hierarchy used for stats.
+
+    Returns:
+      A dictionary mapping each container ID to its relative cgroup path.
+    """
+
+    for controller in ('unified', 'memory', 'cpuacct', 'blkio'):
+      if controller in self.hierarchies:
+        return find_containers(self.hierarchies[controller])
+    return {}
@@ -17,14 +17,41 @@ Licensed under Simplified BSD License (see LICENSE)
 pydmesg: dmesg with human-readable timestamps
 """
 
+import collections
+import errno
+import json
+import logging
+import os
 import re
 import subprocess
 import sys
+import threading
+import time
 
 
+KMSG_FILE = '/dev/kmsg'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+MAX_RECORDS = 1000  # Number of recent kernel records kept in memory
+MAX_SOURCE_RECORDS = 100  # Number of recent records kept for each source
+READ_SIZE = 8192  # Read buffer for a single kernel record, the most the kernel formats, in bytes
+MAX_READ_SIZE = 65536  # Larger read buffer tried once for a record too big for READ_SIZE
+
+# File used to persist the last read kernel record across agent restarts. This
+# is set by the agent, the cursor is not persisted if left empty.
+cursor_file = None
+
 # Regex for dmesg lines that allows the source of the message to be obtained.
 _dmesg_line_regex = re.compile("^\[.*?\] ((?P<source>.*?): )?.*$")
 
+# Regex for the source prefix of a raw kernel message, such as "usb 1-1: ..."
+_kmsg_source_regex = re.compile("^(?P<source>[^ :][^:]{0,63}?): ")
+
+logger = logging.getLogger('hiveary_agent.info.dmesg')
+
+_reader = None
+_reader_lock = threading.Lock()
+_kmsg_unavailable = False
+
 
 def exec_process(cmdline, silent, input=None, **kwargs):
   """Execute a subprocess and returns the returncode, stdout buffer and stderr buffer.
@@ -46,7 +73,266 @@ def exec_process(cmdline, silent, input=None, **kwargs):
   return stdout
 
 
+class KmsgReader(object):
+  """Reads kernel log records from /dev/kmsg without blocking, keeping a
+  bounded ring of the most recent records indexed by their source. Each poll
+  only reads the records logged since the previous one."""
+
+  def __init__(self, path=KMSG_FILE, capacity=MAX_RECORDS,
+               source_capacity=MAX_SOURCE_RECORDS, cursor_path=None):
+    """Open the kernel log.
+
+    Args:
+      path: The kernel log device to read.
+      capacity: The number of recent records to keep in memory.
+      source_capacity: The number of recent records to keep for each source.
+      cursor_path: An optional file to persist the sequence cursor to.
+    Raises:
+      OSError: The kernel log could not be opened.
+    """
+
+    self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    self.capacity = capacity
+    self.source_capacity = source_capacity
+    self.cursor_path = cursor_path
+    self.lock = threading.Lock()
+
+    self.records = collections.deque(maxlen=capacity)
+    self.by_source = {}
+
+    # Record timestamps are in microseconds since boot, find out when the
+    # system booted once so they can be converted cheaply.
+    with open('/proc/uptime', 'r') as uptime:
+      self.boot_time = time.time() - float(uptime.read().split()[0])
+
+    self.boot_id = self._read_boot_id()
+    self.cursor = -1
+    self.saved_cursor = -1
+
+    # Records older than the ring can hold relative to the persisted cursor
+    # would be evicted anyway, so they don't need to be parsed after a restart.
+    self.skip_until = -1
+    persisted = self._load_cursor()
+    if persisted is not None:
+      self.skip_until = persisted - capacity
+
+  def _read_boot_id(self):
+    try:
+      with open(BOOT_ID_FILE, 'r') as boot_id:
+        return boot_id.read().strip()
+    except IOError:
+      return None
+
+  def _load_cursor(self):
+    if not self.cursor_path or not self.boot_id:
+      return None
+
+    try:
+      with open(self.cursor_path, 'r') as cursor:
+        saved = json.load(cursor)
+    except (IOError, ValueError):
+      return None
+
+    # Sequence numbers restart at every boot
+    if saved.get('boot_id') != self.boot_id:
+      return None
+    return saved.get('seq')
+
+  def _save_cursor(self):
+    if not self.cursor_path or self.cursor == self.saved_cursor:
+      return
+
+    try:
+      with open(self.cursor_path, 'w') as cursor:
+        json.dump({'boot_id': self.boot_id, 'seq': self.cursor}, cursor)
+    except IOError:
+      logger.debug('Unable to persist the kmsg cursor to %s', self.cursor_path,
+                   exc_info=True)
+    else:
+      self.saved_cursor = self.cursor
+
+  def poll(self):
+    """Reads all records logged since the last poll.
+
+    Returns:
+      The number of new records read.
+    """
+
+    new_records = 0
+
+    with self.lock:
+      read_size = READ_SIZE
+      while True:
+        try:
+          # Every read returns exactly one record
+          raw_record = os.read(self.fd, read_size)
+        except OSError as err:
+          if err.errno == errno.EAGAIN:
+            break
+          elif err.errno == errno.EPIPE:
+            # Records were overwritten in the kernel buffer before they could
+            # be read, the next read continues with the oldest available one.
+            continue
+          elif err.errno == errno.EINVAL:
+            # The record was larger than the read buffer. The kernel doesn't
+            # move past it, so it's retried once with a larger buffer.
+            if read_size < MAX_READ_SIZE:
+              read_size = MAX_READ_SIZE
+              continue
+            # /dev/kmsg can only seek to the oldest or the newest record, so
+            # the only way past the record is to skip to the newest one
+            logger.warn('Kernel record larger than %d bytes, skipping to the newest '
+                        'kernel record', MAX_READ_SIZE)
+            os.lseek(self.fd, 0, os.SEEK_END)
+            read_size = READ_SIZE
+            continue
+          raise
+
+        read_size = READ_SIZE
+        if not raw_record:
+          break
+        if self._add_record(raw_record):
+          new_records += 1
+
+      self._save_cursor()
+
+    return new_records
+
+  def _add_record(self, raw_record):
+    """Parses a raw record and stores it in the ring.
+
+    Args:
+      raw_record: A record in the /dev/kmsg format, such as
+          "6,339,5140900,-;usb 1-1: new device\n SUBSYSTEM=usb\n DEVICE=c189:1\n"
+    Returns:
+      True if the record was stored.
+    """
+
+    header, _, body = raw_record.partition(';')
+    fields = header.split(',')
+    try:
+      seq = int(fields[1])
+      usec = int(fields[2])
+    except (IndexError, ValueError):
+      return False
+
+    self.cursor = max(self.cursor, seq)
+    if seq <= self.skip_until:
+      return False
+
+    body_lines = body.split('\n')
+    message = body_lines[0]
+
+    # Continuation lines carry the dictionary of properties for the record
+    sources = set()
+    for property_line in body_lines[1:]:
+      key, _, value = property_line.strip().partition('=')
+      if key in ('SUBSYSTEM', 'DEVICE') and value:
+        sources.add(value)
+    match = _kmsg_source_regex.match(message)
+    if match:
+      sources.add(match.group('source'))
+
+    timestamp = time.strftime('%a %b %d %H:%M:%S %Y',
+                              time.localtime(self.boot_time + usec / 1e6))
+    record = (seq, '[{0}] {1}'.format(timestamp, message))
+
+    self.records.append(record)
+    for source in sources:
+      source_records = self.by_source.get(source)
+      if source_records is None:
+        if len(self.by_source) >= self.capacity:
+          self._prune_sources()
+        source_records = self.by_source[source] = collections.deque(
+            maxlen=self.source_capacity)
+      source_records.append(record)
+
+    return True
+
+  def _prune_sources(self):
+    """Removes sources that no longer have any records in the main ring."""
+
+    oldest = self.records[0][0] if self.records else 0
+    for source, source_records in self.by_source.items():
+      if source_records[-1][0] < oldest:
+        del self.by_source[source]
+
+  def recent(self, source=None, max_lines=20):
+    """Returns the most recent formatted records.
+
+    Args:
+      source: If provided, only records from this source will be returned. An
+          exact subsystem, device or message prefix is found directly, any
+          other value is matched as a substring of the known sources.
+      max_lines: The maximum number of records to return.
+    Returns:
+      A list of formatted lines, newest first.
+    """
+
+    with self.lock:
+      if source is None:
+        records = self.records
+      elif source in self.by_source:
+        records = self.by_source[source]
+      else:
+        matched = {}
+        for known_source, source_records in self.by_source.iteritems():
+          if source in known_source:
+            matched.update(source_records)
+        records = sorted(matched.iteritems())
+
+      lines = []
+      for index in xrange(len(records) - 1, -1, -1):
+        if len(lines) >= max_lines:
+          break
+        lines.append(records[index][1])
+
+    return lines
+
+
+def get_reader():
+  """Returns the shared kernel log reader, creating it on first use.
+
+  Returns:
+    A KmsgReader instance, or None if /dev/kmsg can't be read on this system.
+  """
+
+  global _reader, _kmsg_unavailable
+
+  with _reader_lock:
+    if _reader is None and not _kmsg_unavailable:
+      try:
+        _reader = KmsgReader(cursor_path=cursor_file)
+      except (OSError, IOError):
+        logger.info('Unable to read %s, falling back to dmesg', KMSG_FILE)
+        _kmsg_unavailable = True
+
+  return _reader
+
+
 def human_dmesg(source=None, max_lines=20):
+  """Format and return the most recent kernel log lines, read from /dev/kmsg
+  when available.
+
+  Args:
+    source: If provided, only lines from this source will be returned.
+    max_lines: The maximum number of lines to return, in reverse order.
+  Returns:
+    None in the event of an error, otherwise an array of the last dmesg lines.
+  """
+
+  reader = get_reader()
+  if reader is None:
+    return exec_dmesg(source=source, max_lines=max_lines)
+
+  try:
+    reader.poll()
+  except OSError:
+    logger.error('Failed to read from %s', KMSG_FILE, exc_info=True)
+  return reader.recent(source=source, max_lines=max_lines)
+
+
+def exec_dmesg(source=None, max_lines=20):
   """Format and return lines from the output of dmesg.
 
   Args:
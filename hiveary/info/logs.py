@@ -12,6 +12,7 @@ Functions for collecting local log information.
 import datetime
 import logging
 import os
+import stat
 import subprocess
 
 if subprocess.mswindows:
@@ -25,6 +26,17 @@ else:
 import hiveary.info
 
 NUM_LOG_LINES = 20
+TAIL_BLOCK_SIZE = 8192  # Bytes read per seek when reading the end of a file
+SNIFF_BLOCK_SIZE = 1024  # Bytes read from the start of a file to check if it's text
+MAX_SNIFF_CACHE = 4096  # Maximum number of cached text/binary verdicts
+
+# Bytes that are expected in text files. Anything 0x80 or above is allowed so
+# that UTF-8 and other 8-bit encodings are treated as text.
+_text_chars = ''.join(map(chr, [7, 8, 9, 10, 12, 13, 27] + range(0x20, 0x7f) + range(0x80, 0x100)))
+
+# Cache of text/binary verdicts, keyed by (device, inode, mtime, size) so that
+# a changed or replaced file is always checked again.
+_sniff_cache = {}
 logger = logging.getLogger('hiveary_agent.info.logs')
 
 
@@ -43,7 +55,7 @@ def log_files(process, fuzzy_matches=None):
   fuzzy_matches = fuzzy_matches or ('log', 'err', 'info')
   log_paths = []
 
-  for open_file in process.get('open_files', []):
+  for open_file in process.get('open_files') or []:
     path = open_file['path']
 
     # Ignore duplicated file handlers.
@@ -51,7 +63,7 @@ def log_files(process, fuzzy_matches=None):
       continue
 
     # Ignore any binary files.
-    if 'text' not in subprocess.check_output(['file', '-b', path]):
+    if not is_text_file(path):
       continue
 
     # Anything within a log directory can be included, regardless of name
@@ -69,8 +81,94 @@ def log_files(process, fuzzy_matches=None):
   return log_paths
 
 
+def is_text_file(path):
+  """Checks whether a path is a regular text file using the first block of
+  the file, similar to the heuristic used by `file`.
+
+  Args:
+    path: The path of the file to check.
+  Returns:
+    True if the file is a non-empty regular file that looks like text.
+  """
+
+  try:
+    file_stat = os.stat(path)
+  except OSError:
+    return False
+
+  # Sockets, pipes and devices show up as open files too
+  if not stat.S_ISREG(file_stat.st_mode) or not file_stat.st_size:
+    return False
+
+  key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+  verdict = _sniff_cache.get(key)
+  if verdict is not None:
+    return verdict
+
+  try:
+    with open(path, 'rb') as file_desc:
+      block = file_desc.read(SNIFF_BLOCK_SIZE)
+  except IOError:
+    return False
+
+  if '\0' in block:
+    verdict = False
+  else:
+    # Treat the file as binary if more than 30% of it isn't text
+    non_text = block.translate(None, _text_chars)
+    verdict = len(non_text) <= len(block) * 0.3
+
+  if len(_sniff_cache) >= MAX_SNIFF_CACHE:
+    _sniff_cache.clear()
+  _sniff_cache[key] = verdict
+
+  return verdict
+
+
+def read_last_lines(file_desc, num_lines, block_size=TAIL_BLOCK_SIZE):
+  """Reads the last lines of an open file by seeking backwards from the end
+  in fixed size blocks, so only the tail of the file is ever read.
+
+  Args:
+    file_desc: A file object opened in binary mode.
+    num_lines: The number of lines to read from the end of the file.
+    block_size: The number of bytes to read per seek.
+  Returns:
+    A list of up to num_lines raw lines, oldest first, without line endings.
+  """
+
+  if num_lines <= 0:
+    return []
+
+  file_desc.seek(0, os.SEEK_END)
+  position = file_desc.tell()
+  blocks = []
+  newlines = 0
+
+  # One extra newline is needed to know the first line is complete, and a
+  # trailing newline at the end of the file doesn't start a new line.
+  while position > 0 and newlines <= num_lines:
+    read_size = min(block_size, position)
+    position -= read_size
+    file_desc.seek(position)
+    block = file_desc.read(read_size)
+    if not block:
+      # The file was truncated while reading
+      break
+    if not blocks and block.endswith('\n'):
+      newlines -= 1
+    newlines += block.count('\n')
+    blocks.append(block)
+
+  blocks.reverse()
+  lines = ''.join(blocks).splitlines()
+  return lines[-num_lines:]
+
+
 def tail_file(filename, num_lines=NUM_LOG_LINES):
-  """Pulls the last lines from a file.
+  """Pulls the last lines from a file. If the file was recently rotated and
+  doesn't have enough lines, the remaining lines are read from the end of the
+  previous file.
 
   Args:
     filename: The name of the file to pull from.
@@ -80,15 +178,25 @@ def tail_file(filename, num_lines=NUM_LOG_LINES):
   """
 
   try:
-    # stderr is piped to stdout so that if an error occurs it isn't
-    # propogated up to the parent process.
-    file_lines = subprocess.check_output(['tail', '-n', str(num_lines), filename],
-                                         stderr=subprocess.STDOUT)
-  except subprocess.CalledProcessError as err:
-    logger.error('Unable to read %s - returned %d: %s',
-                 filename, err.returncode, err.message)
-  else:
-    return file_lines
+    with open(filename, 'rb') as file_desc:
+      lines = read_last_lines(file_desc, num_lines)
+  except (IOError, OSError) as err:
+    logger.error('Unable to read %s: %s', filename, err)
+    return
+
+  rotated_filename = filename + '.1'
+  if len(lines) < num_lines and os.path.isfile(rotated_filename):
+    try:
+      with open(rotated_filename, 'rb') as file_desc:
+        lines = read_last_lines(file_desc, num_lines - len(lines)) + lines
+    except (IOError, OSError):
+      logger.debug('Unable to read rotated log %s', rotated_filename, exc_info=True)
+
+  if lines:
+    # Logs aren't guaranteed to have a consistent encoding, so replace anything
+    # that isn't valid rather than failing the JSON encoding later.
+    return '\n'.join(lines).decode('utf-8', 'replace') + u'\n'
+  return ''
 
 
 def read_event_log(logtype='Application', max_entries=NUM_LOG_LINES, hours_back=12):
@@ -199,3 +307,19 @@ def read_system_logs():
       system_logs['syslog'] = syslog_lines
 
   return [system_logs]
+
+
+if __name__ == '__main__':
+  # Benchmark the in-process reader against running tail for a given file:
+  #   python -m hiveary.info.logs /var/log/big.log [iterations]
+  import sys
+  import timeit
+
+  bench_file = sys.argv[1]
+  iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  print 'File size: %d bytes' % os.path.getsize(bench_file)
+  for name, call in (('tail_file', lambda: tail_file(bench_file)),
+                     ('tail -n', lambda: subprocess.check_output(
+                         ['tail', '-n', str(NUM_LOG_LINES), bench_file]))):
+    elapsed = timeit.timeit(call, number=iterations)
+    print '%-10s %.3f ms per call' % (name, elapsed / iterations * 1000)
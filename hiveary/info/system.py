@@ -9,6 +9,7 @@ Licensed under Simplified BSD License (see LICENSE)
 Functions for collecting local system information.
 """
 
+import heapq
 import logging
 import netifaces
 import os
@@ -17,6 +18,7 @@ import psutil
 import simplejson
 import socket
 import subprocess
+import time
 
 if subprocess.mswindows:
   import win32net
@@ -473,6 +475,80 @@ def pull_processes(top=None, top_number=5):
   return top_procs
 
 
+def top_processes(top, top_number=5, attrs=('name', 'pid', 'get_open_files'),
+                  deadline=None):
+  """Finds the processes with the highest usage of a resource, without
+  building the full information for every process like pull_processes does.
+
+  The selection is done in two phases. First only the requested numeric value
+  is read for each process, then the remaining attributes are read for just
+  the winning processes.
+
+  Args:
+    top: The resource to rank processes by, either memory_percent or
+        cpu_percent.
+    top_number: Number of top processes to return.
+    attrs: The psutil.Process attributes to pull for each of the top processes.
+    deadline: An optional time.time() value. Once passed, the scan stops early
+        and the remaining processes are returned without the extra attributes.
+  Returns:
+    A list of the top processes, highest usage first. Each process is a
+    JSONable dictionary including the `top` value along with the requested
+    attributes, the same format as pull_processes.
+  """
+
+  if top == 'cpu_percent':
+    # process_iter caches the Process instances, so the CPU percent is measured
+    # since the previous scan rather than blocking for a new interval.
+    def read_value(p):
+      value = p.get_cpu_percent(interval=None)
+      return value, {'cpu_percent': value}
+  elif top == 'memory_percent':
+    # The same calculation as get_memory_percent, keeping the memory info it
+    # reads so it isn't read again for the winners
+    total_memory = float(psutil.TOTAL_PHYMEM)
+    def read_value(p):
+      memory_info = p.get_memory_info()
+      value = memory_info.rss / total_memory * 100
+      return value, {'memory_percent': value, 'memory_info': memory_info}
+  else:
+    raise ValueError('Unknown top process resource "%s"' % top)
+
+  # Phase one: a cheap scan of a single numeric value per process
+  scanned = []
+  for p in psutil.process_iter():
+    try:
+      value, details = read_value(p)
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+      continue
+    scanned.append((value, p, details))
+
+    if deadline and time.time() > deadline:
+      logger.warn('Deadline passed while scanning processes, using a partial scan')
+      break
+
+  # Phase two: read the more expensive details for the winners only, reusing
+  # the values already read by the scan. as_dict names values without the
+  # get_ prefix of their Process method.
+  top_procs = []
+  for value, p, details in heapq.nlargest(top_number, scanned, key=lambda s: s[0]):
+    process = {'pid': p.pid}
+    remaining = [attr for attr in attrs
+                 if attr != 'pid' and (attr[4:] if attr.startswith('get_') else attr) not in details]
+    try:
+      process['name'] = p.name
+      if remaining and (not deadline or time.time() <= deadline):
+        process.update(p.as_dict(attrs=remaining))
+    except psutil.NoSuchProcess:
+      continue
+    process.update(details)
+    process = simplejson.loads(simplejson.dumps(process))
+    top_procs.append(process)
+
+  logger.debug('Retrieved the top %d processes by %s', len(top_procs), top)
+  return top_procs
+
+
 def pull_update_settings():
   """Retrieves information about the system's auto update settings, currently
   only applicable to Windows.
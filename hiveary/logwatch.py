@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Incremental following of log files, similar to tail -F.
+"""
+
+import errno
+import json
+import logging
+import os
+import re
+import threading
+from twisted.internet import task
+
+# inotify is only available on Linux, other systems poll the files instead
+try:
+  from twisted.internet import inotify
+  from twisted.python import filepath
+except ImportError:
+  inotify = None
+
+READ_SIZE = 1024 * 1024  # Most data read from a file per event, in bytes
+MAX_LINE_LENGTH = 64 * 1024  # Longer lines are split, so a missing newline can't use up memory
+POLL_INTERVAL = 1  # Time between polls when inotify isn't available, in seconds
+SAFETY_POLL_INTERVAL = 30  # Time between polls when using inotify, to catch missed events
+
+# Severity words counted in every line, in any case, such as "ERROR" or
+# "level=error". A line counts once for each severity it has a word of. Only
+# whole words count, so "STDERR" or "errors" aren't errors.
+SEVERITIES = {
+    'CRIT': 'critical',
+    'CRITICAL': 'critical',
+    'FATAL': 'critical',
+    'EMERG': 'critical',
+    'EMERGENCY': 'critical',
+    'ERR': 'error',
+    'ERROR': 'error',
+    'WARN': 'warning',
+    'WARNING': 'warning',
+}
+_severity_regex = re.compile(r'\b(?:%s)\b' % '|'.join(sorted(SEVERITIES, key=len, reverse=True)),
+                             re.IGNORECASE)
+
+# File used to persist file offsets across agent restarts. This is set by the
+# agent, offsets are not persisted if left empty.
+checkpoint_file = None
+
+logger = logging.getLogger('hiveary_agent.logwatch')
+
+_offsets = None
+_offsets_lock = threading.Lock()
+
+
+def load_offsets():
+  """Returns the persisted offset of every followed file.
+
+  Returns:
+    A dictionary of file paths mapped to {'dev', 'ino', 'offset'}.
+  """
+
+  global _offsets
+  with _offsets_lock:
+    if _offsets is None:
+      _offsets = {}
+      if checkpoint_file:
+        try:
+          with open(checkpoint_file, 'r') as checkpoint:
+            _offsets = json.load(checkpoint)
+        except (IOError, ValueError):
+          pass
+    return dict(_offsets)
+
+
+def save_offsets(offsets):
+  """Persists the offsets of some files, leaving the rest as they were.
+
+  Args:
+    offsets: A dictionary of file paths mapped to {'dev', 'ino', 'offset'}.
+  """
+
+  if not checkpoint_file:
+    return
+
+  load_offsets()
+  with _offsets_lock:
+    _offsets.update(offsets)
+    try:
+      temp_file = checkpoint_file + '.tmp'
+      with open(temp_file, 'w') as checkpoint:
+        json.dump(_offsets, checkpoint)
+      # Replaced in one step so a crash can't leave a partial checkpoint
+      os.rename(temp_file, checkpoint_file)
+    except (IOError, OSError):
+      logger.debug('Unable to persist the log offsets to %s', checkpoint_file,
+                   exc_info=True)
+
+
+class LogFollower(object):
+  """Follows a single file, reading only the data appended since the last
+  read. The file is reopened from the start when it's rotated, after the rest
+  of the old file has been read, and read from the start again when it's
+  truncated."""
+
+  def __init__(self, path, checkpoint=None):
+    """Initialize the follower. The file is opened at its persisted offset if
+    it's the same file, otherwise at its end.
+
+    Args:
+      path: The path of the file.
+      checkpoint: The persisted {'dev', 'ino', 'offset'} of the file, if any.
+    """
+
+    self.path = path
+    self.file = None
+    self.identity = None  # The (device, inode) of the open file
+    self.offset = 0
+    self.partial = ''
+
+    # Totals since the agent started
+    self.lines_read = 0
+    self.bytes_read = 0
+    self.rotations = 0
+    self.severities = dict.fromkeys(set(SEVERITIES.itervalues()), 0)
+
+    self._open(checkpoint, from_start=False)
+
+  def _open(self, checkpoint=None, from_start=True):
+    """Opens the file at the path, if it exists.
+
+    Args:
+      checkpoint: The persisted position of the file, used if it's the same file.
+      from_start: Whether to read a file without a valid checkpoint from the
+          start, otherwise it's read from its end.
+    Returns:
+      A boolean of whether the file was opened.
+    """
+
+    try:
+      log_file = open(self.path, 'rb')
+    except IOError:
+      return False
+
+    stat = os.fstat(log_file.fileno())
+    self.file = log_file
+    self.identity = (stat.st_dev, stat.st_ino)
+    self.partial = ''
+
+    if (checkpoint and (checkpoint.get('dev'), checkpoint.get('ino')) == self.identity
+        and checkpoint.get('offset', 0) <= stat.st_size):
+      self.offset = checkpoint['offset']
+    elif from_start:
+      self.offset = 0
+    else:
+      self.offset = stat.st_size
+    self.file.seek(self.offset)
+    return True
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  def checkpoint(self):
+    """Returns the position of the follower to persist, or None if the file
+    isn't open."""
+
+    if self.identity is None:
+      return None
+    # Any partial line will be read again after a restart
+    return {'dev': self.identity[0], 'ino': self.identity[1],
+            'offset': self.offset - len(self.partial)}
+
+  def read(self, limit=READ_SIZE):
+    """Reads any complete lines appended since the last read.
+
+    Args:
+      limit: The most data to read, in bytes.
+    Returns:
+      A tuple of the list of new lines, without their line endings, and a
+      boolean of whether there may be more data to read.
+    """
+
+    if self.file is None and not self._open():
+      return [], False
+
+    data = self.file.read(limit)
+    if not data:
+      partial = self.partial
+      rotations = self.rotations
+      # A replaced or truncated file is read from the start straight away
+      more = self._check_rotation()
+      if partial and self.rotations != rotations:
+        # The last line of the rotated file had no line ending
+        lines = [partial.rstrip('\r').decode('utf-8', 'replace')]
+        self._count(lines)
+        return lines, more
+      return [], more
+
+    self.offset += len(data)
+    self.bytes_read += len(data)
+
+    lines = (self.partial + data).split('\n')
+    self.partial = lines.pop()
+    if len(self.partial) > MAX_LINE_LENGTH:
+      lines.append(self.partial)
+      self.partial = ''
+
+    lines = [line.rstrip('\r').decode('utf-8', 'replace') for line in lines]
+    self._count(lines)
+    return lines, len(data) == limit
+
+  def _count(self, lines):
+    """Adds lines to the line and severity counters.
+
+    Args:
+      lines: A list of the lines read.
+    """
+
+    self.lines_read += len(lines)
+    findall = _severity_regex.findall
+    severities = self.severities
+    for line in lines:
+      markers = findall(line)
+      if len(markers) == 1:
+        severities[SEVERITIES[markers[0].upper()]] += 1
+      elif markers:
+        for severity in set(SEVERITIES[marker.upper()] for marker in markers):
+          severities[severity] += 1
+
+  def _check_rotation(self):
+    """Checks whether the file at the path has been replaced or truncated,
+    once the open file has been read to its end.
+
+    Returns:
+      A boolean of whether the file is now being read from the start.
+    """
+
+    try:
+      stat = os.stat(self.path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        logger.debug('Unable to stat %s', self.path, exc_info=True)
+      # Rotated away and not yet recreated, keep the old file until it is
+      return False
+
+    if (stat.st_dev, stat.st_ino) != self.identity:
+      logger.debug('%s was rotated', self.path)
+      self.rotations += 1
+      self.close()
+      return self._open()
+    elif stat.st_size < self.offset:
+      logger.debug('%s was truncated', self.path)
+      self.offset = 0
+      self.partial = ''
+      self.file.seek(0)
+      return True
+    return False
+
+
+class LogWatcher(object):
+  """Follows a set of files, using inotify to read new data as soon as it's
+  written where it's available, otherwise polling the files. New lines that
+  pass a filter are buffered until they're drained. Each drain also returns
+  the file offsets matching the drained lines, which are persisted with commit
+  once the lines have been sent, so lines are neither lost nor read twice
+  across restarts.
+
+  Files are read from the reactor thread, drain and commit can be called from
+  any thread."""
+
+  def __init__(self, paths, line_filter=None, max_lines=10000, reactor=None,
+               line_observer=None):
+    """Initialize the watcher and start following the files.
+
+    Args:
+      paths: A list of the file paths to follow.
+      line_filter: An optional function called with each line, only lines it
+          returns a true value for are buffered, along with the value.
+      max_lines: The most lines to buffer between drains, any more are counted
+          as dropped.
+      reactor: A reference to the twisted reactor, defaults to the global one.
+      line_observer: An optional function called with every list of new
+          lines before they're filtered, on the reactor thread.
+    """
+
+    if reactor is None:
+      from twisted.internet import reactor
+    self.reactor = reactor
+    self.line_filter = line_filter
+    self.line_observer = line_observer
+    self.max_lines = max_lines
+
+    self.lock = threading.Lock()
+    self.lines = []  # Buffered (path, line, filter result) tuples
+    self.dropped = 0
+    self.positions = {}  # Path mapped to the checkpoint matching the buffered lines
+
+    offsets = load_offsets()
+    self.followers = {}
+    for path in paths:
+      path = os.path.abspath(path)
+      self.followers[path] = LogFollower(path, offsets.get(path))
+
+    self.notifier = None
+    if inotify is not None:
+      try:
+        self.notifier = inotify.INotify(reactor)
+        self.notifier.startReading()
+        mask = inotify.IN_MODIFY | inotify.IN_CREATE | inotify.IN_MOVED_TO
+        # Directories are watched so rotated and recreated files are seen
+        for directory in set(os.path.dirname(path) for path in self.followers):
+          self.notifier.watch(filepath.FilePath(directory), mask,
+                              callbacks=[self._notified])
+      except Exception:
+        logger.info('inotify is unavailable, polling log files instead', exc_info=True)
+        self.notifier = None
+
+    self.poller = task.LoopingCall(self.poll)
+    interval = SAFETY_POLL_INTERVAL if self.notifier else POLL_INTERVAL
+    self.poller.clock = reactor
+    self.poller.start(interval, now=False)
+
+  def _notified(self, watch, path, mask):
+    follower = self.followers.get(path.path)
+    if follower is not None:
+      self.read(follower)
+
+  def poll(self):
+    """Reads any new data from every file."""
+
+    for follower in self.followers.itervalues():
+      self.read(follower)
+
+  def read(self, follower):
+    """Reads the new lines from a file into the buffer. Large amounts of new
+    data are read in chunks, yielding to the reactor between them.
+
+    Args:
+      follower: The LogFollower of the file.
+    """
+
+    lines, more = follower.read()
+    if lines and self.line_observer is not None:
+      self.line_observer(lines)
+    if self.line_filter is not None:
+      line_filter = self.line_filter
+      lines = [(line, result) for line, result in ((line, line_filter(line)) for line in lines)
+               if result]
+    else:
+      lines = [(line, None) for line in lines]
+
+    with self.lock:
+      if lines:
+        room = self.max_lines - len(self.lines)
+        if len(lines) > room:
+          self.dropped += len(lines) - max(room, 0)
+          lines = lines[:max(room, 0)]
+        self.lines.extend((follower.path, line, result) for line, result in lines)
+      checkpoint = follower.checkpoint()
+      if checkpoint is not None:
+        self.positions[follower.path] = checkpoint
+
+    if more:
+      self.reactor.callLater(0, self.read, follower)
+
+  def drain(self):
+    """Removes and returns the buffered lines, along with the offsets of every
+    file read since the last drain. The offsets aren't persisted until they're
+    passed to commit.
+
+    Returns:
+      A tuple of the list of (path, line, filter result) tuples, the number of
+      lines dropped since the last drain, and a dictionary of file paths mapped
+      to their positions after the drained lines.
+    """
+
+    with self.lock:
+      lines, self.lines = self.lines, []
+      dropped, self.dropped = self.dropped, 0
+      positions, self.positions = self.positions, {}
+    return lines, dropped, positions
+
+  def commit(self, positions):
+    """Persists the file positions returned by drain, once their lines have
+    been sent.
+
+    Args:
+      positions: A dictionary of file paths mapped to their positions.
+    """
+
+    if positions:
+      save_offsets(positions)
+
+  def stop(self):
+    """Stops following the files. Lines that weren't drained and committed
+    are read again after a restart."""
+
+    if self.poller.running:
+      self.poller.stop()
+    if self.notifier is not None:
+      self.notifier.loseConnection()
+    for follower in self.followers.itervalues():
+      follower.close()
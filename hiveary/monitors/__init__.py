@@ -15,10 +15,28 @@ import datetime
 import json
 import logging
 import shlex
-import subprocess
+import threading
 import time
+import uuid
+from twisted.internet import defer, threads
 
+import hiveary.encoding
+import hiveary.external
 import hiveary.info.system
+import hiveary.logwatch
+import hiveary.patterns
+import hiveary.sketch
+import hiveary.startup
+import hiveary.structured
+import hiveary.telemetry
+import hiveary.thresholds
+import hiveary.timeseries
+
+
+class MonitorDisabled(Exception):
+  """Raised by a monitor's constructor when it isn't enabled on this host, so
+  it's skipped without an error."""
+  pass
 
 
 class BaseMonitor(object):
@@ -27,6 +45,11 @@ class BaseMonitor(object):
 
   IMPORTANCE = 5 # How "mission critical" this monitor is on a scale of 1-10
   DATA_INTERVAL = 15 # Time between data collection/send in seconds
+  MONITOR_TIMER = None  # Time between samples in seconds, when sampling faster than DATA_INTERVAL
+  MAX_DATA_POINTS = 120  # Maximum number of samples kept between sends
+  RUN_TIMEOUT = None  # Max time to wait for get_data in seconds, defaults to DATA_INTERVAL
+  ALERT_BACKOFF = 300  # Default time between repeated alerts for a source in seconds
+  LIVE_SAMPLING = True  # Whether livestreams can request faster sampling, off if get_data drains state
   NAME = 'base'
   TYPE = None
   UID = None  # Can be set to any value guaranteed to be unique, a uuid.uuid4() is recommended
@@ -51,24 +74,46 @@ class BaseMonitor(object):
 
     self.logger.info('Monitoring the following sources: %s', self.SOURCES)
 
+    self.backoff = self.ALERT_BACKOFF if backoff is None else backoff
     self.expected_values = {}
-    self.data_points = []
+    self.thresholds = hiveary.thresholds.ThresholdEngine()
+    self.last_alerts = {}  # Source mapped to the sample time of its last alert
+    self.data_points = hiveary.timeseries.TimeSeriesRing(self.MAX_DATA_POINTS)
 
     self.send_alert = None
-    self.livestreams = {}
+    self.report_sources = None  # Set by the agent, called with the monitor when it adds sources
+    self.livestreams = {}  # Routing key mapped to a function publishing a message string
+    self.host_id = None  # Set by the network controller when a livestream starts
+
+  def sources_changed(self):
+    """Lets the agent know that sources were added after the monitor started,
+    so they can be reported to the server."""
+
+    if self.report_sources is not None:
+      self.report_sources(self)
 
-  def send_data(self, net_controller, data):
+  def send_data(self, net_controller, data, encoded=None):
     """Sends the usage data points for the past time period.
 
     Args:
       net_controller: A NetworkController object with an active AMQP connection.
+      data: A dictionary of the merged data.
+      encoded: Optional, an EncodedSample holding the same values as part of
+          the data, which is reused instead of encoding them again.
     """
 
     data['host_id'] = net_controller.obj_id
     data['id'] = self.UID
 
     # Send the full data up to the server.
-    net_controller.publish_info_message(self.TYPE, json.dumps(data))
+    with hiveary.telemetry.recorder.measure(self.UID, 'send_data'):
+      if encoded is not None:
+        message = encoded.extend(data)
+      else:
+        message = json.dumps(data)
+      net_controller.publish_info_message(self.TYPE, message)
+    hiveary.telemetry.recorder.increment(self.UID, 'bytes_serialized', len(message))
+    hiveary.startup.log_first_sample(self)
 
   def run(self):
     """Wrapper call to get the data for monitored sources and check it against
@@ -76,6 +121,143 @@ class BaseMonitor(object):
 
     pass
 
+  def subsampling(self):
+    """Checks whether the monitor samples more often than it sends data.
+
+    Returns:
+      A boolean of whether MONITOR_TIMER is shorter than DATA_INTERVAL.
+    """
+
+    return (self.MONITOR_TIMER is not None and self.DATA_INTERVAL is not None
+            and self.MONITOR_TIMER < self.DATA_INTERVAL)
+
+  def sample_interval(self):
+    """Returns the time between samples, in seconds."""
+
+    return self.MONITOR_TIMER if self.subsampling() else self.DATA_INTERVAL
+
+  def record_sample(self, data):
+    """Stores a sample until the data is next sent and checks it against the
+    expected values. This must be called from the reactor thread.
+
+    Args:
+      data: A dictionary of sampled data.
+    """
+
+    self.data_points.append(data)
+    self.check_thresholds(data)
+
+  def reset_data(self):
+    """Discards the samples stored since the data was last sent."""
+
+    self.data_points.clear()
+
+  def report_interval(self):
+    """Returns the time period covered by each set of sent data, in seconds."""
+
+    return self.DATA_INTERVAL if self.subsampling() else self.sample_interval()
+
+  def merge_data(self):
+    """Aggregates the samples collected since the data was last sent. This is
+    safe to call outside of the reactor thread.
+
+    Returns:
+      A dictionary of the most recent value of every source, along with the
+      timestamp of the latest sample. When sub-sampling, 'aggregates' maps each
+      numeric source to the min, max, mean, last value and count of its samples.
+      An empty dictionary is returned if there are no samples.
+    """
+
+    merged = self.data_points.merge()
+    if not merged:
+      return {}
+    merged['interval'] = self.report_interval()
+
+    if self.subsampling():
+      merged['aggregates'] = self.data_points.window().summaries()
+
+    return merged
+
+  def set_expected_values(self, expected_values):
+    """Updates the expected values of the monitored sources, and recompiles the
+    thresholds that samples are checked against. This is safe to call outside
+    of the reactor thread.
+
+    Args:
+      expected_values: A dictionary of source names mapped to their expected
+          values, as sent by the server.
+    """
+
+    self.expected_values.update(expected_values)
+    self.thresholds.update(self.expected_values)
+
+  def check_thresholds(self, data):
+    """Checks a sample against the expected values, and fires an alert for each
+    source outside of them that hasn't alerted within the backoff time. This
+    must be called from the reactor thread.
+
+    Args:
+      data: A dictionary of sampled data.
+    Returns:
+      A list of the sources that alerts were fired for.
+    """
+
+    timestamp = data.get('timestamp') or time.time()
+    fired = []
+
+    for source, value, expected in self.thresholds.evaluate(data):
+      last_alert = self.last_alerts.get(source)
+      if last_alert is not None and timestamp - last_alert < self.backoff:
+        continue
+      self.last_alerts[source] = timestamp
+      self.fire_alert(source, value, expected, timestamp)
+      fired.append(source)
+
+    return fired
+
+  def fire_alert(self, source, value, expected, timestamp):
+    """Sends an alert for a source outside of its expected values. The extra
+    alert data is gathered in a worker thread, since it can be slow to find.
+
+    Args:
+      source: The source that is outside of its expected values.
+      value: The sampled value of the source.
+      expected: The expected values that were breached.
+      timestamp: The time the value was sampled.
+    Returns:
+      A Deferred that fires once the alert has been sent.
+    """
+
+    self.logger.info('%s is outside of its expected values %s: %s', source,
+                     expected, value)
+
+    def extra_failed(failure):
+      self.logger.error('Failed to get extra alert data for %s: %s', source,
+                        failure.getErrorMessage())
+      return None
+
+    def send(extra):
+      alert = {
+          'monitor_id': self.UID,
+          'source': source,
+          'value': value,
+          'expected': expected,
+          'sample_time': timestamp,
+          'extra': extra,
+      }
+      if self.send_alert is not None:
+        self.send_alert(alert)
+
+    deferred = threads.deferToThread(self.gather_alert_data, source)
+    deferred.addErrback(extra_failed)
+    deferred.addCallback(send)
+    return deferred
+
+  def stop(self):
+    """Releases anything held by the monitor when the agent shuts down."""
+
+    pass
+
   def get_data(self):
     """Retrieves the monitored data. This must be defined by a child class.
 
@@ -96,6 +278,18 @@ class BaseMonitor(object):
 
     pass
 
+  def gather_alert_data(self, source):
+    """Wrapper call to extra_alert_data that records how long it takes.
+
+    Args:
+      source: The source of the fired alert.
+    Returns:
+      The extra alert data.
+    """
+
+    with hiveary.telemetry.recorder.measure(self.UID, 'extra_alert_data'):
+      return self.extra_alert_data(source)
+
 
 class ExternalMonitor(BaseMonitor):
   """Class used to load an external monitor with an external data pull."""
@@ -113,24 +307,31 @@ class ExternalMonitor(BaseMonitor):
     self.get_data_command = shlex.split(kwargs.pop('get_data'))
     self.extra_data_command = shlex.split(kwargs.pop('extra_data', ''))
 
+    timeout = kwargs.pop('timeout', None)
+    self.mode = kwargs.pop('mode', 'oneshot').lower()
+    if self.mode not in ('persistent', 'oneshot'):
+      raise ValueError('Unknown external monitor mode %s' % self.mode)
+
     monitor_type = kwargs.pop('type').lower()
     sources = kwargs.pop('sources', None)
     default_type = kwargs.pop('default_type', '')
     states = kwargs.pop('states', None)
 
+    # Without configured sources, the sources are found from the first sample
+    # rather than running the command here, which would hold up startup
+    self.discovering = not sources
+
     # Monitor type specific instantiation
     if monitor_type == 'usage':
       if not sources:
         sources = {}
-        for source in self.get_data().keys():
-          sources[source] = default_type
       if sources and type(sources) is not dict:
         raise TypeError('Sources for usage monitor is not a dict')
       self.DEFAULT_TYPE = default_type
 
     elif monitor_type == 'status':
       if not sources:
-        sources = self.get_data().keys()
+        sources = []
       if sources and type(sources) is not list:
         raise TypeError('Sources for status monitor is not a list')
       if type(states) is not list:
@@ -145,13 +346,109 @@ class ExternalMonitor(BaseMonitor):
         setattr(self, key, value)
     self.logger.info('Monitoring the following sources: %s', self.SOURCES)
 
-  def get_data(self):
+    # The default timeout follows any overridden DATA_INTERVAL or RUN_TIMEOUT
+    self.command_timeout = timeout if timeout is not None else (self.RUN_TIMEOUT or self.DATA_INTERVAL)
+
+    # Persistent commands are started once and sent a request for each sample
+    if self.mode == 'persistent':
+      self.process = hiveary.external.PersistentProcess(
+          self.get_data_command, self.NAME, timeout=self.command_timeout,
+          logger=self.logger)
+    else:
+      self.process = None
+
+  def record_sample(self, data):
+    if self.discovering:
+      self.discover_sources(data)
+    super(ExternalMonitor, self).record_sample(data)
+
+  def discover_sources(self, data):
+    """Sets the monitored sources from the first sample that has any data, for
+    monitors configured without sources.
+
+    Args:
+      data: A dictionary of sampled data.
+    """
+
+    sources = [key for key in data if key not in ('timestamp', 'interval')]
+    if not sources:
+      return
+
+    self.discovering = False
+    if self.TYPE == 'usage':
+      self.SOURCES.update((source, self.DEFAULT_TYPE) for source in sources)
+    else:
+      self.SOURCES.extend(sources)
+    self.logger.info('Discovered the following sources: %s', self.SOURCES)
+    self.sources_changed()
+
+  def parse_output(self, output, command_name):
+    """Parses the JSON output of a command.
+
+    Args:
+      output: The output of the command.
+      command_name: The name of the command, such as get_data, for logging.
+    Returns:
+      The parsed dictionary, which is empty if the output was invalid.
+    """
+
     data = {}
     try:
-      proc = subprocess.Popen(self.get_data_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-      data = json.loads(proc.communicate()[0])
+      data = json.loads(output)
     except ValueError as e:
-      self.logger.warn('Failed to parse get_data output for %s monitor', self.NAME)
+      self.logger.warn('Failed to parse %s output for %s monitor', command_name, self.NAME)
+
+    if type(data) is not dict:
+      self.logger.warn('%s output was not a dictionary for %s monitor, removing data',
+                       command_name, self.NAME)
+      data = {}
+    return data
+
+  def collect(self, reactor, threadpool):
+    """Samples the monitored sources. One-shot commands are run through the
+    shared command executor, which limits how many run at once, rather than
+    tying up a worker thread.
+
+    Args:
+      reactor: A reference to the twisted reactor.
+      threadpool: The twisted ThreadPool to run a persistent command's request in.
+    Returns:
+      A Deferred that fires with the sampled data in the reactor thread.
+    """
+
+    if self.process is not None:
+      return super(ExternalMonitor, self).collect(reactor, threadpool)
+
+    data = {
+      'timestamp': time.time(),
+      'interval': self.report_interval()
+    }
+
+    def parse(output):
+      data.update(self.parse_output(output, 'get_data'))
+      return data
+
+    def failed(failure):
+      failure.trap(hiveary.external.CommandError)
+      self.logger.warn('Get data failed for %s monitor: %s', self.NAME,
+                       failure.getErrorMessage())
+      return data
+
+    deferred = hiveary.external.get_executor(reactor).run(
+        self.UID, self.UID + '.get_data', self.get_data_command, self.command_timeout)
+    deferred.addCallbacks(parse, failed)
+    return deferred
+
+  def get_data(self):
+    data = {}
+    try:
+      if self.process is not None:
+        data = self.process.request('get_data')
+      else:
+        output = hiveary.external.run_command(self.get_data_command, self.command_timeout)
+        return self.parse_output(output, 'get_data')
+    except hiveary.external.CommandError as e:
+      self.logger.warn('Get data failed for %s monitor: %s', self.NAME, e)
     except:
       self.logger.error('Get data failed for %s monitor', self.NAME, exc_info=True)
 
@@ -160,46 +457,243 @@ class ExternalMonitor(BaseMonitor):
       data = {}
     return data
 
-  def extra_alert_data(self):
+  def extra_alert_data(self, source=None):
     data = {}
-    if self.extra_data_command:
+    if self.process is not None and not self.extra_data_command:
+      # Persistent commands answer extra data requests themselves
       try:
-        proc = subprocess.Popen(self.extra_data_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        data = json.loads(proc.communicate()[0])
-      except ValueError as e:
-        self.logger.debug('Failed to parse extra_data output for %s monitor', self.NAME)
-      except:
-        self.logger.error('Extra data failed for %s monitor', self.NAME, exc_info=True)
+        data = self.process.request('extra_data', source=source)
+      except hiveary.external.CommandError as e:
+        self.logger.debug('Extra data failed for %s monitor: %s', self.NAME, e)
       if type(data) is not dict:
-        self.logger.warn('Get extra alert data output was not a dictionary for %s monitor, removing data', self.NAME)
         data = {}
+    elif self.extra_data_command:
+      # Alerts for several sources at once share a single run of the command
+      executor = hiveary.external.get_executor()
+      cache_key = self.UID + '.extra_data'
+      output = executor.cached_output(cache_key, self.DATA_INTERVAL)
+      try:
+        if output is None:
+          output = hiveary.external.run_command(self.extra_data_command, self.command_timeout)
+          executor.store_output(cache_key, output)
+      except hiveary.external.CommandError as e:
+        self.logger.debug('Extra data failed for %s monitor: %s', self.NAME, e)
+      except:
+        self.logger.error('Extra data failed for %s monitor', self.NAME, exc_info=True)
+      else:
+        data = self.parse_output(output, 'extra_data')
     return data
 
+  def stop(self):
+    if self.process is not None:
+      self.process.stop()
+
 
 class PollingMixin(object):
   """Mixin class for monitors that expect to regularly poll their data sources
   for new data."""
 
+  ADAPTIVE = False  # Whether to adjust the sample interval to how volatile the data is
+  MIN_INTERVAL = None  # Shortest adaptive interval in seconds, defaults to a quarter of the normal one
+  MAX_INTERVAL = None  # Longest adaptive interval in seconds, see max_interval
+  CHANGE_THRESHOLD = 0.25  # Relative change between samples that counts as volatile
+  VARIANCE_THRESHOLD = 0.15  # Coefficient of variation of recent samples that counts as volatile
+  ADAPTIVE_WINDOW = 5  # Number of recent samples considered
+  VOLATILE_SAMPLES = 2  # Consecutive volatile samples needed before sampling faster
+  # Smallest scale changes are measured against for each source type, so that
+  # noise around low values, such as an idle CPU, doesn't count as volatile
+  VOLATILITY_FLOORS = {'percent': 10.0, 'bytes': 1024 * 1024}
+
+  def __init__(self, *args, **kwargs):
+    super(PollingMixin, self).__init__(*args, **kwargs)
+    self.adaptive_interval = None
+    self.recent_samples = collections.deque(maxlen=self.ADAPTIVE_WINDOW)
+    self.volatile_samples = 0
+
+  def sample_interval(self):
+    """Returns the time between samples, in seconds, including any adaptive
+    adjustment."""
+
+    return self.adaptive_interval or super(PollingMixin, self).sample_interval()
+
+  def min_interval(self):
+    """Returns the shortest adaptive interval, in seconds."""
+
+    if self.MIN_INTERVAL is not None:
+      return self.MIN_INTERVAL
+    return max(1, super(PollingMixin, self).sample_interval() / 4.0)
+
+  def max_interval(self):
+    """Returns the longest adaptive interval, in seconds. When sub-sampling,
+    this defaults to half of DATA_INTERVAL so every send still has samples."""
+
+    if self.MAX_INTERVAL is not None:
+      return self.MAX_INTERVAL
+    if self.subsampling():
+      return self.DATA_INTERVAL / 2.0
+    return self.DATA_INTERVAL * 4
+
+  def volatile(self):
+    """Checks whether the recent samples changed enough to sample faster. A
+    source is volatile when its last change, or the standard deviation of its
+    recent values, is large relative to its mean, or to the floor of its type
+    in VOLATILITY_FLOORS if that's larger.
+
+    Returns:
+      A boolean of whether any source is volatile.
+    """
+
+    sources = set()
+    for values in self.recent_samples:
+      sources.update(values)
+    source_types = self.SOURCES if isinstance(self.SOURCES, dict) else {}
+
+    for source in sources:
+      values = [sample[source] for sample in self.recent_samples if source in sample]
+      if len(values) < 2:
+        continue
+      mean = sum(values) / len(values)
+      # Floored so that sources idling around low values don't look volatile
+      scale = max(abs(mean), self.VOLATILITY_FLOORS.get(source_types.get(source), 1.0))
+      if abs(values[-1] - values[-2]) > self.CHANGE_THRESHOLD * scale:
+        return True
+      variance = sum((value - mean) ** 2 for value in values) / len(values)
+      if variance ** 0.5 > self.VARIANCE_THRESHOLD * scale:
+        return True
+
+    return False
+
+  def adapt_interval(self, data):
+    """Adjusts the sample interval after a sample. The interval is halved
+    once VOLATILE_SAMPLES samples in a row are volatile, and grows by half once
+    a full window of samples is stable, within min_interval and max_interval.
+
+    Args:
+      data: A dictionary of sampled data.
+    Returns:
+      The new sample interval in seconds, or None if it hasn't changed.
+    """
+
+    if not self.ADAPTIVE:
+      return None
+
+    self.recent_samples.append(dict(
+        (source, value) for source, value in data.iteritems()
+        if source not in ('timestamp', 'interval')
+        and isinstance(value, (int, long, float)) and not isinstance(value, bool)))
+
+    current = self.sample_interval()
+    if self.volatile():
+      # A single spike isn't enough to sample faster
+      self.volatile_samples += 1
+      if self.volatile_samples < self.VOLATILE_SAMPLES:
+        return None
+      self.volatile_samples = 0
+      interval = current / 2.0
+    else:
+      self.volatile_samples = 0
+      if len(self.recent_samples) < self.recent_samples.maxlen:
+        return None
+      interval = current * 1.5
+      # Require a new full window of stable samples before growing again
+      self.recent_samples.clear()
+
+    # Whole seconds keep the samples aligned with other monitors' ticks
+    interval = min(max(round(interval), self.min_interval()), self.max_interval())
+    if interval == current:
+      return None
+
+    self.adaptive_interval = interval
+    return interval
+
   def run(self, net_controller):
     """Wrapper call to get the data for monitored sources and check it against
     any set alert values."""
 
+    with hiveary.telemetry.recorder.measure(self.UID, 'run'):
+      self.publish(net_controller, self.sample())
+
+  def sample(self):
+    """Gets the data for the monitored sources along with the sample time. This
+    is safe to call outside of the reactor thread.
+
+    Returns:
+      A dictionary of the sampled data.
+    """
+
     data = {
       'timestamp': time.time(),
-      'interval': self.DATA_INTERVAL
+      'interval': self.report_interval()
     }
-    data.update(self.get_data())
-    self.send_data(net_controller, data)
+    with hiveary.telemetry.recorder.measure(self.UID, 'get_data'):
+      data.update(self.get_data())
+    return data
+
+  def collect(self, reactor, threadpool):
+    """Samples the monitored sources using a worker thread, so that a slow
+    get_data doesn't block the reactor.
+
+    Args:
+      reactor: A reference to the twisted reactor.
+      threadpool: The twisted ThreadPool to run the sample in.
+    Returns:
+      A Deferred that fires with the sampled data in the reactor thread.
+    """
+
+    return threads.deferToThreadPool(reactor, threadpool, self.sample)
 
-    # Send a copy of the data to any waiting real-time data streams
+  def add_sample(self, data, encoded=None):
+    """Stores a sample until the data is next sent, and forwards it to any
+    real-time data streams. This must be called from the reactor thread.
+
+    Args:
+      data: A dictionary of sampled data.
+      encoded: Optional, an EncodedSample of the data to reuse.
+    """
+
+    self.record_sample(data)
+
+    # Send a copy of the data to any waiting real-time data streams. The frame
+    # is encoded once and the same string is published to every stream.
     if self.livestreams:
-      data.pop('extra', None)
-      data_container = {
+      if encoded is None:
+        encoded = hiveary.encoding.EncodedSample(data)
+      frame = encoded.wrap('data', {
           'monitor_id': self.UID,
-          'data': data,
-      }
-      for publish in self.livestreams.itervalues():
-        publish(data_container)
+          'host_id': self.host_id,
+          'timestamp': time.time(),
+      })
+      for publish in self.livestreams.values():
+        publish(frame)
+
+  def flush(self, net_controller, encoded=None):
+    """Sends the samples collected since the last send to the server. This
+    must be called from the reactor thread.
+
+    Args:
+      net_controller: A NetworkController object with an active AMQP connection.
+      encoded: Optional, an EncodedSample of the only stored sample to reuse.
+    """
+
+    data = self.merge_data()
+    self.reset_data()
+    if data:
+      self.send_data(net_controller, data, encoded)
+
+  def publish(self, net_controller, data):
+    """Stores a sample and sends it to the server straight away. The sample is
+    encoded once, for both the send and any real-time data streams. This must
+    be called from the reactor thread.
+
+    Args:
+      net_controller: A NetworkController object with an active AMQP connection.
+      data: A dictionary of sampled data.
+    """
+
+    encoded = hiveary.encoding.EncodedSample(data)
+    self.add_sample(data, encoded)
+    # The merged data only matches the sample when it's the only one stored
+    self.flush(net_controller, encoded if len(self.data_points) == 1 else None)
 
 
 class ProcessMixin(object):
@@ -214,12 +708,287 @@ class UsageMonitor(BaseMonitor):
   TYPE = 'usage'
   SOURCES = {}
   DEFAULT_TYPE = None
+  SKETCH_SOURCES = ()  # Sources to report quantiles for
+  SKETCH_TYPES = ()  # Source types, such as 'percent', to report quantiles for
+  SKETCH_ACCURACY = 0.01  # Relative accuracy of the reported quantiles
+  QUANTILES = (0.5, 0.95, 0.99)
+
+  def __init__(self, *args, **kwargs):
+    super(UsageMonitor, self).__init__(*args, **kwargs)
+    self.sketch_lock = threading.Lock()
+    self.sketches = {}
+
+  def sketched(self, source):
+    """Checks whether quantiles are reported for a source.
+
+    Args:
+      source: The name of the source.
+    Returns:
+      A boolean of whether the source is in SKETCH_SOURCES, or its type is in
+      SKETCH_TYPES.
+    """
+
+    if source in self.SKETCH_SOURCES:
+      return True
+    return bool(self.SKETCH_TYPES) and (self.SOURCES or {}).get(source) in self.SKETCH_TYPES
+
+  def record_sample(self, data):
+    """Stores a sample, adding the values of sketched sources to their
+    quantile sketches.
+
+    Args:
+      data: A dictionary of sampled data.
+    """
+
+    super(UsageMonitor, self).record_sample(data)
+
+    if not (self.SKETCH_SOURCES or self.SKETCH_TYPES):
+      return
+    with self.sketch_lock:
+      for source, value in data.iteritems():
+        if (isinstance(value, (int, long, float)) and not isinstance(value, bool)
+            and self.sketched(source)):
+          sketch = self.sketches.get(source)
+          if sketch is None:
+            sketch = self.sketches[source] = hiveary.sketch.QuantileSketch(self.SKETCH_ACCURACY)
+          sketch.add(value)
+
+  def reset_data(self):
+    """Discards the stored samples and quantile sketches."""
+
+    super(UsageMonitor, self).reset_data()
+    with self.sketch_lock:
+      self.sketches = {}
+
+  def merge_data(self):
+    """Aggregates the samples collected since the data was last sent.
+
+    Returns:
+      The merged data as returned by BaseMonitor.merge_data. For sketched
+      sources, 'quantiles' maps each source to its estimated percentiles, and
+      'sketches' maps each source to its serialized QuantileSketch so the
+      server can merge them across intervals and hosts. These are left out
+      when there's only one sample, as they'd only repeat its values.
+    """
+
+    merged = super(UsageMonitor, self).merge_data()
+    with self.sketch_lock:
+      if merged and self.sketches and len(self.data_points) > 1:
+        merged['quantiles'] = dict((source, sketch.quantiles(self.QUANTILES))
+                                   for source, sketch in self.sketches.iteritems())
+        merged['sketches'] = dict((source, sketch.to_dict())
+                                  for source, sketch in self.sketches.iteritems())
+    return merged
 
 
 class LogMonitor(BaseMonitor):
-  """Base class for all "log" type monitors."""
+  """Base class for all "log" type monitors. Follows a set of log files as
+  they're written to, and sends the new lines matching any of the patterns
+  each interval. External log monitors set the files and patterns through
+  keyword arguments."""
 
   TYPE = 'log'
+  FILES = []
+  PATTERNS = []  # Regexes of the lines to send, optionally keyed by name, every line is sent if empty
+  MAX_LINES = 1000  # Most lines sent each interval, any more are counted as dropped
+  LIVE_SAMPLING = False
+  FIELDS = {}  # Structured log fields to aggregate, mapped to 'histogram' or 'counter'
+  FORMAT = 'auto'  # Format of structured lines, 'json', 'logfmt' or 'auto'
+
+  def __init__(self, *args, **kwargs):
+    self.UID = kwargs.pop('uid', self.UID)
+    self.NAME = kwargs.pop('name', self.NAME)
+    self.FILES = kwargs.pop('files', self.FILES)
+    self.PATTERNS = kwargs.pop('patterns', self.PATTERNS)
+    self.FIELDS = kwargs.pop('fields', self.FIELDS)
+    self.FORMAT = kwargs.pop('format', self.FORMAT)
+    kwargs.pop('type', None)
+
+    # Load in any other overrides provided
+    for key in kwargs.keys():
+      if key not in ('backoff', 'logger'):
+        value = kwargs.pop(key)
+        if hasattr(self, key):
+          setattr(self, key, value)
+
+    self.SOURCES = list(self.FILES)
+    super(LogMonitor, self).__init__(*args, **kwargs)
+
+    self.patterns = hiveary.patterns.PatternSet(self.PATTERNS) if self.PATTERNS else None
+    self.extractor = None
+    if self.FIELDS:
+      self.extractor = hiveary.structured.FieldExtractor(self.FIELDS, self.FORMAT)
+    self.watcher = hiveary.logwatch.LogWatcher(
+        self.FILES, self.patterns.match if self.patterns else None, self.MAX_LINES,
+        line_observer=self.extractor.add_lines if self.extractor else None)
+    # File positions after the lines drained but not yet sent, persisted
+    # once they have been
+    self.unsent_positions = {}
+    self.positions_lock = threading.Lock()
+
+  def get_data(self):
+    """Collects the matching lines written since the last call.
+
+    Returns:
+      A dictionary with 'lines', mapping each file to its new lines, 'matches',
+      mapping each pattern to the number of lines it matched, and 'dropped',
+      the number of lines that were over MAX_LINES.
+    """
+
+    lines, dropped, positions = self.watcher.drain()
+    with self.positions_lock:
+      self.unsent_positions.update(positions)
+    files = {}
+    matches = {}
+    for path, line, matched in lines:
+      files.setdefault(path, []).append(line)
+      for pattern in matched or ():
+        matches[pattern] = matches.get(pattern, 0) + 1
+    return {'lines': files, 'matches': matches, 'dropped': dropped}
+
+  def send_data(self, net_controller, data, encoded=None):
+    """Sends the lines collected since the last send, then persists the file
+    positions after them, so that lines which were never sent are read again
+    after a restart."""
+
+    with self.positions_lock:
+      positions, self.unsent_positions = self.unsent_positions, {}
+    super(LogMonitor, self).send_data(net_controller, data, encoded)
+    self.watcher.commit(positions)
+
+  def stop(self):
+    self.watcher.stop()
+
+
+class LogRateMonitor(PollingMixin, UsageMonitor):
+  """Reports how fast the files of a LogMonitor are written to, as usage
+  sources for each file: <file>.lines and <file>.bytes per second, and a
+  <file>.<severity> rate of matches per second for each severity, where a line
+  with markers of several severities is a match for each of them. These come
+  from the counters kept by the log followers, so no lines are buffered and
+  the rates can be alerted on like any other usage source."""
+
+  RATE_TYPES = {'lines': 'per_second', 'bytes': 'bytes'}
+
+  def __init__(self, log_monitor, *args, **kwargs):
+    """Initialize the monitor.
+
+    Args:
+      log_monitor: The LogMonitor whose files to report on.
+    """
+
+    self.log_monitor = log_monitor
+    self.UID = str(uuid.uuid5(uuid.NAMESPACE_URL, 'hiveary:%s/rates' % log_monitor.UID))
+    self.NAME = '%s_rates' % log_monitor.NAME
+    self.DATA_INTERVAL = log_monitor.DATA_INTERVAL
+    self.MONITOR_TIMER = log_monitor.MONITOR_TIMER
+
+    self.SOURCES = {}
+    for path in log_monitor.watcher.followers:
+      for name, source_type in self.RATE_TYPES.iteritems():
+        self.SOURCES['%s.%s' % (path, name)] = source_type
+      for severity in set(hiveary.logwatch.SEVERITIES.itervalues()):
+        self.SOURCES['%s.%s' % (path, severity)] = 'per_second'
+
+    super(LogRateMonitor, self).__init__(*args, **kwargs)
+
+    self.last_counts = self.counts()
+    self.last_time = time.time()
+
+  def counts(self):
+    """Returns the current totals of every file, as a dictionary of source
+    names mapped to counts."""
+
+    counts = {}
+    for path, follower in self.log_monitor.watcher.followers.iteritems():
+      counts['%s.lines' % path] = follower.lines_read
+      counts['%s.bytes' % path] = follower.bytes_read
+      for severity, count in follower.severities.items():
+        counts['%s.%s' % (path, severity)] = count
+    return counts
+
+  def get_data(self):
+    """Returns the rate of each source since the last call, per second."""
+
+    now = time.time()
+    counts = self.counts()
+    elapsed = max(now - self.last_time, 0.001)
+
+    data = dict((source, (count - self.last_counts.get(source, 0)) / elapsed)
+                for source, count in counts.iteritems())
+    self.last_counts = counts
+    self.last_time = now
+    return data
+
+
+class LogFieldMonitor(PollingMixin, UsageMonitor):
+  """Reports the structured fields aggregated from the lines of a LogMonitor
+  with FIELDS set, as usage sources such as latency_ms.p95 or status.500.
+  Sources are added as field values are first seen."""
+
+  SOURCE_TYPES = {'.count': 'count', '.mean': 'value', '.min': 'value', '.max': 'value',
+                  '.p50': 'value', '.p95': 'value', '.p99': 'value'}
+  LIVE_SAMPLING = False
+
+  def __init__(self, log_monitor, *args, **kwargs):
+    """Initialize the monitor.
+
+    Args:
+      log_monitor: The LogMonitor whose fields to report, which must have an
+          extractor.
+    """
+
+    self.extractor = log_monitor.extractor
+    self.UID = str(uuid.uuid5(uuid.NAMESPACE_URL, 'hiveary:%s/fields' % log_monitor.UID))
+    self.NAME = '%s_fields' % log_monitor.NAME
+    self.DATA_INTERVAL = log_monitor.DATA_INTERVAL
+    self.MONITOR_TIMER = log_monitor.MONITOR_TIMER
+    self.SOURCES = {}
+
+    super(LogFieldMonitor, self).__init__(*args, **kwargs)
+
+  def collect(self, reactor, threadpool):
+    """Samples the aggregated fields. Lines are added to the extractor from
+    the reactor thread, so it's flushed from there as well instead of from a
+    worker thread.
+
+    Args:
+      reactor: A reference to the twisted reactor.
+      threadpool: Unused.
+    Returns:
+      A Deferred that has already fired with the sampled data.
+    """
+
+    return defer.maybeDeferred(self.sample)
+
+  def get_data(self):
+    """Flushes the fields aggregated since the last call, adding any sources
+    seen for the first time."""
+
+    data = self.extractor.flush()
+    added = False
+    for source in data:
+      if source not in self.SOURCES:
+        self.SOURCES[source] = self.source_type(source)
+        added = True
+    if added:
+      self.sources_changed()
+    return data
+
+  def source_type(self, source):
+    """Finds the type of a newly seen source.
+
+    Args:
+      source: The name of the source.
+    Returns:
+      The type of the source, 'per_second' for the values of counter fields.
+    """
+
+    for suffix, source_type in self.SOURCE_TYPES.iteritems():
+      if (source.endswith(suffix)
+          and self.extractor.fields.get(source[:-len(suffix)]) == hiveary.structured.HISTOGRAM):
+        return source_type
+    return 'per_second'
 
 
 class StatusMonitor(BaseMonitor):
@@ -7,6 +7,7 @@ Licensed under Simplified BSD License (see LICENSE)
 (C) Hiveary, Inc. 2013-2014 all rights reserved
 """
 
+import collections
 import datetime
 import json
 import kombu
@@ -21,6 +22,7 @@ import socket
 from ssl import CERT_REQUIRED, CERT_NONE
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import urllib2
@@ -33,7 +35,9 @@ if subprocess.mswindows:
 # Local imports
 from . import oauth_client
 from . import paths
+from . import ratelimit
 import hiveary.info.system
+import hiveary.telemetry
 
 
 class NetworkController(object):
@@ -42,6 +46,14 @@ class NetworkController(object):
   PING_TIMER = 120  # How often to ping the server, in seconds
   MAX_BACKOFF_MULTIPLE = 10
 
+  # Limits of livestream and bulk publishes, in bytes. Everything else, such as
+  # monitor data and alerts, is never held back.
+  PUBLISH_RATE = 256 * 1024  # Per second across all routing keys
+  PUBLISH_BURST = 1024 * 1024
+  KEY_PUBLISH_RATE = 64 * 1024  # Per second for each routing key
+  KEY_PUBLISH_BURST = 256 * 1024
+  MAX_QUEUED = 100  # Most bulk messages waiting for the limits, the oldest are dropped past this
+
   def __init__(self, reactor=None, logger=None):
     """Initialze the controller.
 
@@ -75,6 +87,17 @@ class NetworkController(object):
     self.reactor = reactor
 
     self.monitors = {}
+    self.live_sampler = None  # Set by the agent once monitors are scheduled
+
+    # Rate limiting of livestream frames and bulk messages. Livestream frames
+    # over the limits wait for room, and are replaced by any newer frame for
+    # the same stream in the meantime. Bulk messages wait in order.
+    self.limiter = ratelimit.RateLimiter(self.PUBLISH_RATE, self.PUBLISH_BURST,
+                                         self.KEY_PUBLISH_RATE, self.KEY_PUBLISH_BURST)
+    self.limit_lock = threading.Lock()
+    self.pending_frames = collections.OrderedDict()  # Routing key mapped to (message, exchange)
+    self.queued = collections.deque()  # (routing key, message, exchange, time queued) tuples
+    self.flush_timer = None
 
   def ensure_internet_connection(self, test_url='http://google.com'):
     """Blocks until there is an active connection to the public internet.
@@ -308,11 +331,7 @@ class NetworkController(object):
     if not exchange_name:
       exchange_name = 'agent.{user}'.format(user=self.user_id)
 
-    # Check the message format and add the host ID
-    if type(message) == dict:
-      message['host_id'] = self.obj_id
-      message['timestamp'] = time.time()
-      message = json.dumps(message)
+    message = self.encode_message(message)
 
     exchange = kombu.Exchange(exchange_name)
     with self.amqp.Producer(exchange=exchange, routing_key=routing_key,
@@ -329,6 +348,102 @@ class NetworkController(object):
         if retry:
           self.publish_info_message(routing_key, message, retry, exchange_name)
 
+  def encode_message(self, message):
+    """Encodes a dict message as JSON, adding the host ID and timestamp.
+    Messages that are already strings are returned as they are."""
+
+    if type(message) == dict:
+      message['host_id'] = self.obj_id
+      message['timestamp'] = time.time()
+      message = json.dumps(message)
+    return message
+
+  def publish_limited(self, routing_key, message, exchange_name=None,
+                      coalesce=False):
+    """Publishes a message within the rate limits of its routing key and of
+    the agent as a whole. This is safe to call from any thread.
+
+    Args:
+      routing_key: The AMQP routing key.
+      message: The message to publish, as a string or dict.
+      exchange_name: An optional AMQP exchange name to use.
+      coalesce: Whether the message replaces any earlier message for the same
+          routing key that is still waiting, as for livestream frames, rather
+          than being queued after it.
+    """
+
+    message = self.encode_message(message)
+    recorder = hiveary.telemetry.recorder
+
+    with self.limit_lock:
+      if coalesce:
+        if routing_key in self.pending_frames:
+          # The waiting frame is out of date, this one is sent in its place
+          recorder.increment('network', 'frames_coalesced')
+          send = False
+        else:
+          send = not self.limiter.acquire(routing_key, len(message))
+          if not send:
+            recorder.increment('network', 'frames_delayed')
+        if not send:
+          self.pending_frames[routing_key] = (message, exchange_name)
+      else:
+        send = not self.queued and not self.limiter.acquire(routing_key, len(message))
+        if not send:
+          if len(self.queued) >= self.MAX_QUEUED:
+            self.queued.popleft()
+            recorder.increment('network', 'bulk_dropped')
+          self.queued.append((routing_key, message, exchange_name, time.time()))
+          recorder.increment('network', 'bulk_queued')
+
+    if send:
+      self.publish_info_message(routing_key, message, exchange_name=exchange_name)
+    else:
+      self.reactor.callFromThread(self.schedule_flush)
+
+  def schedule_flush(self, delay=0):
+    """Makes sure the waiting messages are flushed after a delay, in seconds.
+    This must be called from the reactor thread."""
+
+    if self.flush_timer is not None and self.flush_timer.active():
+      if self.flush_timer.getTime() <= self.reactor.seconds() + delay:
+        return
+      self.flush_timer.cancel()
+    self.flush_timer = self.reactor.callLater(delay, self.flush_limited)
+
+  def flush_limited(self):
+    """Publishes the waiting messages that are within the rate limits, and
+    schedules another flush for the rest."""
+
+    self.flush_timer = None
+    recorder = hiveary.telemetry.recorder
+    ready = []
+    delays = []
+
+    with self.limit_lock:
+      while self.queued:
+        routing_key, message, exchange_name, queued_at = self.queued[0]
+        delay = self.limiter.acquire(routing_key, len(message))
+        if delay:
+          delays.append(delay)
+          break
+        self.queued.popleft()
+        recorder.record('network', 'bulk_delay', time.time() - queued_at)
+        ready.append((routing_key, message, exchange_name))
+
+      for routing_key, (message, exchange_name) in self.pending_frames.items():
+        delay = self.limiter.acquire(routing_key, len(message))
+        if delay:
+          delays.append(delay)
+        else:
+          del self.pending_frames[routing_key]
+          ready.append((routing_key, message, exchange_name))
+
+    for routing_key, message, exchange_name in ready:
+      self.publish_info_message(routing_key, message, exchange_name=exchange_name)
+    if delays:
+      self.schedule_flush(min(delays))
+
   def amqp_errback(self, exc, interval):
     """Error callback fired when there is a problem with the connection or channel.
 
@@ -365,6 +480,68 @@ class NetworkController(object):
     else:
       self.run_task(data)
 
+  def start_livestream(self, monitor, stream_routing_key, command):
+    """Starts sending a copy of a monitor's data to a real-time AMQP queue.
+    This must be called from the reactor thread.
+
+    Args:
+      monitor: The monitor to stream.
+      stream_routing_key: The routing key of the stream's queue.
+      command: The live_data task command, with the optional sample_rate and
+          ttl of faster sampling while the stream is open.
+    """
+
+    # Add a new livestream callback, which is given each frame already
+    # encoded, so the same string can be published to every stream
+    exchange_name = 'agent.{user}.reports'.format(user=self.user_id)
+    live_publish = lambda message: self.publish_limited(stream_routing_key,
+                                                        message,
+                                                        exchange_name=exchange_name,
+                                                        coalesce=True)
+
+    # The stream can ask for the monitor to be sampled faster while it's
+    # open, for a limited time
+    interval = None
+    sample_rate = command.get('sample_rate')
+    if sample_rate and self.live_sampler is not None:
+      interval = self.live_sampler.start(monitor, stream_routing_key, sample_rate,
+                                         command.get('ttl'))
+
+    # Send a copy of any data that has been aggregated so far
+    frame = monitor.merge_data()
+    frame.pop('timestamp', None)
+    data_container = {
+        'data': frame,
+        'monitor_id': monitor.UID,
+        'interval': interval or monitor.sample_interval(),
+    }
+    self.logger.debug('Sending inititial data: %s', data_container)
+    live_publish(data_container)
+
+    # Store the lambda on the monitor so all future data will get published
+    monitor.host_id = self.obj_id
+    monitor.livestreams[stream_routing_key] = live_publish
+
+  def stop_livestream(self, monitor, stream_routing_key):
+    """Stops a real-time data stream started by start_livestream. This must be
+    called from the reactor thread.
+
+    Args:
+      monitor: The streamed monitor.
+      stream_routing_key: The routing key of the stream's queue.
+    """
+
+    self.logger.info('Stopping livestream for %s...', monitor.UID)
+    if stream_routing_key not in monitor.livestreams:
+      self.logger.info('Livestream for monitor %s was not enabled, skipping',
+                       monitor.UID)
+      return
+
+    del(monitor.livestreams[stream_routing_key])
+    if self.live_sampler is not None:
+      self.live_sampler.stop(monitor, stream_routing_key)
+    self.logger.info('Livestream stopped')
+
   def run_task(self, client_task):
     """Run a task as commanded by the control server.
 
@@ -422,7 +599,7 @@ class NetworkController(object):
                        monitor_id, expected_values)
 
       if monitor_id in self.monitors:
-        self.monitors[monitor_id].expected_values.update(expected_values)
+        self.monitors[monitor_id].set_expected_values(expected_values)
       else:
         self.logger.warn('Monitor "%s" is not enabled!', monitor_id)
     elif task_name == 'live_data':
@@ -434,38 +611,15 @@ class NetworkController(object):
       self.logger.info('Received request to %s sending real-time data for %s',
                        action, monitor_id)
 
+      # The streams and the scheduler are only touched from the reactor thread,
+      # and tasks are run from the AMQP thread
       if monitor_id in self.monitors:
+        monitor = self.monitors[monitor_id]
         if action == 'start':
-          # Add a new livestream callback
-          exchange_name = 'agent.{user}.reports'.format(user=self.user_id)
-          live_publish = lambda data: self.publish_info_message(stream_routing_key,
-                                                                data,
-                                                                exchange_name=exchange_name)
-
-          # Send a copy of any data that has been aggregated so far
-          data = self.monitors[monitor_id].merge_data()
-          data.pop('timestamp', None)
-          data_container = {
-              'data': data,
-              'monitor_id': monitor_id,
-              'interval': self.monitors[monitor_id].MONITOR_TIMER,
-          }
-          self.logger.debug('Sending inititial data: %s', data_container)
-          live_publish(data_container)
-
-          # Store the lambda on the monitor so all future data will get published
-          self.monitors[monitor_id].livestreams[stream_routing_key] = live_publish
+          self.reactor.callFromThread(self.start_livestream, monitor,
+                                      stream_routing_key, client_task['command'])
         elif action == 'stop':
-          # Delete the previously setup stream
-          self.logger.info('Stopping livestream for %s...', monitor_id)
-          if monitor_id not in self.monitors:
-            self.logger.warn('Monitor %s has not been started', monitor_id)
-          elif stream_routing_key not in self.monitors[monitor_id].livestreams:
-            self.logger.info('Livestream for monitor %s was not enabled, skipping',
-                             monitor_id)
-          else:
-            del(self.monitors[monitor_id].livestreams[stream_routing_key])
-            self.logger.info('Livestream stopped')
+          self.reactor.callFromThread(self.stop_livestream, monitor, stream_routing_key)
       else:
         self.logger.warn('Monitor "%s" is not enabled!', monitor_id)
     elif task_name == 'update':
@@ -481,6 +635,9 @@ class NetworkController(object):
       self.logger.error('Unable to perform requested task')
       data['status'] = 'NOT_IMPLEMENTED'
 
-    if data['id'] is not None or routing_key != 'task_complete':
+    if task_name == 'refresh':
+      # Inventory responses can be large, so they're kept within the limits
+      self.publish_limited(routing_key, json.dumps(data))
+    elif data['id'] is not None or routing_key != 'task_complete':
       self.publish_info_message(routing_key, json.dumps(data))
       self.logger.info('Sent task completion to server')
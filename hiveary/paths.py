@@ -19,6 +19,7 @@ if subprocess.mswindows:
 
 
 CSIDL_COMMON_APPDATA = 35   # Used for finding the path to the config file in Windows
+DEFAULT_PID_FILE = '/var/run/hiveary-agent.pid'
 
 
 def get_common_appdata_path():
@@ -59,6 +60,31 @@ def get_program_path():
   return os.path.abspath(resource_dir)
 
 
+def get_pid_file(config_filename, pid_file=None):
+  """Determines where the agent's PID file is kept. If the directory of the
+  PID file doesn't exist, the file is kept next to the config file instead.
+
+  Args:
+    config_filename: The full path to the config file.
+    pid_file: The configured PID file, if any.
+  Returns:
+    A string of the path to the PID file.
+  """
+
+  pid_file = pid_file or DEFAULT_PID_FILE
+  if not os.path.isdir(os.path.dirname(pid_file)):
+    pid_file = os.path.join(os.path.dirname(config_filename),
+                            os.path.basename(pid_file))
+  return pid_file
+
+
+def get_telemetry_file(pid_file):
+  """Returns the path to the telemetry stored by the running agent, which is
+  kept next to its PID file so it can be dumped from the command line."""
+
+  return os.path.splitext(pid_file)[0] + '.telemetry'
+
+
 def find_executable():
   """Determines the absolute path to the current process's executable and args.
 
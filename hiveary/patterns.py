@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Matching of log lines against many patterns at once.
+"""
+
+import logging
+import os
+import re
+import sre_constants
+import sre_parse
+
+MIN_LITERAL_LENGTH = 3  # Shorter required substrings aren't worth checking for
+MIN_PREFIX_LENGTH = 8  # Literals sharing a prefix this long are checked as the prefix
+MAX_COMBINED = 256  # Most combined regexes cached, one per set of candidate rules
+
+logger = logging.getLogger('hiveary_agent.patterns')
+
+
+def required_literals(parsed):
+  """Finds substrings that every match of a parsed regex must contain.
+
+  Args:
+    parsed: The output of sre_parse.parse, or a part of it.
+  Returns:
+    A list of unicode strings.
+  """
+
+  literals = []
+  run = []
+
+  def flush():
+    if run:
+      literals.append(u''.join(run))
+      del run[:]
+
+  for op, value in parsed:
+    if op == sre_constants.LITERAL:
+      run.append(unichr(value))
+      continue
+
+    flush()
+    if op == sre_constants.SUBPATTERN:
+      literals.extend(required_literals(value[-1]))
+    elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and value[0] >= 1:
+      # The repeated item has to appear at least once
+      literals.extend(required_literals(value[2]))
+  flush()
+
+  return literals
+
+
+def reduce_literals(literals):
+  """Reduces a set of literals to fewer that are still present in every line
+  containing any of the originals. Literals containing another literal are
+  dropped, and literals with a long common prefix are replaced by the prefix.
+
+  Args:
+    literals: An iterable of strings.
+  Returns:
+    A list of strings.
+  """
+
+  kept = []
+  for literal in sorted(set(literals), key=len):
+    if not any(shorter in literal for shorter in kept):
+      kept.append(literal)
+
+  reduced = []
+  for literal in sorted(kept):
+    if reduced:
+      prefix = os.path.commonprefix([reduced[-1], literal])
+      if len(prefix) >= MIN_PREFIX_LENGTH:
+        reduced[-1] = prefix
+        continue
+    reduced.append(literal)
+  return reduced
+
+
+class Rule(object):
+  """A single named pattern along with its prefilter."""
+
+  def __init__(self, name, pattern, flags=0):
+    """Initialize the rule.
+
+    Args:
+      name: The name of the rule.
+      pattern: The regex of the rule, as a string.
+      flags: Any re flags to compile the regex with.
+    Raises:
+      re.error: The pattern isn't a valid regex.
+    """
+
+    self.name = name
+    self.pattern = pattern
+    self.regex = re.compile(pattern, flags)
+
+    parsed = sre_parse.parse(pattern, flags)
+    self.ignore_case = bool(parsed.pattern.flags & re.IGNORECASE)
+
+    literals = [literal for literal in required_literals(parsed)
+                if len(literal) >= MIN_LITERAL_LENGTH]
+    self.literal = max(literals, key=len) if literals else None
+    if self.literal is not None and self.ignore_case:
+      self.literal = self.literal.lower()
+
+    # Patterns that rely on group names, backreferences or inline flags can't be
+    # combined with others, since the combined regex shares them
+    self.combinable = (not self.regex.groupindex and parsed.pattern.flags == flags
+                       and not _uses_backreferences(parsed))
+
+
+def _uses_backreferences(parsed):
+  """Checks whether a parsed regex, or a part of it, refers back to a group."""
+
+  for item in parsed:
+    if not isinstance(item, tuple) or len(item) != 2:
+      continue
+    op, value = item
+    if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+      return True
+    values = value if isinstance(value, (list, tuple)) else [value]
+    for part in values:
+      if isinstance(part, sre_parse.SubPattern):
+        if _uses_backreferences(part):
+          return True
+      elif isinstance(part, list):
+        # The alternatives of a branch
+        for alternative in part:
+          if isinstance(alternative, sre_parse.SubPattern) and _uses_backreferences(alternative):
+            return True
+  return False
+
+
+class PatternSet(object):
+  """Matches lines against a set of rules in a single pass. Each rule has a
+  required substring extracted from its regex, and lines containing none of
+  them are rejected with cheap substring checks. The remaining lines are
+  tested once against a combined regex of the rules that could match, made of
+  an optional lookahead per rule with a named group, so the groups that took
+  part show every rule that matched. Combined regexes are cached by the set of
+  rules they cover.
+
+  This isn't thread-safe, each thread should use its own PatternSet."""
+
+  def __init__(self, patterns, flags=0):
+    """Initialize the set.
+
+    Args:
+      patterns: A dictionary of rule names mapped to regexes, or a list of
+          regexes, which are named by their index.
+      flags: Any re flags to compile the regexes with.
+    Raises:
+      re.error: One of the patterns isn't a valid regex.
+    """
+
+    if not isinstance(patterns, dict):
+      patterns = dict((str(index), pattern) for index, pattern in enumerate(patterns))
+
+    self.flags = flags
+    self.rules = [Rule(name, pattern, flags) for name, pattern in sorted(patterns.iteritems())]
+
+    # Rules without a literal have to be tried on every line
+    self.unfiltered = frozenset(index for index, rule in enumerate(self.rules)
+                                if rule.literal is None)
+    self.literals = self._index_literals(False)
+    self.folded_literals = self._index_literals(True)
+
+    self.combined = {}  # Sets of candidate rule indexes mapped to a combined regex
+
+  def __len__(self):
+    return len(self.rules)
+
+  def _index_literals(self, ignore_case):
+    """Maps each reduced literal to the indexes of the rules it's a prefilter for.
+
+    Args:
+      ignore_case: Whether to index the rules that ignore case.
+    Returns:
+      A list of (literal, rule indexes) tuples.
+    """
+
+    rules = [(index, rule.literal) for index, rule in enumerate(self.rules)
+             if rule.literal is not None and rule.ignore_case == ignore_case]
+    return [(literal, frozenset(index for index, rule_literal in rules
+                                if literal in rule_literal))
+            for literal in reduce_literals(literal for index, literal in rules)]
+
+  def candidates(self, line):
+    """Finds the rules that could match a line, from the literals it contains.
+
+    Args:
+      line: The line to check.
+    Returns:
+      A frozenset of rule indexes, which is empty if no rule can match.
+    """
+
+    found = None
+    for literal, indexes in self.literals:
+      if literal in line:
+        found = indexes if found is None else found | indexes
+    if self.folded_literals:
+      folded = line.lower()
+      for literal, indexes in self.folded_literals:
+        if literal in folded:
+          found = indexes if found is None else found | indexes
+
+    if found is None:
+      return self.unfiltered
+    return found | self.unfiltered if self.unfiltered else found
+
+  def _combine(self, indexes):
+    """Builds the combined regex for a set of candidate rules.
+
+    Args:
+      indexes: A frozenset of rule indexes.
+    Returns:
+      A tuple of the compiled regex, or None if no rules can be combined, a
+      dictionary of its group names mapped to rule names, and the list of rules
+      that have to be searched separately.
+    """
+
+    combined = self.combined.get(indexes)
+    if combined is not None:
+      return combined
+
+    lookaheads = []
+    group_names = {}
+    separate = []
+    for index in sorted(indexes):
+      rule = self.rules[index]
+      if rule.combinable:
+        group = 'r%d' % index
+        group_names[group] = rule.name
+        lookaheads.append('(?=(?P<%s>.*?(?:%s)))?' % (group, rule.pattern))
+      else:
+        separate.append(rule)
+
+    regex = re.compile(''.join(lookaheads), self.flags) if lookaheads else None
+    if len(self.combined) >= MAX_COMBINED:
+      self.combined.clear()
+    combined = self.combined[indexes] = (regex, group_names, separate)
+    return combined
+
+  def match(self, line):
+    """Finds every rule that matches a line. The line is tested once against a
+    regex combining the rules whose literals it contains.
+
+    Args:
+      line: The line to match.
+    Returns:
+      A list of the names of the matching rules, which is empty if none match.
+    """
+
+    indexes = self.candidates(line)
+    if not indexes:
+      return []
+
+    regex, group_names, separate = self._combine(indexes)
+    matched = []
+    if regex is not None:
+      for group, value in regex.match(line).groupdict().iteritems():
+        if value is not None:
+          matched.append(group_names[group])
+    for rule in separate:
+      if rule.regex.search(line):
+        matched.append(rule.name)
+    return matched
+
+
+if __name__ == '__main__':
+  # Compare against searching for each regex in turn, over synthetic logs:
+  #   python -m hiveary.patterns [megabytes] [patterns]
+  import random
+  import sys
+  import time
+
+  megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 1024
+  num_patterns = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+  random.seed(0)
+  words = ['request', 'served', 'GET', 'POST', '/api/v1/users', '/static/app.js',
+           'cache', 'hit', 'miss', 'user', 'session', 'ok', 'took', 'bytes']
+  levels = ['DEBUG'] * 40 + ['INFO'] * 50 + ['WARN'] * 8 + ['ERROR'] * 2
+  lines = []
+  for i in xrange(50000):
+    lines.append(u'2014-06-01 12:00:%02d.%03d %s [worker-%d] %s %d' % (
+        i % 60, i % 1000, random.choice(levels), i % 16,
+        ' '.join(random.choice(words) for _ in xrange(8)), random.randint(1, 99999)))
+  block_size = sum(len(line) + 1 for line in lines)
+  repeats = max(1, int(megabytes * 1024 * 1024 / block_size))
+
+  patterns = [r'ERROR .*timeout', r'OutOfMemoryError', r'Traceback \(most recent call last\)',
+              r'segfault at [0-9a-f]+', r'(?i)connection refused', r'WARN .*cache miss',
+              r'status=5\d\d', r'deadlock detected', r'disk (full|quota exceeded)',
+              r'ERROR \[worker-1[0-5]\]']
+  while len(patterns) < num_patterns:
+    patterns.append(r'fatal error code E%04d' % len(patterns))
+  patterns = patterns[:num_patterns]
+
+  pattern_set = PatternSet(patterns)
+  start = time.time()
+  matches = 0
+  for repeat in xrange(repeats):
+    for line in lines:
+      if pattern_set.match(line):
+        matches += 1
+  elapsed = time.time() - start
+  total = repeats * block_size / 1024.0 / 1024
+  print '%d patterns over %.0f MB of logs' % (len(patterns), total)
+  print 'PatternSet:   %.1fs, %.1f MB/s, %d matching lines' % (elapsed, total / elapsed, matches)
+
+  # The naive approach is timed over one block and scaled up
+  regexes = [re.compile(pattern) for pattern in patterns]
+  start = time.time()
+  naive_matches = 0
+  for line in lines:
+    if [regex for regex in regexes if regex.search(line)]:
+      naive_matches += 1
+  naive_elapsed = (time.time() - start) * repeats
+  print 'Each regex:   %.1fs, %.1f MB/s, %d matching lines (timed over one block)' % (
+      naive_elapsed, total / naive_elapsed, naive_matches * repeats)
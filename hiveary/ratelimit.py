@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Token bucket rate limiting of outgoing messages.
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+  """A bucket of tokens, such as bytes, that refills at a steady rate up to
+  its burst size. Amounts larger than the burst size are allowed once the
+  bucket is full, leaving it in debt until it refills.
+
+  This isn't thread-safe, see RateLimiter."""
+
+  def __init__(self, rate, burst, clock=time.time):
+    """Initialize the bucket, starting full.
+
+    Args:
+      rate: The number of tokens added per second.
+      burst: The most tokens the bucket can hold.
+      clock: A function returning the current time in seconds.
+    """
+
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.clock = clock
+    self.tokens = self.burst
+    self.last_refill = clock()
+
+  def refill(self):
+    now = self.clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+    self.last_refill = now
+
+  def delay(self, amount):
+    """Finds how long until an amount can be taken.
+
+    Args:
+      amount: The number of tokens needed.
+    Returns:
+      The wait in seconds, 0 if the amount can be taken now.
+    """
+
+    self.refill()
+    needed = min(amount, self.burst) - self.tokens
+    return needed / self.rate if needed > 0 else 0
+
+  def take(self, amount):
+    self.tokens -= amount
+
+
+class RateLimiter(object):
+  """Limits messages with a bucket per key, such as an AMQP routing key, and a
+  global bucket shared by every key. A message is only allowed if both of its
+  buckets have room for it. All methods are thread-safe."""
+
+  MAX_KEYS = 1000  # Most per-key buckets kept, idle full buckets are discarded past this
+
+  def __init__(self, rate, burst, key_rate, key_burst, clock=time.time):
+    """Initialize the limiter.
+
+    Args:
+      rate: The global rate, per second.
+      burst: The global burst size.
+      key_rate: The rate of each key, per second.
+      key_burst: The burst size of each key.
+      clock: A function returning the current time in seconds.
+    """
+
+    self.lock = threading.Lock()
+    self.clock = clock
+    self.key_rate = key_rate
+    self.key_burst = key_burst
+    self.bucket = TokenBucket(rate, burst, clock)
+    self.buckets = {}
+
+  def acquire(self, key, amount):
+    """Takes an amount from the key's bucket and the global bucket, if both
+    have room for it.
+
+    Args:
+      key: The key the amount is for.
+      amount: The amount to take, such as the size of a message in bytes.
+    Returns:
+      0 if the amount was taken, otherwise the seconds to wait before it can be.
+    """
+
+    with self.lock:
+      bucket = self.buckets.get(key)
+      if bucket is None:
+        if len(self.buckets) >= self.MAX_KEYS:
+          self._discard_idle()
+        bucket = self.buckets[key] = TokenBucket(self.key_rate, self.key_burst, self.clock)
+
+      delay = max(bucket.delay(amount), self.bucket.delay(amount))
+      if not delay:
+        bucket.take(amount)
+        self.bucket.take(amount)
+      return delay
+
+  def _discard_idle(self):
+    """Removes the buckets that have refilled, which are the same as new ones."""
+
+    for key, bucket in self.buckets.items():
+      bucket.refill()
+      if bucket.tokens >= bucket.burst:
+        del self.buckets[key]
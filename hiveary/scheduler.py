@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Scheduling of periodic monitor runs.
+"""
+
+import hashlib
+import heapq
+import logging
+import math
+import threading
+from twisted.internet import defer
+from twisted.python import failure, threadpool
+
+
+def host_offset(host_id):
+  """Derives a deterministic offset for a host, used to spread the load of many
+  hosts across each interval while keeping a single host's schedule stable.
+
+  Args:
+    host_id: The unique ID of the host.
+  Returns:
+    A float between 0 (inclusive) and 1 (exclusive).
+  """
+
+  if host_id is None:
+    return 0.0
+  digest = hashlib.md5(str(host_id)).hexdigest()
+  return int(digest[:8], 16) / float(0x100000000)
+
+
+def with_timeout(reactor, deferred, timeout):
+  """Wraps a Deferred so that it errbacks if the result takes too long. The
+  original Deferred is left running, since threads can't be interrupted, but
+  its result is discarded if it arrives after the timeout.
+
+  Args:
+    reactor: A reference to the twisted reactor.
+    deferred: The Deferred to wait on. Its result is consumed by the wrapper.
+    timeout: The number of seconds to wait, or None to wait forever.
+  Returns:
+    A new Deferred that fires with the result of the original, or errbacks
+    with a defer.TimeoutError.
+  """
+
+  result = defer.Deferred()
+
+  def expire():
+    if not result.called:
+      result.errback(defer.TimeoutError('Timed out after %ss' % timeout))
+
+  timer = reactor.callLater(timeout, expire) if timeout else None
+
+  def finish(outcome):
+    if timer is not None and timer.active():
+      timer.cancel()
+    if not result.called:
+      if isinstance(outcome, failure.Failure):
+        result.errback(outcome)
+      else:
+        result.callback(outcome)
+
+  deferred.addBoth(finish)
+  return result
+
+
+class MonitorThreadPool(threadpool.ThreadPool):
+  """ThreadPool for collecting monitor samples whose workers don't hold up
+  shutdown. A get_data that never returns, such as one stuck on a hung
+  network mount, would otherwise block the reactor's shutdown while its worker
+  is joined, and then the interpreter's exit."""
+
+  def threadFactory(self, *args, **kwargs):
+    thread = threading.Thread(*args, **kwargs)
+    thread.daemon = True
+    return thread
+
+  def stop(self):
+    """Tells the workers to exit once they've finished their current work,
+    without waiting for them."""
+
+    self.joined = True
+    while self.workers:
+      self.q.put(threadpool.WorkerStop)
+      self.workers -= 1
+
+
+class ScheduleEntry(object):
+  """A single periodic call managed by the scheduler."""
+
+  def __init__(self, key, interval, func, args, kwargs):
+    self.key = key
+    self.interval = interval
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.due = None
+    self.active = True
+    self.running = False
+
+    # Schedule lag statistics, in seconds
+    self.runs = 0
+    self.missed = 0
+    self.skipped = 0
+    self.last_lag = 0.0
+    self.max_lag = 0.0
+    self.total_lag = 0.0
+
+  def stats(self):
+    """Returns a dictionary of the schedule statistics for this entry."""
+
+    return {
+        'interval': self.interval,
+        'runs': self.runs,
+        'missed': self.missed,
+        'skipped': self.skipped,
+        'last_lag': self.last_lag,
+        'max_lag': self.max_lag,
+        'mean_lag': self.total_lag / self.runs if self.runs else 0.0,
+    }
+
+
+class MonitorScheduler(object):
+  """Runs periodic calls on a shared timer wheel. Every call is aligned to the
+  wall-clock boundaries of its interval, shifted by a per-host jitter, so calls
+  with compatible intervals land on the same tick and run together from a
+  single reactor timer instead of each having their own LoopingCall.
+
+  Calls that return a Deferred are treated as running until it fires, and any
+  ticks that come due in the meantime are skipped rather than overlapped."""
+
+  MAX_JITTER = 5  # Upper bound of the per-host offset into each interval, in seconds
+  LAG_WARNING = 2  # Schedule lag that gets logged as a warning, in seconds
+
+  def __init__(self, reactor, host_id=None, logger=None):
+    """Initialize the scheduler.
+
+    Args:
+      reactor: A reference to the twisted reactor controlling the agent.
+      host_id: The unique ID of the host, used to derive the jitter.
+      logger: A logging object to use.
+    """
+
+    self.logger = logger or logging.getLogger('hiveary_agent.scheduler')
+    self.reactor = reactor
+    self.offset = host_offset(host_id)
+
+    self.entries = {}
+    self.wheel = {}  # Tick time mapped to the entries due at that time
+    self.ticks = []  # Heap of the tick times present in the wheel
+    self.timer = None
+
+  def jitter(self, interval):
+    """Finds the offset into each interval that this host's calls run at.
+
+    Args:
+      interval: The interval of the call, in seconds.
+    Returns:
+      The offset in seconds.
+    """
+
+    return self.offset * min(interval, self.MAX_JITTER)
+
+  def next_due(self, interval, after):
+    """Finds the next aligned time a call with the interval should run.
+
+    Args:
+      interval: The interval of the call, in seconds.
+      after: The time.time() value the call must be due after.
+    Returns:
+      The time.time() value the call should next run at.
+    """
+
+    jitter = self.jitter(interval)
+    boundary = (math.floor((after - jitter) / interval) + 1) * interval
+
+    # Rounded so calls with different intervals coalesce on the same tick
+    due = round(boundary + jitter, 3)
+    if due <= after:
+      # Rounding down landed on the boundary that just passed
+      due = round(due + interval, 3)
+    return due
+
+  def add(self, key, interval, func, *args, **kwargs):
+    """Adds a new periodic call, replacing any existing call with the same key.
+
+    Args:
+      key: A unique key for the call, such as the monitor UID.
+      interval: How often to run the call, in seconds.
+      func: The function to run. It may return a Deferred.
+      *args, **kwargs: Anything that needs to be passed to the function.
+    Returns:
+      The new ScheduleEntry.
+    """
+
+    self.remove(key)
+
+    entry = ScheduleEntry(key, interval, func, args, kwargs)
+    self.entries[key] = entry
+    self._schedule(entry, self.next_due(interval, self.reactor.seconds()))
+    self.logger.debug('Scheduled %s every %ss, first run at %.3f', key,
+                      interval, entry.due)
+
+    return entry
+
+  def remove(self, key):
+    """Stops a periodic call.
+
+    Args:
+      key: The key the call was added with.
+    """
+
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      # The entry is left in the wheel and skipped once its tick comes around
+      entry.active = False
+
+  def reschedule(self, key, interval):
+    """Changes the interval of an existing call, keeping its statistics. The
+    call is moved forward if the new interval makes it due sooner, otherwise
+    the new interval applies from its next run.
+
+    Args:
+      key: The key the call was added with.
+      interval: The new interval of the call, in seconds.
+    Returns:
+      The ScheduleEntry, or None if there's no call with the key.
+    """
+
+    entry = self.entries.get(key)
+    if entry is None or entry.interval == interval:
+      return entry
+
+    self.logger.debug('Rescheduling %s from every %ss to every %ss', key,
+                      entry.interval, interval)
+    entry.interval = interval
+
+    due = self.next_due(interval, self.reactor.seconds())
+    if entry.due is not None and due < entry.due:
+      tick = self.wheel.get(entry.due)
+      if tick is not None and entry in tick:
+        # The emptied tick is left in the heap and skipped once it comes around
+        tick.remove(entry)
+      self._schedule(entry, due)
+
+    return entry
+
+  def stats(self):
+    """Returns the schedule lag statistics for every call, keyed by the call key."""
+
+    return dict((key, entry.stats()) for key, entry in self.entries.iteritems())
+
+  def stop(self):
+    """Stops all calls."""
+
+    for key in self.entries.keys():
+      self.remove(key)
+    if self.timer is not None and self.timer.active():
+      self.timer.cancel()
+    self.timer = None
+
+  def _schedule(self, entry, due):
+    entry.due = due
+    if due not in self.wheel:
+      self.wheel[due] = []
+      heapq.heappush(self.ticks, due)
+    self.wheel[due].append(entry)
+    self._set_timer()
+
+  def _set_timer(self):
+    """Makes sure the reactor timer fires for the earliest tick."""
+
+    if not self.ticks:
+      return
+
+    if self.timer is not None and self.timer.active():
+      if self.timer.getTime() <= self.ticks[0]:
+        return
+      self.timer.cancel()
+
+    delay = max(0, self.ticks[0] - self.reactor.seconds())
+    self.timer = self.reactor.callLater(delay, self._tick)
+
+  def _tick(self):
+    """Runs every call that is due and schedules their next runs."""
+
+    self.timer = None
+    now = self.reactor.seconds()
+
+    while self.ticks and self.ticks[0] <= now:
+      due = heapq.heappop(self.ticks)
+      for entry in self.wheel.pop(due, []):
+        if entry.active:
+          self._run(entry, due, now)
+
+    self._set_timer()
+
+  def _run(self, entry, due, now):
+    """Runs a single call and schedules it again.
+
+    Args:
+      entry: The ScheduleEntry to run.
+      due: The time the call was scheduled for.
+      now: The time the tick started.
+    """
+
+    lag = now - due
+    entry.runs += 1
+    entry.last_lag = lag
+    entry.total_lag += lag
+    entry.max_lag = max(entry.max_lag, lag)
+
+    # Any boundaries that passed while the call was late are skipped
+    missed = int(lag // entry.interval)
+    if missed:
+      entry.missed += missed
+    if lag > self.LAG_WARNING:
+      self.logger.warn('%s ran %.3fs behind schedule', entry.key, lag)
+
+    if entry.running:
+      entry.skipped += 1
+      self.logger.warn('%s is still running from a previous tick, skipping', entry.key)
+    else:
+      try:
+        outcome = entry.func(*entry.args, **entry.kwargs)
+      except Exception:
+        self.logger.error('Scheduled call %s failed', entry.key, exc_info=True)
+      else:
+        if isinstance(outcome, defer.Deferred):
+          entry.running = True
+          outcome.addBoth(self._finished, entry)
+
+    if entry.active:
+      self._schedule(entry, self.next_due(entry.interval, max(now, due)))
+
+  def _finished(self, outcome, entry):
+    """Callback for when a call that returned a Deferred is complete.
+
+    Args:
+      outcome: The result of the Deferred.
+      entry: The ScheduleEntry of the call.
+    """
+
+    entry.running = False
+    if isinstance(outcome, failure.Failure):
+      self.logger.error('Scheduled call %s failed: %s', entry.key,
+                        outcome.getTraceback())
+
+
+class LiveSampler(object):
+  """Temporarily samples monitors faster while someone is watching their
+  livestream. The extra samples are stored like any other, so the regular
+  data sent to the server stays complete, and are forwarded to the streams.
+
+  The total CPU time spent on fast sampling is capped by CPU_BUDGET, using
+  the CPU time each monitor's samples have taken so far. Fast sampling stops
+  when the last stream of a monitor stops or its TTL expires."""
+
+  CPU_BUDGET = 0.05  # Fraction of a single core that fast sampling may use
+  MIN_INTERVAL = 1  # Fastest sampling allowed, in seconds
+  DEFAULT_TTL = 300  # How long fast sampling lasts if no TTL is requested, in seconds
+  MAX_TTL = 3600  # Longest TTL allowed, in seconds
+  DEFAULT_CPU_COST = 0.01  # Assumed CPU time of a sample before any are measured, in seconds
+
+  def __init__(self, reactor, scheduler, sample, recorder, logger=None):
+    """Initialize the sampler.
+
+    Args:
+      reactor: A reference to the twisted reactor.
+      scheduler: The MonitorScheduler to run the fast samples on.
+      sample: A function called with a monitor to collect and store a sample.
+      recorder: The TelemetryRecorder holding the CPU time of samples.
+      logger: A logging object to use.
+    """
+
+    self.logger = logger or logging.getLogger('hiveary_agent.scheduler')
+    self.reactor = reactor
+    self.scheduler = scheduler
+    self.sample = sample
+    self.recorder = recorder
+    self.streams = {}  # Monitor UID mapped to stream key mapped to (interval, expiry call)
+    self.intervals = {}  # Monitor UID mapped to the interval it's being sampled at
+    self.cpu_costs = {}  # Monitor UID mapped to the estimated CPU time of a sample
+
+  def key(self, monitor):
+    return monitor.UID + '.live'
+
+  def sample_cost(self, monitor):
+    """Returns the estimated CPU time of one sample of a monitor, in seconds."""
+
+    cost = self.recorder.mean_cpu(monitor.UID, 'get_data')
+    return self.DEFAULT_CPU_COST if cost is None else cost
+
+  def budget_used(self, exclude=None):
+    """Returns the fraction of a core used by fast sampling.
+
+    Args:
+      exclude: The UID of a monitor to leave out.
+    """
+
+    return sum(self.cpu_costs.get(uid, 0) / interval
+               for uid, interval in self.intervals.iteritems() if uid != exclude)
+
+  def start(self, monitor, stream_key, interval, ttl=None):
+    """Starts fast sampling for a livestream.
+
+    Args:
+      monitor: The monitor being watched.
+      stream_key: The routing key of the livestream.
+      interval: The requested time between samples, in seconds.
+      ttl: How long to sample fast for, in seconds.
+    Returns:
+      The interval the monitor is now sampled at, which may be slower than
+      requested to stay within the CPU budget, or None if the monitor isn't
+      sampled any faster than usual.
+    """
+
+    if not getattr(monitor, 'LIVE_SAMPLING', False) or monitor.DATA_INTERVAL is None:
+      return None
+
+    try:
+      interval = max(float(interval), self.MIN_INTERVAL)
+      ttl = min(float(ttl or self.DEFAULT_TTL), self.MAX_TTL)
+    except (TypeError, ValueError):
+      self.logger.warn('Invalid live sampling rate %r or TTL %r', interval, ttl)
+      return None
+
+    self.stop(monitor, stream_key)
+    streams = self.streams.setdefault(monitor.UID, {})
+    expiry = self.reactor.callLater(ttl, self.stop, monitor, stream_key)
+    streams[stream_key] = (interval, expiry)
+    return self._update(monitor)
+
+  def stop(self, monitor, stream_key):
+    """Stops fast sampling for a livestream, reverting to the monitor's usual
+    rate if it was the last stream sampling fast.
+
+    Args:
+      monitor: The monitor being watched.
+      stream_key: The routing key of the livestream.
+    """
+
+    streams = self.streams.get(monitor.UID, {})
+    stream = streams.pop(stream_key, None)
+    if stream is None:
+      return
+    interval, expiry = stream
+    if expiry.active():
+      expiry.cancel()
+    if not streams:
+      del self.streams[monitor.UID]
+    self._update(monitor)
+
+  def _update(self, monitor):
+    """Schedules the fast samples of a monitor at the fastest interval its
+    streams requested that the CPU budget allows.
+
+    Returns:
+      The new interval, or None if the monitor isn't sampled fast anymore.
+    """
+
+    key = self.key(monitor)
+    streams = self.streams.get(monitor.UID)
+    previous = self.intervals.pop(monitor.UID, None)
+    if not streams:
+      if previous is not None:
+        self.scheduler.remove(key)
+        self.logger.info('%s (%s) monitor back to its usual sampling rate',
+                         monitor.NAME, monitor.UID)
+      return None
+
+    requested = min(interval for interval, expiry in streams.itervalues())
+    cost = self.sample_cost(monitor)
+    available = self.CPU_BUDGET - self.budget_used(exclude=monitor.UID)
+    interval = requested
+    if available <= 0:
+      interval = None
+    elif cost / interval > available:
+      interval = math.ceil(cost / available)
+      self.logger.info('Live sampling of %s (%s) limited to every %ss by the CPU budget',
+                       monitor.NAME, monitor.UID, interval)
+
+    if interval is None or interval >= monitor.sample_interval():
+      if previous is not None:
+        self.scheduler.remove(key)
+      return None
+
+    self.intervals[monitor.UID] = interval
+    self.cpu_costs[monitor.UID] = cost
+    if previous is None:
+      self.scheduler.add(key, interval, self.sample, monitor)
+      self.logger.info('%s (%s) monitor sampling every %ss for its livestreams',
+                       monitor.NAME, monitor.UID, interval)
+    else:
+      self.scheduler.reschedule(key, interval)
+    return interval
+
+  def stop_all(self):
+    """Stops all fast sampling."""
+
+    for uid, streams in self.streams.items():
+      for interval, expiry in streams.itervalues():
+        if expiry.active():
+          expiry.cancel()
+      self.scheduler.remove(uid + '.live')
+    self.streams = {}
+    self.intervals = {}
+    self.cpu_costs = {}
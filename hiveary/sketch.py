@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Mergeable quantile sketches, used to report percentiles of a source without
+keeping every sample.
+"""
+
+import math
+
+
+class QuantileSketch(object):
+  """A quantile sketch with logarithmically sized buckets. Every value is
+  counted in the bucket covering it, and each bucket is narrow enough that any
+  quantile is within the relative accuracy of the true value. Negative values
+  are kept in a mirrored set of buckets, indexed by their magnitude. Sketches
+  with the same accuracy can be merged losslessly, so the server can combine
+  sketches across intervals and hosts.
+
+  Memory is bounded by max_buckets: once there are more buckets than that, the
+  lowest buckets are collapsed together, which only affects the accuracy of
+  the lowest quantiles."""
+
+  MIN_VALUE = 1e-9  # Values closer to zero than this are counted as zero
+
+  def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+    """Initialize the sketch.
+
+    Args:
+      relative_accuracy: The maximum relative error of a quantile, between 0
+          and 1.
+      max_buckets: The maximum number of buckets to keep.
+    """
+
+    self.relative_accuracy = relative_accuracy
+    self.max_buckets = max_buckets
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+
+    self.buckets = {}  # Bucket index mapped to the count of values in it
+    self.negative_buckets = {}  # The same for negative values, by their magnitude
+    self.zero_count = 0
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def __len__(self):
+    return self.count
+
+  def _index(self, value):
+    return int(math.ceil(math.log(value) / self.log_gamma))
+
+  def _value(self, index):
+    # The midpoint of the bucket, relative to its bounds
+    return 2 * self.gamma ** index / (self.gamma + 1)
+
+  def add(self, value, count=1):
+    """Adds a value to the sketch.
+
+    Args:
+      value: The value to add.
+      count: The number of times the value was seen.
+    """
+
+    if value >= self.MIN_VALUE:
+      buckets = self.buckets
+    elif value <= -self.MIN_VALUE:
+      buckets = self.negative_buckets
+    else:
+      buckets = None
+      self.zero_count += count
+
+    if buckets is not None:
+      index = self._index(abs(value))
+      buckets[index] = buckets.get(index, 0) + count
+      if len(self.buckets) + len(self.negative_buckets) > self.max_buckets:
+        self._collapse()
+
+    self.count += count
+    self.total += value * count
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+  def extend(self, values):
+    """Adds every value from an iterable to the sketch.
+
+    Args:
+      values: An iterable of values.
+    """
+
+    for value in values:
+      self.add(value)
+
+  def _collapse(self):
+    """Merges the lowest buckets so that there are at most max_buckets. The
+    lowest are the largest negative values, then the smallest positive ones."""
+
+    excess = len(self.buckets) + len(self.negative_buckets) - self.max_buckets
+    for buckets, indexes in ((self.negative_buckets, sorted(self.negative_buckets, reverse=True)),
+                             (self.buckets, sorted(self.buckets))):
+      if excess <= 0 or len(indexes) < 2:
+        continue
+      merged = indexes[:min(excess, len(indexes) - 1) + 1]
+      target = merged[-1]
+      for index in merged[:-1]:
+        buckets[target] += buckets.pop(index)
+      excess -= len(merged) - 1
+
+  def merge(self, other):
+    """Adds all values from another sketch into this one.
+
+    Args:
+      other: A QuantileSketch with the same relative accuracy.
+    Raises:
+      ValueError: The sketches have a different relative accuracy.
+    """
+
+    if other.gamma != self.gamma:
+      raise ValueError('Cannot merge sketches with a different relative accuracy')
+    if not other.count:
+      return
+
+    for index, count in other.buckets.iteritems():
+      self.buckets[index] = self.buckets.get(index, 0) + count
+    for index, count in other.negative_buckets.iteritems():
+      self.negative_buckets[index] = self.negative_buckets.get(index, 0) + count
+    if len(self.buckets) + len(self.negative_buckets) > self.max_buckets:
+      self._collapse()
+
+    self.zero_count += other.zero_count
+    self.count += other.count
+    self.total += other.total
+    self.min = other.min if self.min is None else min(self.min, other.min)
+    self.max = other.max if self.max is None else max(self.max, other.max)
+
+  def quantile(self, quantile):
+    """Estimates the value at a quantile.
+
+    Args:
+      quantile: The quantile to find, between 0 and 1.
+    Returns:
+      The estimated value, or None if the sketch is empty.
+    """
+
+    if not self.count:
+      return None
+
+    rank = quantile * (self.count - 1)
+    value = None
+    seen = 0
+    # The most negative values come first, from the largest magnitude down
+    for index in sorted(self.negative_buckets, reverse=True):
+      seen += self.negative_buckets[index]
+      if rank < seen:
+        value = -self._value(index)
+        break
+
+    if value is None:
+      seen += self.zero_count
+      if rank < seen:
+        value = 0.0
+
+    if value is None:
+      value = self.max
+      for index in sorted(self.buckets):
+        seen += self.buckets[index]
+        if rank < seen:
+          value = self._value(index)
+          break
+
+    # The exact extremes are known, so never estimate outside of them
+    return min(max(value, self.min), self.max)
+
+  def quantiles(self, quantiles=(0.5, 0.95, 0.99)):
+    """Estimates the values at several quantiles.
+
+    Args:
+      quantiles: The quantiles to find, between 0 and 1.
+    Returns:
+      A dictionary of names such as 'p95' mapped to the estimated values.
+    """
+
+    return dict(('p%g' % (quantile * 100), self.quantile(quantile))
+                for quantile in quantiles)
+
+  def to_dict(self):
+    """Returns a compact JSONable version of the sketch. Buckets are stored as
+    a flat list of [index delta, count] pairs in index order, which keeps the
+    numbers small for the narrow ranges most sources cover. Buckets of negative
+    values are stored the same way under negative_bins, when there are any."""
+
+    def encode(buckets):
+      bins = []
+      previous = 0
+      for index in sorted(buckets):
+        bins.append(index - previous)
+        bins.append(buckets[index])
+        previous = index
+      return bins
+
+    data = {
+        'accuracy': self.relative_accuracy,
+        'count': self.count,
+        'sum': self.total,
+        'min': self.min,
+        'max': self.max,
+        'zero': self.zero_count,
+        'bins': encode(self.buckets),
+    }
+    if self.negative_buckets:
+      data['negative_bins'] = encode(self.negative_buckets)
+    return data
+
+  @classmethod
+  def from_dict(cls, data, max_buckets=2048):
+    """Rebuilds a sketch from the output of to_dict.
+
+    Args:
+      data: A dictionary created by to_dict.
+      max_buckets: The maximum number of buckets to keep.
+    Returns:
+      A new QuantileSketch.
+    """
+
+    sketch = cls(data['accuracy'], max_buckets)
+    for buckets, bins in ((sketch.buckets, data['bins']),
+                          (sketch.negative_buckets, data.get('negative_bins', ()))):
+      index = 0
+      for position in xrange(0, len(bins), 2):
+        index += bins[position]
+        buckets[index] = bins[position + 1]
+    if len(sketch.buckets) + len(sketch.negative_buckets) > max_buckets:
+      sketch._collapse()
+
+    sketch.count = data['count']
+    sketch.total = data['sum']
+    sketch.min = data['min']
+    sketch.max = data['max']
+    sketch.zero_count = data['zero']
+    return sketch
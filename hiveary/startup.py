@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Profiling of the agent's startup: how long each import and startup phase takes,
+and how long until the first sample is published.
+"""
+
+import __builtin__
+import contextlib
+import logging
+import sys
+import time
+
+# Set when this module is first imported, which the agent script does before
+# anything else
+STARTED = time.time()
+MIN_IMPORT_TIME = 0.001  # Imports faster than this are left out of the report, in seconds
+
+# Whether startup is being profiled, set by the agent script
+enabled = False
+
+logger = logging.getLogger('hiveary_agent.startup')
+
+_first_sample_logged = False
+
+
+def elapsed():
+  """Returns the seconds since the agent started."""
+
+  return time.time() - STARTED
+
+
+def _label(name, globals, fromlist, level):
+  """Names an import for the report, such as "hiveary.monitors (ProcessMixin)".
+
+  Args:
+    name, globals, fromlist, level: The arguments given to __import__.
+  """
+
+  if level > 0 and globals:
+    # An explicit relative import, from the package of the importing module
+    package = globals.get('__package__') or globals.get('__name__', '').rsplit('.', level)[0]
+    name = '%s.%s' % (package, name) if name else package
+  if fromlist:
+    name = '%s (%s)' % (name, ', '.join(fromlist))
+  return name
+
+
+class ImportNode(object):
+  """An import and the imports it triggered."""
+
+  def __init__(self, name):
+    self.name = name
+    self.duration = 0.0
+    self.children = []
+
+  def self_time(self):
+    """Returns the time spent in this import, excluding its children."""
+
+    return self.duration - sum(child.duration for child in self.children)
+
+
+class ImportProfiler(object):
+  """Times every import that loads new modules, by wrapping __import__, and
+  keeps them as a tree of which import triggered which."""
+
+  def __init__(self):
+    self.root = ImportNode('total')
+    self.stack = [self.root]
+    self.original_import = None
+
+  def install(self):
+    if self.original_import is None:
+      self.original_import = __builtin__.__import__
+      __builtin__.__import__ = self._import
+
+  def uninstall(self):
+    if self.original_import is not None:
+      __builtin__.__import__ = self.original_import
+      self.original_import = None
+
+  def _import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+    node = ImportNode(_label(name, globals, fromlist, level))
+    modules = len(sys.modules)
+    self.stack.append(node)
+    start = time.time()
+    try:
+      return self.original_import(name, globals, locals, fromlist, level)
+    finally:
+      node.duration = time.time() - start
+      self.stack.pop()
+      # Imports of modules that were already loaded are left out
+      if len(sys.modules) != modules:
+        self.stack[-1].children.append(node)
+
+  def report(self, min_time=MIN_IMPORT_TIME):
+    """Builds a readable tree of the import times.
+
+    Args:
+      min_time: The shortest import to include, in seconds.
+    Returns:
+      A list of lines, one per import with its cumulative and own time, in
+      milliseconds, indented under the import that triggered it.
+    """
+
+    self.root.duration = sum(child.duration for child in self.root.children)
+    lines = []
+
+    def add(node, depth):
+      lines.append('%8.1fms %8.1fms  %s%s' % (node.duration * 1000, node.self_time() * 1000,
+                                                '  ' * depth, node.name))
+      for child in sorted(node.children, key=lambda child: -child.duration):
+        if child.duration >= min_time:
+          add(child, depth + 1)
+
+    lines.append('%10s %10s  %s' % ('cumulative', 'self', 'module'))
+    add(self.root, 0)
+    return lines
+
+
+@contextlib.contextmanager
+def phase(name):
+  """Context manager that logs how long a phase of startup took.
+
+  Args:
+    name: A description of the phase, such as "loading monitors".
+  """
+
+  start = time.time()
+  try:
+    yield
+  finally:
+    logger.info('Startup: %s took %.3fs, %.3fs since startup', name,
+                time.time() - start, elapsed())
+
+
+def log_first_sample(monitor):
+  """Logs the time from startup to the first published sample, once, when
+  startup is being profiled.
+
+  Args:
+    monitor: The monitor that published the sample.
+  """
+
+  global _first_sample_logged
+  if enabled and not _first_sample_logged:
+    _first_sample_logged = True
+    logger.info('First sample published by %s (%s) %.3fs after startup',
+                monitor.NAME, monitor.UID, elapsed())
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Listener for metrics pushed by applications in the StatsD format.
+"""
+
+import errno
+import logging
+import os
+import socket
+import stat
+import time
+from twisted.internet import interfaces
+from zope.interface import implementer
+
+DEFAULT_PORT = 8125
+MAX_METRICS = 10000  # Most counter and timer names tracked each interval, to bound memory
+MAX_GAUGES = 10000  # Most gauge names kept at once, to bound memory
+GAUGE_EXPIRY = 60 * 60  # Gauges that haven't been set for this long are dropped, in seconds
+MAX_PACKET_SIZE = 65535
+MAX_BATCH = 1000  # Most packets read from a socket before yielding to the reactor
+RECEIVE_BUFFER = 4 * 1024 * 1024  # Requested socket buffer, to ride out bursts
+
+# Where to listen, set from the agent's config. The listener is only started
+# when at least one of these is set.
+port = None
+unix_socket = None
+
+
+class StatsdAggregator(object):
+  """Aggregates StatsD metrics between flushes. Counters are summed, gauges
+  keep their latest value across flushes until they go unset for the gauge
+  expiry, and timers keep their count, sum, min and max. Aggregates are updated in place, so a metric only allocates
+  anything the first time it's seen in an interval.
+
+  This isn't thread-safe, parse and flush should both be called from the
+  reactor thread."""
+
+  def __init__(self, max_metrics=MAX_METRICS, max_gauges=MAX_GAUGES,
+               gauge_expiry=GAUGE_EXPIRY, logger=None):
+    """Initialize the aggregator.
+
+    Args:
+      max_metrics: The most counter and timer names to track, new names past
+          this are dropped until the next flush.
+      max_gauges: The most gauge names to keep, new names past this are
+          dropped until older gauges expire.
+      gauge_expiry: The time after which a gauge that hasn't been set is
+          dropped, in seconds.
+      logger: A logging object to use.
+    """
+
+    self.logger = logger or logging.getLogger('hiveary_agent.statsd')
+    self.max_metrics = max_metrics
+    self.max_gauges = max_gauges
+    self.gauge_expiry = gauge_expiry
+    self.counters = {}
+    self.gauges = {}
+    self.gauges_set = {}  # Gauge name mapped to the start of the last interval it was set in
+    self.timers = {}  # Name mapped to a [count, sum, min, max] list
+    self.last_flush = time.time()
+
+    # Totals since the agent started
+    self.packets = 0
+    self.metrics = 0
+    self.invalid = 0
+    self.dropped = 0
+
+  def tracked(self):
+    """Returns the number of counter and timer names tracked this interval.
+    Gauges are kept across flushes, so they're capped separately."""
+
+    return len(self.counters) + len(self.timers)
+
+  def parse(self, data, packets=1):
+    """Parses newline separated metrics, such as
+    "requests:1|c\\nlatency:320|ms|@0.1\\nqueue:+5|g".
+
+    Args:
+      data: One or more raw packets joined by newlines.
+      packets: The number of packets in the data.
+    """
+
+    counters = self.counters
+    gauges = self.gauges
+    gauges_set = self.gauges_set
+    interval = self.last_flush
+    timers = self.timers
+    metrics = 0
+    invalid = 0
+
+    for line in data.split('\n'):
+      if not line:
+        continue
+      try:
+        name, rest = line.split(':', 1)
+        fields = rest.split('|')
+        kind = fields[1]
+        raw_value = fields[0]
+        value = float(raw_value)
+
+        if kind == 'c':
+          if len(fields) > 2 and fields[2][:1] == '@':
+            rate = float(fields[2][1:])
+            if not 0 < rate <= 1:
+              raise ValueError('Invalid sample rate %s' % rate)
+            value /= rate
+          if name in counters:
+            counters[name] += value
+          elif self._admit(name):
+            counters[name] = value
+
+        elif kind == 'ms' or kind == 'h':
+          timer = timers.get(name)
+          if timer is not None:
+            timer[0] += 1
+            timer[1] += value
+            if value < timer[2]:
+              timer[2] = value
+            elif value > timer[3]:
+              timer[3] = value
+          elif self._admit(name):
+            timers[name] = [1, value, value, value]
+
+        elif kind == 'g':
+          if name in gauges:
+            if raw_value[:1] in '+-':
+              gauges[name] += value
+            else:
+              gauges[name] = value
+            gauges_set[name] = interval
+          elif self._admit_gauge():
+            gauges[name] = value
+            gauges_set[name] = interval
+
+        else:
+          invalid += 1
+          continue
+        metrics += 1
+      except (ValueError, IndexError, ZeroDivisionError):
+        invalid += 1
+
+    self.packets += packets
+    self.metrics += metrics
+    self.invalid += invalid
+
+  def _admit(self, name):
+    """Checks whether there's room to track a new metric name."""
+
+    if self.tracked() < self.max_metrics:
+      return True
+    self.dropped += 1
+    return False
+
+  def _admit_gauge(self):
+    """Checks whether there's room to keep a new gauge name."""
+
+    if len(self.gauges) < self.max_gauges:
+      return True
+    self.dropped += 1
+    return False
+
+  def flush(self):
+    """Returns the aggregated values since the last flush, and resets the
+    counters and timers. Gauges that haven't been set within the gauge expiry
+    are dropped.
+
+    Returns:
+      A dictionary of source names mapped to values. Counters are reported as
+      a rate per second, gauges as their value, and each timer as name.count,
+      name.mean, name.min and name.max.
+    """
+
+    now = time.time()
+    elapsed = max(now - self.last_flush, 0.001)
+    self.last_flush = now
+
+    expired = [name for name, interval in self.gauges_set.iteritems()
+               if now - interval > self.gauge_expiry]
+    for name in expired:
+      del self.gauges[name]
+      del self.gauges_set[name]
+
+    data = {}
+    for name, value in self.counters.iteritems():
+      data[name] = value / elapsed
+    for name, (count, total, minimum, maximum) in self.timers.iteritems():
+      data[name + '.count'] = count
+      data[name + '.mean'] = total / count
+      data[name + '.min'] = minimum
+      data[name + '.max'] = maximum
+    data.update(self.gauges)
+
+    self.counters = {}
+    self.timers = {}
+    return data
+
+
+@implementer(interfaces.IReadDescriptor)
+class DatagramReader(object):
+  """Reads datagrams straight from a socket registered with the reactor. Each
+  time the socket is readable every waiting packet, up to MAX_BATCH, is read
+  and the batch is parsed in one pass, which avoids the per-packet overhead of
+  a twisted DatagramProtocol."""
+
+  def __init__(self, sock, aggregator, logger=None):
+    """Initialize the reader.
+
+    Args:
+      sock: A bound, non-blocking datagram socket.
+      aggregator: The StatsdAggregator to feed packets into.
+      logger: A logging object to use.
+    """
+
+    self.logger = logger or logging.getLogger('hiveary_agent.statsd')
+    self.socket = sock
+    self.aggregator = aggregator
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def logPrefix(self):
+    return 'statsd'
+
+  def doRead(self):
+    recv = self.socket.recv
+    packets = []
+    try:
+      for _ in xrange(MAX_BATCH):
+        packets.append(recv(MAX_PACKET_SIZE))
+    except socket.error as e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        self.logger.warn('Error reading StatsD packets: %s', e)
+
+    if packets:
+      self.aggregator.parse('\n'.join(packets), len(packets))
+
+  def connectionLost(self, reason):
+    self.socket.close()
+
+
+def remove_stale_socket(path):
+  """Removes a unix socket left over from a previous run. Anything else at the
+  path, including a socket that's still being listened on, is left alone.
+
+  Args:
+    path: The path of the socket.
+  Raises:
+    socket.error: The path is in use.
+  """
+
+  try:
+    mode = os.lstat(path).st_mode
+  except OSError as e:
+    if e.errno == errno.ENOENT:
+      return
+    raise
+
+  if not stat.S_ISSOCK(mode):
+    raise socket.error(errno.EADDRINUSE, '%s exists and is not a socket' % path)
+
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  try:
+    probe.connect(path)
+  except socket.error as e:
+    if e.errno != errno.ECONNREFUSED:
+      raise
+  else:
+    raise socket.error(errno.EADDRINUSE, '%s is in use by another process' % path)
+  finally:
+    probe.close()
+
+  # Nothing is listening, so the socket was left over from a previous run
+  os.remove(path)
+
+
+def listen(reactor, aggregator, port=DEFAULT_PORT, interface='127.0.0.1',
+           unix_socket=None):
+  """Starts listening for StatsD packets.
+
+  Args:
+    reactor: A reference to the twisted reactor.
+    aggregator: The StatsdAggregator to feed packets into.
+    port: The UDP port to listen on, or None to not listen over UDP.
+    interface: The interface to listen on for UDP.
+    unix_socket: An optional path of a unix datagram socket to listen on.
+  Returns:
+    A list of the DatagramReaders, which can be stopped with
+    reactor.removeReader.
+  """
+
+  sockets = []
+  if port is not None:
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind((interface, port))
+    sockets.append(udp_socket)
+  if unix_socket:
+    remove_stale_socket(unix_socket)
+    unix_datagram_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    unix_datagram_socket.bind(unix_socket)
+    sockets.append(unix_datagram_socket)
+
+  readers = []
+  for sock in sockets:
+    sock.setblocking(False)
+    try:
+      # The kernel caps this at its own maximum
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    except socket.error:
+      pass
+    reader = DatagramReader(sock, aggregator)
+    reactor.addReader(reader)
+    readers.append(reader)
+  return readers
+
+
+if __name__ == '__main__':
+  # Load generator, which sends packets from a separate process and reports
+  # how many the listener handled:
+  #   python -m hiveary.statsd [seconds] [metrics per packet]
+  import multiprocessing
+  import sys
+  from twisted.internet import reactor
+
+  duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+  per_packet = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+  port = 18125
+
+  metrics = ['app.requests:1|c', 'app.latency:%d|ms', 'app.queue:%d|g',
+             'app.errors:1|c|@0.1']
+
+  def generate(stop_at):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packets = []
+    for i in xrange(1000):
+      lines = []
+      for j in xrange(per_packet):
+        metric = metrics[(i + j) % len(metrics)]
+        lines.append(metric % (i % 500) if '%d' in metric else metric)
+      packets.append('\n'.join(lines))
+    sent = 0
+    while time.time() < stop_at:
+      for packet in packets:
+        sender.sendto(packet, ('127.0.0.1', port))
+      sent += len(packets)
+    print 'Sent %d packets' % sent
+
+  # Time spent parsing alone, without the cost of receiving from the socket
+  aggregator = StatsdAggregator()
+  sample = ['\n'.join(metrics[(i + j) % len(metrics)].replace('%d', str(i))
+                      for j in xrange(per_packet)) for i in xrange(1000)]
+  start = time.time()
+  for repeat in xrange(100):
+    for packet in sample:
+      aggregator.parse(packet)
+  parse_rate = aggregator.packets / (time.time() - start)
+  print 'Parsing only: %d packets/s, %d metrics/s' % (parse_rate, parse_rate * per_packet)
+
+  aggregator = StatsdAggregator()
+  listen(reactor, aggregator, port)
+  stop_at = time.time() + duration
+  sender = multiprocessing.Process(target=generate, args=(stop_at,))
+  cpu_start = []
+
+  def start():
+    cpu_start.append(sum(os.times()[:2]))
+    sender.start()
+
+  def report():
+    # The listener's rate per second of its own CPU time, since the sender
+    # competes for the same cores
+    cpu_used = sum(os.times()[:2]) - cpu_start[0]
+    sender.join()
+    print 'Received %d packets in %.1fs using %.2fs of CPU' % (aggregator.packets,
+                                                              duration, cpu_used)
+    print 'Per core: %d packets/s, %d metrics/s' % (aggregator.packets / cpu_used,
+                                                     aggregator.metrics / cpu_used)
+    reactor.stop()
+
+  reactor.callWhenRunning(start)
+  reactor.callLater(duration, report)
+  reactor.run()
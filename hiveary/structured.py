@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Extraction of numeric and categorical fields from structured (JSON or logfmt)
+log lines.
+"""
+
+import json
+import re
+import time
+
+import hiveary.sketch
+
+HISTOGRAM = 'histogram'  # Numeric fields, reported as count, mean, min, max and percentiles
+COUNTER = 'counter'  # Categorical fields, reported as a rate per second of each value
+MAX_VALUES = 100  # Most distinct values counted per counter field, the rest are counted as "other"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _lookup(record, path):
+  """Finds a possibly nested field of a decoded JSON record.
+
+  Args:
+    record: The decoded record.
+    path: A list of the keys leading to the field.
+  Returns:
+    The value of the field, or None if it's missing.
+  """
+
+  for key in path:
+    if not isinstance(record, dict):
+      return None
+    record = record.get(key)
+    if record is None:
+      return None
+  return record
+
+
+class FieldExtractor(object):
+  """Aggregates configured fields of structured log lines between flushes.
+
+  Parsing is lazy: a line is only decoded if it contains the name of one of
+  the fields, which is a cheap substring check, so the many lines without the
+  fields cost next to nothing. Lines that pass are not decoded in full either,
+  the configured keys are pulled out with a single regex. Only nested JSON
+  fields need the whole line to be decoded.
+
+  This isn't thread-safe, add and flush should be called from the same
+  thread."""
+
+  FORMATS = ('auto', 'json', 'logfmt')
+
+  def __init__(self, fields, log_format='auto', accuracy=0.01):
+    """Initialize the extractor.
+
+    Args:
+      fields: A dictionary of field names mapped to HISTOGRAM or COUNTER.
+          Nested JSON fields are named by their keys joined with dots, such
+          as "http.status".
+      log_format: 'json', 'logfmt', or 'auto' to tell them apart by whether
+          the line starts with a brace.
+      accuracy: The relative accuracy of histogram percentiles.
+    Raises:
+      ValueError: The format or the kind of a field isn't known.
+    """
+
+    if log_format not in self.FORMATS:
+      raise ValueError('Unknown log format %s' % log_format)
+    for name, kind in fields.iteritems():
+      if kind not in (HISTOGRAM, COUNTER):
+        raise ValueError('Unknown kind %s for field %s' % (kind, name))
+
+    self.fields = dict(fields)
+    self.log_format = log_format
+    self.accuracy = accuracy
+
+    # The last key of each field must appear in a line for it to be decoded
+    self.paths = dict((name, name.split('.')) for name in self.fields)
+    self.json_keys = sorted(set(u'"%s"' % path[-1] for path in self.paths.itervalues()))
+    self.logfmt_keys = sorted(set(u'%s=' % name for name in self.fields))
+    names = '|'.join(re.escape(name) for name in sorted(self.fields, key=len, reverse=True))
+    self.logfmt_regex = re.compile(r'(?<!\S)(%s)=("(?:[^"\\]|\\.)*"|\S*)' % names,
+                                   re.UNICODE)
+    # A quoted key followed by a colon can't appear inside a JSON string, where
+    # the quotes would be escaped
+    self.nested = any(len(path) > 1 for path in self.paths.itervalues())
+    self.json_regex = re.compile(r'"(%s)"\s*:\s*("(?:[^"\\]|\\.)*"|[^\s,}\]]+)' % names,
+                                 re.UNICODE)
+
+    # Totals since the extractor was created
+    self.lines = 0
+    self.parsed = 0
+    self.invalid = 0
+
+    self._reset()
+
+  def _reset(self):
+    self.histograms = {}  # Field mapped to a QuantileSketch
+    self.counters = {}  # Field mapped to a dictionary of values mapped to counts
+    self.last_flush = time.time()
+
+  def add_lines(self, lines):
+    """Adds the fields of several lines.
+
+    Args:
+      lines: A list of lines.
+    """
+
+    for line in lines:
+      self.add(line)
+
+  def add(self, line):
+    """Adds the fields of a line, if it has any.
+
+    Args:
+      line: A single log line.
+    Returns:
+      A boolean of whether the line was decoded.
+    """
+
+    self.lines += 1
+
+    if self.log_format == 'json' or (self.log_format == 'auto' and line[:1] == u'{'):
+      for key in self.json_keys:
+        if key in line:
+          break
+      else:
+        return False
+      values = self._parse_json(line)
+    else:
+      for key in self.logfmt_keys:
+        if key in line:
+          break
+      else:
+        return False
+      values = self._parse_logfmt(line)
+
+    if values is None:
+      self.invalid += 1
+      return False
+    self.parsed += 1
+
+    for name, value in values:
+      if self.fields[name] == HISTOGRAM:
+        self._add_histogram(name, value)
+      else:
+        self._add_counter(name, value)
+    return True
+
+  def _parse_json(self, line):
+    """Pulls the configured keys out of a JSON line. The line is only decoded
+    in full when there are nested fields.
+
+    Returns:
+      A list of (field, value) tuples of the fields present, or None if the
+      line isn't a JSON object.
+    """
+
+    if not self.nested:
+      values = []
+      for name, value in self.json_regex.findall(line):
+        if value[:1] == u'"':
+          try:
+            value = json.loads(value)
+          except ValueError:
+            return None
+        elif value == u'null':
+          continue
+        elif value in (u'true', u'false'):
+          value = value == u'true'
+        values.append((name, value))
+      return values
+
+    try:
+      record = json.loads(line)
+    except ValueError:
+      return None
+    if not isinstance(record, dict):
+      return None
+
+    values = []
+    for name, path in self.paths.iteritems():
+      value = record.get(path[0]) if len(path) == 1 else _lookup(record, path)
+      if value is not None:
+        values.append((name, value))
+    return values
+
+  def _parse_logfmt(self, line):
+    """Pulls the configured keys out of a logfmt line, without splitting the
+    rest of it.
+
+    Returns:
+      A list of (field, value) tuples of the fields present.
+    """
+
+    values = []
+    for name, value in self.logfmt_regex.findall(line):
+      if value[:1] == u'"':
+        value = value[1:-1].replace(u'\\"', u'"')
+      values.append((name, value))
+    return values
+
+  def _add_histogram(self, name, value):
+    try:
+      value = float(value)
+    except (TypeError, ValueError):
+      self.invalid += 1
+      return
+    if value != value:
+      # NaN can't be placed in a bucket
+      return
+
+    sketch = self.histograms.get(name)
+    if sketch is None:
+      sketch = self.histograms[name] = hiveary.sketch.QuantileSketch(self.accuracy)
+    sketch.add(value)
+
+  def _add_counter(self, name, value):
+    if isinstance(value, bool):
+      value = u'true' if value else u'false'
+    elif isinstance(value, (dict, list)):
+      self.invalid += 1
+      return
+
+    counts = self.counters.get(name)
+    if counts is None:
+      counts = self.counters[name] = {}
+    if value not in counts and len(counts) >= MAX_VALUES:
+      value = u'other'
+    counts[value] = counts.get(value, 0) + 1
+
+  def flush(self):
+    """Returns the aggregated fields since the last flush, and resets them.
+
+    Returns:
+      A dictionary of source names mapped to values. Each histogram field is
+      reported as field.count, field.mean, field.min, field.max and
+      percentiles such as field.p95, and each value of a counter field as
+      field.value, its rate per second.
+    """
+
+    now = time.time()
+    elapsed = max(now - self.last_flush, 0.001)
+
+    data = {}
+    for name, sketch in self.histograms.iteritems():
+      if not sketch.count:
+        continue
+      data[name + '.count'] = sketch.count
+      data[name + '.mean'] = sketch.total / sketch.count
+      data[name + '.min'] = sketch.min
+      data[name + '.max'] = sketch.max
+      for quantile, value in sketch.quantiles(QUANTILES).iteritems():
+        data['%s.%s' % (name, quantile)] = value
+    for name, counts in self.counters.iteritems():
+      for value, count in counts.iteritems():
+        data[u'%s.%s' % (name, value)] = count / elapsed
+
+    self._reset()
+    return data
+
+
+if __name__ == '__main__':
+  # Parse cost per line, for lines that are rejected by the prefilter and
+  # lines that are decoded, compared with decoding every line:
+  #   python -m hiveary.structured [lines]
+  import random
+  import sys
+
+  num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+  random.seed(0)
+  json_lines = []
+  logfmt_lines = []
+  for i in xrange(num_lines):
+    record = {'ts': '2014-06-01T12:00:%02d' % (i % 60), 'level': 'info',
+              'msg': 'request served', 'path': '/api/v1/users/%d' % (i % 100)}
+    if i % 4 == 0:
+      # A quarter of the lines are access logs with the fields
+      record['latency_ms'] = round(random.expovariate(1 / 40.0), 2)
+      record['status'] = random.choice([200] * 90 + [404] * 6 + [500] * 4)
+    json_lines.append(unicode(json.dumps(record)))
+    logfmt_lines.append(u' '.join(u'%s=%s' % (key, '"%s"' % value if ' ' in str(value) else value)
+                                  for key, value in sorted(record.items())))
+
+  fields = {'latency_ms': HISTOGRAM, 'status': COUNTER}
+
+  def timed(name, lines, add):
+    start = time.time()
+    for line in lines:
+      add(line)
+    elapsed = time.time() - start
+    print '%-32s %6.2f us/line, %8d lines/s' % (name, elapsed * 1e6 / len(lines),
+                                                len(lines) / elapsed)
+
+  for log_format, lines in (('json', json_lines), ('logfmt', logfmt_lines)):
+    with_fields = lines[::4]
+    without_fields = [line for i, line in enumerate(lines) if i % 4]
+    timed('%s, prefiltered out' % log_format, without_fields,
+          FieldExtractor(fields, log_format).add)
+    timed('%s, decoded' % log_format, with_fields, FieldExtractor(fields, log_format).add)
+    extractor = FieldExtractor(fields, log_format)
+    timed('%s, mixed' % log_format, lines, extractor.add)
+    print '  %s' % ', '.join('%s=%.4g' % item for item in sorted(extractor.flush().items()))
+
+  timed('json.loads on every line', json_lines, json.loads)
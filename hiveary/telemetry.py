@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Self-telemetry for the agent, used to find out which monitors are using the
+agent's time.
+"""
+
+import bisect
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+CLOCK_THREAD_CPUTIME_ID = 3  # From <time.h>, the value differs on other platforms
+
+
+class _timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _find_thread_clock():
+  """Finds a function returning the CPU time used by the calling thread. Work is
+  spread across worker threads, so the process-wide CPU time can't be used to
+  tell monitors apart where a per-thread clock is available.
+
+  Returns:
+    A function that returns the CPU time in seconds.
+  """
+
+  # Process-wide user and system time, only accurate when monitors don't overlap
+  process_clock = lambda: sum(os.times()[:2])
+
+  library = sys.platform.startswith('linux') and (
+      ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+  if not library:
+    return process_clock
+  try:
+    clock_gettime = ctypes.CDLL(library).clock_gettime
+  except (OSError, AttributeError):
+    return process_clock
+  clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+  clock_gettime.restype = ctypes.c_int
+
+  # Make sure the clock is supported before relying on it, a call only fails
+  # for an invalid clock ID
+  if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(_timespec())) != 0:
+    return process_clock
+
+  def thread_clock():
+    spec = _timespec()
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(spec))
+    return spec.tv_sec + spec.tv_nsec / 1e9
+  return thread_clock
+
+thread_cpu_time = _find_thread_clock()
+
+
+class Histogram(object):
+  """A fixed-size histogram of durations, with exponentially growing buckets."""
+
+  BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+            10, 30, 60)
+
+  def __init__(self, bounds=BOUNDS):
+    """Initialize the histogram.
+
+    Args:
+      bounds: The sorted upper bounds of each bucket. A final bucket catches
+          everything above the last bound.
+    """
+
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, value):
+    """Adds a single value to the histogram.
+
+    Args:
+      value: The value to add.
+    """
+
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.total += value
+    self.max = max(self.max, value)
+
+  def to_dict(self):
+    """Returns a JSONable version of the histogram."""
+
+    return {
+        'bounds': self.bounds,
+        'counts': self.counts,
+        'count': self.count,
+        'total': self.total,
+        'max': self.max,
+    }
+
+
+class TelemetryRecorder(object):
+  """Keeps the execution statistics of every monitor, keyed by the monitor UID.
+  All methods are thread-safe."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.timings = {}  # UID mapped to stage mapped to wall/cpu histograms
+    self.counters = {}  # UID mapped to counter name mapped to value
+
+  @contextlib.contextmanager
+  def measure(self, uid, stage):
+    """Context manager that records the wall and CPU time spent in a block.
+
+    Args:
+      uid: The UID of the monitor.
+      stage: The name of what's being measured, such as get_data.
+    """
+
+    wall_start = time.time()
+    cpu_start = thread_cpu_time()
+    try:
+      yield
+    finally:
+      self.record(uid, stage, time.time() - wall_start,
+                  thread_cpu_time() - cpu_start)
+
+  def record(self, uid, stage, wall, cpu=None):
+    """Records a single measurement.
+
+    Args:
+      uid: The UID of the monitor.
+      stage: The name of what was measured, such as get_data.
+      wall: The wall time taken, in seconds.
+      cpu: The CPU time taken, in seconds, if known.
+    """
+
+    with self.lock:
+      stages = self.timings.setdefault(uid, {})
+      if stage not in stages:
+        stages[stage] = {'wall': Histogram(), 'cpu': Histogram()}
+      stages[stage]['wall'].add(wall)
+      if cpu is not None:
+        stages[stage]['cpu'].add(cpu)
+
+  def increment(self, uid, counter, amount=1):
+    """Increases a counter.
+
+    Args:
+      uid: The UID of the monitor.
+      counter: The name of the counter, such as bytes_serialized.
+      amount: How much to increase the counter by.
+    """
+
+    with self.lock:
+      counters = self.counters.setdefault(uid, {})
+      counters[counter] = counters.get(counter, 0) + amount
+
+  def mean_cpu(self, uid, stage):
+    """Returns the mean CPU time of a stage, in seconds, or None if it hasn't
+    been measured.
+
+    Args:
+      uid: The UID of the monitor.
+      stage: The name of what was measured, such as get_data.
+    """
+
+    with self.lock:
+      histogram = self.timings.get(uid, {}).get(stage, {}).get('cpu')
+      if histogram is None or not histogram.count:
+        return None
+      return histogram.total / histogram.count
+
+  def snapshot(self, schedule_stats=None):
+    """Builds a JSONable summary of all statistics.
+
+    Args:
+      schedule_stats: Optional schedule statistics for each monitor UID, as
+          returned by MonitorScheduler.stats.
+    Returns:
+      A dictionary of monitor UIDs mapped to their statistics.
+    """
+
+    monitors = {}
+    with self.lock:
+      for uid, stages in self.timings.iteritems():
+        monitor = monitors.setdefault(uid, {})
+        for stage, histograms in stages.iteritems():
+          monitor[stage] = dict((name, histogram.to_dict())
+                                for name, histogram in histograms.iteritems())
+      for uid, counters in self.counters.iteritems():
+        monitors.setdefault(uid, {}).update(counters)
+
+    for uid, stats in (schedule_stats or {}).iteritems():
+      monitors.setdefault(uid, {})['schedule'] = stats
+
+    return {
+        'since': self.started,
+        'timestamp': time.time(),
+        'monitors': monitors,
+    }
+
+
+# Shared recorder for the whole agent
+recorder = TelemetryRecorder()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Local evaluation of the expected values sent by the server, so that alerts
+can be fired as soon as a sample is taken.
+"""
+
+import array
+import logging
+
+# NumPy is optional, when available it's used to evaluate samples
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+NAN = float('nan')
+INF = float('inf')
+
+logger = logging.getLogger('hiveary_agent.thresholds')
+
+
+def _as_number(value):
+  """Returns the value as a float, or NaN if it isn't numeric."""
+
+  if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+    return float(value)
+  return NAN
+
+
+def parse_expected(expected):
+  """Normalizes the expected value of a single source.
+
+  Args:
+    expected: Either a dictionary with optional 'min' and 'max' bounds, a
+        dictionary with a list of acceptable 'states', a two item [min, max]
+        list, or a list of acceptable states.
+  Returns:
+    A tuple of (lower bound, upper bound, states). The bounds are None for
+    state based sources and the states are None for numeric sources.
+  Raises:
+    ValueError: The expected value isn't in a known format, or has no
+        acceptable states, which would make every value a breach.
+  """
+
+  if isinstance(expected, dict):
+    if 'states' in expected:
+      if not expected['states']:
+        raise ValueError('No acceptable states given')
+      return (None, None, frozenset(expected['states']))
+    lower = expected.get('min')
+    upper = expected.get('max')
+  elif isinstance(expected, (list, tuple)):
+    if not expected:
+      raise ValueError('No acceptable states given')
+    if all(isinstance(value, basestring) for value in expected):
+      return (None, None, frozenset(expected))
+    if len(expected) != 2:
+      raise ValueError('Expected a [min, max] pair, got %r' % (expected,))
+    lower, upper = expected
+  else:
+    raise ValueError('Unknown expected value format %r' % (expected,))
+
+  lower = -INF if lower is None else float(lower)
+  upper = INF if upper is None else float(upper)
+  return (lower, upper, None)
+
+
+class ThresholdEngine(object):
+  """Checks samples against the expected values of each source. The bounds are
+  compiled into parallel arrays whenever the expected values change, so each
+  sample is checked in a single pass over the arrays."""
+
+  def __init__(self):
+    # Replaced as a whole on update, so evaluate always sees a consistent set
+    self.compiled = ((), array.array('d'), array.array('d'), {})
+
+  def update(self, expected_values):
+    """Compiles a new set of expected values, replacing the current set.
+
+    Args:
+      expected_values: A dictionary of source names mapped to their expected
+          value, in any format understood by parse_expected.
+    """
+
+    sources = []
+    lower_bounds = array.array('d')
+    upper_bounds = array.array('d')
+    states = {}
+
+    for source, expected in expected_values.iteritems():
+      try:
+        lower, upper, allowed_states = parse_expected(expected)
+      except (ValueError, TypeError):
+        logger.warn('Ignoring invalid expected value for %s: %r', source, expected)
+        continue
+
+      if allowed_states is not None:
+        states[source] = allowed_states
+      else:
+        sources.append(source)
+        lower_bounds.append(lower)
+        upper_bounds.append(upper)
+
+    self.compiled = (tuple(sources), lower_bounds, upper_bounds, states)
+
+  def evaluate(self, sample):
+    """Finds all sources in a sample that are outside of their expected values.
+
+    Args:
+      sample: A dictionary of source names mapped to their sampled values.
+    Returns:
+      A list of (source, value, expected) tuples for every breached source.
+      For numeric sources expected is a dictionary of the min and max, for
+      state sources it is a dictionary of the allowed states.
+    """
+
+    sources, lower_bounds, upper_bounds, states = self.compiled
+    breaches = []
+
+    if sources:
+      values = [_as_number(sample.get(source)) for source in sources]
+      if numpy is not None:
+        values_array = numpy.array(values, dtype=numpy.float64)
+        lower_array = numpy.frombuffer(lower_bounds, dtype=numpy.float64)
+        upper_array = numpy.frombuffer(upper_bounds, dtype=numpy.float64)
+        # Comparisons with NaN are always false, so missing sources never breach
+        breached = numpy.nonzero((values_array < lower_array) | (values_array > upper_array))[0]
+      else:
+        breached = [index for index, value in enumerate(values)
+                    if value < lower_bounds[index] or value > upper_bounds[index]]
+
+      for index in breached:
+        breaches.append((sources[index], values[index], {
+            'min': lower_bounds[index] if lower_bounds[index] != -INF else None,
+            'max': upper_bounds[index] if upper_bounds[index] != INF else None,
+        }))
+
+    for source, allowed_states in states.iteritems():
+      value = sample.get(source)
+      if value is not None and value not in allowed_states:
+        breaches.append((source, value, {'states': sorted(allowed_states)}))
+
+    return breaches
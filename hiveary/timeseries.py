@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Compact storage of monitor samples.
+"""
+
+import array
+import itertools
+import threading
+
+# NumPy is optional, when available it's used for the reductions
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+NAN = float('nan')
+
+
+def _is_number(value):
+  return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+class TimeSeriesRing(object):
+  """Fixed-capacity ring of samples. Every numeric source is stored in its own
+  array of doubles, sharing a single array of timestamps, so a sample costs
+  8 bytes per source instead of a dictionary. Sources missing from a sample
+  are stored as NaN. Non-numeric values, such as states, only keep their most
+  recent value."""
+
+  def __init__(self, capacity, metadata=('interval',)):
+    """Initialize the ring.
+
+    Args:
+      capacity: The maximum number of samples to keep.
+      metadata: Keys of samples that describe the sample rather than being a
+          source, which only keep their most recent value.
+    """
+
+    self.capacity = capacity
+    self.metadata = frozenset(metadata)
+    self.lock = threading.Lock()
+    self.timestamps = array.array('d', [NAN]) * capacity
+    self.sources = {}
+    self.latest = {}
+    self.head = 0  # Position the next sample will be written to
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def __nonzero__(self):
+    return self.count > 0
+
+  def append(self, sample):
+    """Adds a sample, overwriting the oldest one if the ring is full.
+
+    Args:
+      sample: A dictionary of source names mapped to values. The 'timestamp'
+          key, if present, is stored as the sample time.
+    """
+
+    with self.lock:
+      position = self.head
+      self.timestamps[position] = sample.get('timestamp', NAN)
+
+      for source, values in self.sources.iteritems():
+        if source not in sample:
+          values[position] = NAN
+
+      for source, value in sample.iteritems():
+        if source == 'timestamp':
+          continue
+        if _is_number(value) and source not in self.metadata:
+          values = self.sources.get(source)
+          if values is None:
+            values = self.sources[source] = array.array('d', [NAN]) * self.capacity
+          values[position] = value
+        self.latest[source] = value
+
+      self.head = (position + 1) % self.capacity
+      self.count = min(self.count + 1, self.capacity)
+
+  def clear(self):
+    """Removes all samples. The storage of sources that were in any of the
+    samples is kept for reuse, the rest is freed so sources that have gone
+    away, such as exited processes, don't keep an array each."""
+
+    with self.lock:
+      latest = self.latest
+      for source in [source for source in self.sources if source not in latest]:
+        del self.sources[source]
+      self.count = 0
+      self.latest = {}
+
+  def window(self, size=None):
+    """Returns a view of the most recent samples, without copying them.
+
+    Args:
+      size: The number of samples to include, defaults to all of them.
+    Returns:
+      A RingView of the samples.
+    """
+
+    with self.lock:
+      size = self.count if size is None else min(size, self.count)
+      return RingView(self, (self.head - size) % self.capacity, size)
+
+  def merge(self):
+    """Combines the stored samples into a single dictionary, equivalent to
+    updating a dictionary with each sample in order.
+
+    Returns:
+      A dictionary of the latest value for each source, along with the
+      timestamp of the latest sample.
+    """
+
+    with self.lock:
+      if not self.count:
+        return {}
+      merged = dict(self.latest)
+      merged['timestamp'] = self.timestamps[(self.head - 1) % self.capacity]
+      return merged
+
+
+class RingView(object):
+  """A window of consecutive samples within a TimeSeriesRing. The view reads
+  straight from the ring's arrays, so it should be used before the ring wraps
+  around past the start of the window."""
+
+  def __init__(self, ring, start, size):
+    self.ring = ring
+    self.start = start
+    self.size = size
+
+  def __len__(self):
+    return self.size
+
+  def _segments(self):
+    """Returns the (start, end) index ranges of the view, split where the ring
+    wraps around."""
+
+    end = self.start + self.size
+    if end <= self.ring.capacity:
+      return [(self.start, end)]
+    return [(self.start, self.ring.capacity), (0, end - self.ring.capacity)]
+
+  def values(self, source):
+    """Iterates over the values of a source in the view, oldest first,
+    skipping samples that didn't include the source.
+
+    Args:
+      source: The name of the source.
+    """
+
+    values = self.ring.sources.get(source)
+    if values is None:
+      return iter(())
+    segments = [itertools.islice(values, start, end) for start, end in self._segments()]
+    return (value for value in itertools.chain(*segments) if value == value)
+
+  def as_array(self, source):
+    """Returns the values of a source as a NumPy array, including NaN for
+    missing samples. The array shares memory with the ring unless the view
+    wraps around.
+
+    Args:
+      source: The name of the source.
+    Returns:
+      A numpy.ndarray, or None if NumPy isn't available.
+    """
+
+    if numpy is None:
+      return None
+    values = self.ring.sources.get(source)
+    if values is None:
+      return numpy.empty(0)
+    buffer_view = numpy.frombuffer(values, dtype=numpy.float64)
+    segments = [buffer_view[start:end] for start, end in self._segments()]
+    return segments[0] if len(segments) == 1 else numpy.concatenate(segments)
+
+  def summary(self, source):
+    """Reduces the values of a source to its min, max, mean, last and count.
+
+    Args:
+      source: The name of the source.
+    Returns:
+      A dictionary of the reductions, or None if the source has no values
+      within the view.
+    """
+
+    if numpy is not None:
+      values = self.as_array(source)
+      values = values[~numpy.isnan(values)]
+      if not len(values):
+        return None
+      return {
+          'min': float(values.min()),
+          'max': float(values.max()),
+          'mean': float(values.mean()),
+          'last': float(values[-1]),
+          'count': int(len(values)),
+      }
+
+    count = 0
+    total = 0.0
+    minimum = maximum = last = None
+    for value in self.values(source):
+      if not count:
+        minimum = maximum = value
+      else:
+        minimum = min(minimum, value)
+        maximum = max(maximum, value)
+      total += value
+      last = value
+      count += 1
+
+    if not count:
+      return None
+    return {'min': minimum, 'max': maximum, 'mean': total / count,
+            'last': last, 'count': count}
+
+  def summaries(self):
+    """Reduces every numeric source in the view.
+
+    Returns:
+      A dictionary of source names mapped to their summary.
+    """
+
+    summaries = {}
+    for source in self.ring.sources.keys():
+      summary = self.summary(source)
+      if summary is not None:
+        summaries[source] = summary
+    return summaries
+
+
+if __name__ == '__main__':
+  # Compare the memory used per sample against storing a dict per sample:
+  #   python -m hiveary.timeseries [sources] [samples]
+  import random
+  import sys
+  import time
+
+  num_sources = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  num_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+  sources = ['source_%d' % i for i in xrange(num_sources)]
+  samples = []
+  for i in xrange(num_samples):
+    sample = dict((source, random.random() * 100) for source in sources)
+    sample['timestamp'] = time.time()
+    samples.append(sample)
+
+  dict_bytes = sum(sys.getsizeof(sample) + sum(sys.getsizeof(v) for v in sample.itervalues())
+                   for sample in samples)
+
+  ring = TimeSeriesRing(num_samples)
+  for sample in samples:
+    ring.append(sample)
+  ring_bytes = (sys.getsizeof(ring.timestamps) + sys.getsizeof(ring.sources) +
+                sum(sys.getsizeof(values) for values in ring.sources.itervalues()))
+
+  print '%d sources, %d samples' % (num_sources, num_samples)
+  print 'dict per sample: %.1f bytes per sample' % (dict_bytes / float(num_samples))
+  print 'TimeSeriesRing:  %.1f bytes per sample' % (ring_bytes / float(num_samples))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Hiveary Container Resource Monitor
+Monitors the following sources for every container cgroup:
+  <container>_cpu, <container>_ram, <container>_io_read, <container>_io_write
+"""
+
+import multiprocessing
+import psutil
+import time
+
+from hiveary import monitors
+import hiveary.info.cgroups
+
+
+class ContainerResourceMonitor(monitors.PollingMixin, monitors.UsageMonitor):
+  """Monitors resource usage of each container using the cgroup hierarchy."""
+
+  DATA_INTERVAL = 10
+  NAME = 'containers'
+  UID = 'c3f4b0d2-52a5-4f8e-9a57-2a0b6e1d8c41'
+  RESCAN_INTERVAL = 60  # How often to look for new or removed containers, in seconds
+  ID_LENGTH = 12  # Length of the container ID used in source names, same as docker
+
+  def __init__(self, *args, **kwargs):
+    hierarchies = hiveary.info.cgroups.find_hierarchies()
+    if not hierarchies:
+      raise EnvironmentError('No cgroup hierarchies are mounted')
+
+    self.reader = hiveary.info.cgroups.CgroupStatReader(hierarchies)
+    self.num_cpus = multiprocessing.cpu_count()
+    self.containers = {}
+    self.last_stats = {}
+    self.last_scan = 0
+    self.pid_to_container = {}
+
+    self.SOURCES = {}
+    self.rescan()
+
+    super(ContainerResourceMonitor, self).__init__(*args, **kwargs)
+
+  def rescan(self):
+    """Finds the current set of containers, dropping state for any that have
+    been removed.
+
+    Returns:
+      A boolean of whether any containers were added.
+    """
+
+    containers = self.reader.find_containers()
+
+    for removed in set(self.containers).difference(containers):
+      self.reader.forget_cgroup(self.containers[removed])
+      self.last_stats.pop(removed, None)
+      for suffix in ('_cpu', '_ram', '_io_read', '_io_write'):
+        self.SOURCES.pop(removed[:self.ID_LENGTH] + suffix, None)
+
+    for added in set(containers).difference(self.containers):
+      name = added[:self.ID_LENGTH]
+      self.SOURCES[name + '_cpu'] = 'percent'
+      self.SOURCES[name + '_ram'] = 'bytes'
+      self.SOURCES[name + '_io_read'] = 'bytes'
+      self.SOURCES[name + '_io_write'] = 'bytes'
+
+    added = bool(set(containers).difference(self.containers))
+    self.containers = containers
+    self.last_scan = time.time()
+    return added
+
+  def get_data(self):
+    """Pulls the resource usage of every container. CPU and IO are reported as
+    rates computed from the change in the cumulative counters since the
+    previous interval.
+
+    Returns:
+      A dictionary with keys container(_cpu|_ram|_io_read|_io_write) to their values.
+    """
+
+    now = time.time()
+    if now - self.last_scan >= self.RESCAN_INTERVAL and self.rescan():
+      self.sources_changed()
+
+    data = {}
+    for container, cgroup_path in self.containers.iteritems():
+      stats = self.reader.container_stats(cgroup_path)
+      if not stats:
+        continue
+
+      name = container[:self.ID_LENGTH]
+      if 'memory' in stats:
+        data[name + '_ram'] = stats['memory']
+
+      last_time, last = self.last_stats.get(container, (None, None))
+      self.last_stats[container] = (now, stats)
+      if last_time is None or now <= last_time:
+        # Rates need two samples
+        continue
+
+      time_diff = now - last_time
+      if 'cpu_usage' in stats and 'cpu_usage' in last:
+        # Normalized across all CPUs to match the host-wide cpu source
+        cpu_diff = max(0, stats['cpu_usage'] - last['cpu_usage'])
+        data[name + '_cpu'] = 100.0 * cpu_diff / time_diff / self.num_cpus
+      for counter in ('io_read', 'io_write'):
+        if counter in stats and counter in last:
+          data[name + '_' + counter] = max(0, stats[counter] - last[counter]) / time_diff
+
+    return data
+
+  def container_processes(self, container):
+    """Finds the processes running within a container, using a cache of pid to
+    container mappings that is refreshed for new pids only.
+
+    Args:
+      container: The full container ID.
+    Returns:
+      A list of psutil.Process instances belonging to the container.
+    """
+
+    processes = []
+    current_pids = set()
+    for process in psutil.process_iter():
+      current_pids.add(process.pid)
+      if process.pid not in self.pid_to_container:
+        self.pid_to_container[process.pid] = hiveary.info.cgroups.container_for_pid(process.pid)
+      if self.pid_to_container[process.pid] == container:
+        processes.append(process)
+
+    # Drop exited pids so the cache can't grow without bound
+    for pid in set(self.pid_to_container).difference(current_pids):
+      del self.pid_to_container[pid]
+
+    return processes
+
+  def extra_alert_data(self, source):
+    """Finds the processes in the container when an alert is fired.
+
+    Args:
+      source: The source of the fired alert.
+    Returns:
+      A list of dictionaries containing section titles and data
+    """
+
+    name = source.rsplit('_', 1)[0]
+    if name.endswith('_io'):
+      name = name[:-len('_io')]
+
+    for container in self.containers:
+      if container.startswith(name):
+        break
+    else:
+      return []
+
+    container_procs = []
+    for process in self.container_processes(container):
+      try:
+        container_procs.append({
+            'name': process.name,
+            'pid': process.pid,
+            'cpu_percent': process.get_cpu_percent(interval=None),
+            'memory_percent': process.get_memory_percent(),
+        })
+      except psutil.NoSuchProcess:
+        continue
+
+    return [{
+        'title': 'Processes in container {}'.format(name),
+        'data': container_procs,
+    }]
@@ -28,10 +28,9 @@ class ProcessResourceMonitor(monitors.PollingMixin, monitors.UsageMonitor):
 
     self.name_to_pid = {}
 
-    for process in psutil.process_iter():
-      self.SOURCES[process.name + "_cpu"] = "percent"
-      self.SOURCES[process.name + "_ram"] = "percent"
-      self.name_to_pid[process.name] = process.pid
+    # Walking every process is slow on busy hosts, so the sources are found
+    # as they're sampled rather than holding up startup
+    self.SOURCES = {}
 
     super(ProcessResourceMonitor, self).__init__(*args, **kwargs)
 
@@ -51,6 +50,24 @@ class ProcessResourceMonitor(monitors.PollingMixin, monitors.UsageMonitor):
 
     return data
 
+  def record_sample(self, data):
+    """Stores a sample, adding the processes that weren't running before as
+    new sources.
+
+    Args:
+      data: A dictionary of sampled data.
+    """
+
+    added = False
+    for source in data:
+      if source not in self.SOURCES and source.endswith(('_cpu', '_ram')):
+        self.SOURCES[source] = "percent"
+        added = True
+    if added:
+      self.sources_changed()
+
+    super(ProcessResourceMonitor, self).record_sample(data)
+
   def extra_alert_data(self, process_source):
     """Pulls extra information about the process when the alert is fired.
 
@@ -22,7 +22,10 @@ import hiveary.info.system
 class ResourceMonitor(monitors.ProcessMixin, monitors.PollingMixin, monitors.UsageMonitor):
   """Monitors system resource data."""
 
-  MONITOR_TIMER = 10
+  MONITOR_TIMER = 5
+  ADAPTIVE = True
+  ALERT_DATA_TIMEOUT = 5  # Max time to spend gathering extra alert data, in seconds
+  SKETCH_TYPES = ('percent', 'bytes')
   NAME = 'resources'
   UID = '2c72af48-37ce-4ea1-9e53-9f081a6bcb6b'
 
@@ -83,6 +86,7 @@ class ResourceMonitor(monitors.ProcessMixin, monitors.PollingMixin, monitors.Usa
       A list of dictionaries containing section titles and data
     """
 
+    deadline = time.time() + self.ALERT_DATA_TIMEOUT
     extra_data = []
     top = None
 
@@ -113,7 +117,7 @@ class ResourceMonitor(monitors.ProcessMixin, monitors.PollingMixin, monitors.Usa
       })
 
     if top:
-      top_procs = hiveary.info.system.pull_processes(top=top)
+      top_procs = hiveary.info.system.top_processes(top, deadline=deadline)
       if top_procs:
         # Find out any more information available about these processes and
         # provide those details to the user.
@@ -127,10 +131,11 @@ class ResourceMonitor(monitors.ProcessMixin, monitors.PollingMixin, monitors.Usa
               'logs': {},
           }
 
-          # Read any available log information
-          for log_file in hiveary.info.logs.log_files(process):
-            last_logs = hiveary.info.logs.tail_file(log_file)
-            proc_subset['logs'][log_file] = last_logs
+          # Read any available log information, as long as there is time left
+          if time.time() < deadline:
+            for log_file in hiveary.info.logs.log_files(process):
+              last_logs = hiveary.info.logs.tail_file(log_file)
+              proc_subset['logs'][log_file] = last_logs
 
           # Remove log subsection if logs not available
           if not proc_subset['logs']:
@@ -142,11 +147,15 @@ class ResourceMonitor(monitors.ProcessMixin, monitors.PollingMixin, monitors.Usa
           'data': top_procs_extra,
         })
 
-    system_logs = hiveary.info.logs.read_system_logs()
-    if system_logs:
-      extra_data.append({
-        'title': 'System logs',
-        'data': system_logs,
-      })
+    if time.time() < deadline:
+      system_logs = hiveary.info.logs.read_system_logs()
+      if system_logs:
+        extra_data.append({
+          'title': 'System logs',
+          'data': system_logs,
+        })
+    else:
+      self.logger.warn('Extra alert data for %s exceeded %ss, system logs skipped',
+                       source, self.ALERT_DATA_TIMEOUT)
 
     return extra_data
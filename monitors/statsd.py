@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Hiveary
+https://hiveary.com
+
+Licensed under Simplified BSD License (see LICENSE)
+(C) Hiveary, Inc. 2014 all rights reserved
+
+Hiveary StatsD Monitor
+Monitors metrics pushed by applications in the StatsD format:
+  <counter> (per second), <gauge>, <timer>.count, <timer>.mean, <timer>.min,
+  <timer>.max
+"""
+
+import os
+import socket
+from twisted.internet import defer, reactor
+
+from hiveary import monitors
+import hiveary.statsd
+
+
+class StatsdMonitor(monitors.PollingMixin, monitors.UsageMonitor):
+  """Listens for StatsD packets over UDP and a unix datagram socket, and reports
+  every metric received as a source. The listener is opt-in, enabled by the
+  statsd_port and statsd_socket config options."""
+
+  DATA_INTERVAL = 10
+  NAME = 'statsd'
+  UID = '5b0e7a3c-9d14-4c61-8f2e-3a7d6c1b9e50'
+  INTERFACE = '127.0.0.1'
+  SOURCE_TYPES = {'.count': 'count', '.mean': 'ms', '.min': 'ms', '.max': 'ms'}
+  LIVE_SAMPLING = False  # Timers would be split between samples
+
+  def __init__(self, *args, **kwargs):
+    self.port = hiveary.statsd.port
+    self.unix_socket = hiveary.statsd.unix_socket
+    if self.port is None and not self.unix_socket:
+      raise monitors.MonitorDisabled('No statsd_port or statsd_socket is configured')
+
+    self.SOURCES = {}
+    self.aggregator = hiveary.statsd.StatsdAggregator()
+
+    super(StatsdMonitor, self).__init__(*args, **kwargs)
+
+    self.readers = []
+    if self.port is not None:
+      self.readers.extend(hiveary.statsd.listen(reactor, self.aggregator, self.port,
+                                                self.INTERFACE))
+    if self.unix_socket:
+      try:
+        self.readers.extend(hiveary.statsd.listen(
+            reactor, self.aggregator, port=None, unix_socket=self.unix_socket))
+      except (socket.error, OSError) as e:
+        self.logger.warn('Unable to listen on %s: %s', self.unix_socket, e)
+        self.unix_socket = None
+    if not self.readers:
+      raise EnvironmentError('Unable to listen for StatsD packets')
+
+  def collect(self, reactor, threadpool):
+    """Samples the aggregated metrics. The aggregator is only touched from the
+    reactor thread, and flushing it is cheap, so this doesn't use a worker
+    thread.
+
+    Args:
+      reactor: A reference to the twisted reactor.
+      threadpool: Unused.
+    Returns:
+      A Deferred that has already fired with the sampled data.
+    """
+
+    return defer.maybeDeferred(self.sample)
+
+  def get_data(self):
+    """Flushes the metrics received since the last sample, adding any metrics
+    seen for the first time as new sources."""
+
+    data = self.aggregator.flush()
+
+    added = False
+    for source in data:
+      if source not in self.SOURCES:
+        self.SOURCES[source] = self.source_type(source)
+        added = True
+    if added:
+      self.sources_changed()
+
+    return data
+
+  def source_type(self, source):
+    """Finds the type of a newly seen source.
+
+    Args:
+      source: The name of the source.
+    Returns:
+      The type of the source, such as 'gauge'.
+    """
+
+    if source in self.aggregator.gauges:
+      return 'gauge'
+    for suffix, source_type in self.SOURCE_TYPES.iteritems():
+      if source.endswith(suffix):
+        return source_type
+    return 'per_second'
+
+  def stop(self):
+    for reader in self.readers:
+      reactor.removeReader(reader)
+      reader.connectionLost(None)
+    if self.unix_socket and os.path.exists(self.unix_socket):
+      os.remove(self.unix_socket)